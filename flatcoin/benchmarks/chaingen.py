@@ -0,0 +1,237 @@
+import random
+from typing import Dict, List, Set
+
+import ecdsa
+
+from flatcoin.block import Block, BlockHeader, BlockSummary
+from flatcoin.coinselection import InsufficientFundsError
+from flatcoin.coinstate import CoinState
+from flatcoin.consensus import target_threshold
+from flatcoin.mining import NONCE_SPACE, TEMPLATE_RESERVED_BYTES, search_nonces
+from flatcoin.params import BLOCK_REWARD, MAX_BLOCK_SIZE
+from flatcoin.payout import create_payout_transactions
+from flatcoin.transaction import Output, OutputReference, Transaction
+from flatcoin.wallet import Wallet, create_coinbase_transaction, create_spend_transaction
+
+from flatcoin.benchmarks.reorg import BENCHMARK_TARGET
+
+
+# Builds the same chain for the same seed: every key, amount and recipient
+# comes from one random.Random, timestamps are spaced a block interval
+# apart from a fixed start, and signatures use RFC 6979 nonces instead of
+# random ones. Chains from different runs are identical byte for byte, so
+# timings taken on them can be compared.
+#
+# Coinbases go to a random user. Each other transaction picks a sender with
+# coins that are still unspent in the block being built, and is one of:
+#   a payout to several users, which splits coins (fan-out)
+#   a large payment, most of the sender's balance, which needs many
+#     inputs (fan-in)
+#   a small payment with change, the common case
+# The first blocks hold only a few transactions, until payouts have spread
+# coins over enough users.
+
+GENESIS_TIMESTAMP = 1_700_000_000
+BLOCK_INTERVAL = 600
+
+DEFAULT_USERS = 32
+
+# share of transactions of each kind; the rest are small payments
+PAYOUT_SHARE = 0.2
+LARGE_PAYMENT_SHARE = 0.15
+MAX_PAYOUT_RECIPIENTS = 8
+
+MIN_FEE = 100
+MAX_FEE = 1000
+
+
+class DeterministicSigningKey:
+
+    # what sign_transaction needs from a signing key, with the nonce derived
+    # from the key and digest
+
+    def __init__(self, signing_key: ecdsa.SigningKey):
+        self.signing_key = signing_key
+
+    def sign_digest(self, digest: bytes) -> bytes:
+        return self.signing_key.sign_digest_deterministic(digest)  # type: ignore
+
+
+class DeterministicWallet(Wallet):
+
+    def signing_key(self, public_key: bytes) -> ecdsa.SigningKey:
+        signing_key = self.signing_keys.get(public_key)
+        if signing_key is None:
+            signing_key = DeterministicSigningKey(super().signing_key(public_key))  # type: ignore
+            self.signing_keys[public_key] = signing_key  # type: ignore
+        return signing_key
+
+
+def new_wallet(rng: random.Random) -> DeterministicWallet:
+    signing_key = ecdsa.SigningKey.from_secret_exponent(
+        rng.randrange(1, ecdsa.SECP256k1.order), curve=ecdsa.SECP256k1
+    )
+    public_key = signing_key.verifying_key.to_string()  # type: ignore
+    return DeterministicWallet({public_key: signing_key.to_string()})
+
+
+def public_key_of(wallet: Wallet) -> bytes:
+    return next(iter(wallet.keypair))  # type: ignore
+
+
+def mine_block(previous_hash: bytes, height: int, timestamp: int, transactions: List[Transaction]) -> Block:
+    summary = BlockSummary(
+        timestamp=timestamp,
+        height=height,
+        block_hash=b"\x00" * 32,
+        nonce=0,
+        target=BENCHMARK_TARGET,
+        previous_block_hash=previous_hash,
+        merkle_root_hash=b"\x00" * 32,
+    )
+    block = Block(BlockHeader(summary), transactions)
+    summary.merkle_root_hash = block.merkle_root()
+
+    (nonce, _) = search_nonces(
+        block.header.serialize(), summary.nonce_offset(), target_threshold(BENCHMARK_TARGET), 0, NONCE_SPACE
+    )
+    if nonce is None:
+        raise ValueError("Nonce space exhausted")
+    summary.nonce = nonce
+    block.invalidate()
+    return block
+
+
+class SyntheticChain:
+
+    def __init__(self, seed: int, blocks: List[Block], wallets: List[DeterministicWallet], coinstate: CoinState):
+        self.seed = seed
+        self.blocks = blocks
+        self.wallets = wallets
+        # the UTXO set after the last block
+        self.coinstate = coinstate
+
+    @property
+    def transaction_count(self) -> int:
+        return sum(len(block.transactions) for block in self.blocks)
+
+    @property
+    def input_count(self) -> int:
+        return sum(len(transaction.inputs) for block in self.blocks for transaction in block.transactions)
+
+    @property
+    def output_count(self) -> int:
+        return sum(len(transaction.outputs) for block in self.blocks for transaction in block.transactions)
+
+    @property
+    def size(self) -> int:
+        return sum(block.serialized_size() for block in self.blocks)
+
+    def tip_hash(self) -> bytes:
+        return self.blocks[-1].hash()
+
+
+class _BlockBuilder:
+
+    def __init__(self, rng: random.Random, wallets: List[DeterministicWallet], coinstate: CoinState):
+        self.rng = rng
+        self.wallets = wallets
+        self.coinstate = coinstate
+        self.spent: Set[OutputReference] = set()
+        self.size = 0
+
+    def unspent(self, wallet: Wallet) -> Dict[OutputReference, Output]:
+        return {
+            reference: output for (reference, output) in wallet.get_unspent_outputs(self.coinstate).items()
+            if reference not in self.spent
+        }
+
+    def next_transactions(self) -> List[Transaction]:
+        rng = self.rng
+        candidates = [wallet for wallet in self.wallets if self.unspent(wallet)]
+        if not candidates:
+            return []
+
+        sender = rng.choice(candidates)
+        unspent = self.unspent(sender)
+        balance = sum(output.value for output in unspent.values())
+        fee = rng.randint(MIN_FEE, MAX_FEE)
+        others = [wallet for wallet in self.wallets if wallet is not sender]
+
+        kind = rng.random()
+        if kind < PAYOUT_SHARE:
+            recipients = rng.sample(others, rng.randint(2, MAX_PAYOUT_RECIPIENTS))
+            share = (balance - fee) // (2 * len(recipients))
+            if share <= 0:
+                return []
+            payouts = [(public_key_of(wallet), rng.randint(1, share)) for wallet in recipients]
+            return create_payout_transactions(sender, unspent, payouts, fee)
+
+        if kind < PAYOUT_SHARE + LARGE_PAYMENT_SHARE:
+            amount = int((balance - fee) * rng.uniform(0.5, 0.95))
+        else:
+            largest = max(output.value for output in unspent.values())
+            amount = int((largest - fee) * rng.uniform(0.05, 0.5))
+        if amount <= 0:
+            return []
+        return [create_spend_transaction(sender, unspent, public_key_of(rng.choice(others)), amount, fee)]
+
+    def add(self, transactions: List[Transaction]) -> bool:
+        size = sum(transaction.serialized_size() for transaction in transactions)
+        if self.size + size > MAX_BLOCK_SIZE - TEMPLATE_RESERVED_BYTES:
+            return False
+        for transaction in transactions:
+            self.spent.update(inp.output_reference for inp in transaction.inputs)
+        self.size += size
+        return True
+
+
+def generate_chain(
+    blocks: int,
+    transactions_per_block: int,
+    seed: int = 0,
+    users: int = DEFAULT_USERS,
+) -> SyntheticChain:
+    # blocks includes the first one, which holds only its coinbase
+    if blocks < 1:
+        raise ValueError("A chain needs at least one block")
+    if users < MAX_PAYOUT_RECIPIENTS + 1:
+        raise ValueError(f"The generator needs at least {MAX_PAYOUT_RECIPIENTS + 1} users")
+
+    rng = random.Random(seed)
+    wallets = [new_wallet(rng) for _ in range(users)]
+    coinstate = CoinState.empty()
+    chain: List[Block] = []
+    previous_hash = b"\x00" * 32
+
+    for height in range(blocks):
+        builder = _BlockBuilder(rng, wallets, coinstate)
+        transactions: List[Transaction] = []
+        fees = 0
+
+        # a failed draw still uses up an attempt, so the loop ends even when
+        # coins are scarce
+        attempts = 0
+        while height > 0 and len(transactions) < transactions_per_block and attempts < 2 * transactions_per_block:
+            attempts += 1
+            try:
+                drawn = builder.next_transactions()
+            except InsufficientFundsError:
+                continue
+            if not drawn or not builder.add(drawn):
+                continue
+            for transaction in drawn:
+                fees += sum(builder.coinstate.unspent_transaction_outs.get(inp.output_reference).value  # type: ignore
+                            for inp in transaction.inputs)
+                fees -= sum(output.value for output in transaction.outputs)
+            transactions.extend(drawn)
+
+        miner = public_key_of(rng.choice(wallets))
+        coinbase = create_coinbase_transaction(miner, BLOCK_REWARD + fees, height)
+        block = mine_block(previous_hash, height, GENESIS_TIMESTAMP + height * BLOCK_INTERVAL, [coinbase] + transactions)
+
+        coinstate = coinstate.apply_block(block)
+        chain.append(block)
+        previous_hash = block.hash()
+
+    return SyntheticChain(seed, chain, wallets, coinstate)
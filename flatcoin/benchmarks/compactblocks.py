@@ -0,0 +1,186 @@
+import argparse
+import json
+import random
+from time import perf_counter
+from typing import Any, Dict, List, Optional
+
+from flatcoin.block import Block, BlockHeader, BlockSummary
+from flatcoin.merkle import merkle_root
+from flatcoin.mining import TEMPLATE_RESERVED_BYTES
+from flatcoin.networking.compact import CompactBlock, PartialBlock
+from flatcoin.networking.protocol import (
+    BlockData,
+    BlockTransactions,
+    CompactBlockData,
+    GetBlockTransactions,
+    encode_message,
+)
+from flatcoin.params import BLOCK_REWARD, MAX_BLOCK_SIZE
+from flatcoin.transaction import Input, Output, OutputReference, Transaction
+from flatcoin.wallet import create_coinbase_transaction
+
+
+# Relays one block to a receiver whose mempool holds a given share of the
+# block's transactions, and compares sending it in full with sending it as
+# a compact block. Propagation time is modelled as one-way latency per
+# message leg plus bytes over bandwidth; a compact block that cannot be
+# rebuilt alone costs two more legs for the missing transactions.
+
+# what a block template leaves for transactions besides the coinbase
+BLOCK_SPACE = int(MAX_BLOCK_SIZE) - TEMPLATE_RESERVED_BYTES
+
+
+def random_transaction(rng: random.Random, inputs: int, outputs: int) -> Transaction:
+    transaction = Transaction(
+        [Input(OutputReference(rng.randbytes(32), rng.randrange(4)), rng.randbytes(64)) for _ in range(inputs)],
+        [Output(rng.randrange(1, 10**8), rng.randbytes(64)) for _ in range(outputs)],
+        None,
+    )
+    transaction.hash()
+    return transaction
+
+
+def typical_transaction(rng: random.Random) -> Transaction:
+    # mostly one or two inputs and two outputs, with the odd consolidation
+    # or fan-out payment
+    return random_transaction(rng, rng.choice((1, 1, 2, 2, 2, 3, 8)), rng.choice((1, 2, 2, 2, 3, 10)))
+
+
+def random_transactions(rng: random.Random, count: int) -> List[Transaction]:
+    return [typical_transaction(rng) for _ in range(count)]
+
+
+def block_transactions(rng: random.Random, count: Optional[int] = None) -> List[Transaction]:
+    # count transactions, or as many as fit when count is None; either way
+    # they must fit in BLOCK_SPACE, as in a block a node would accept
+    if count is not None:
+        transactions = random_transactions(rng, count)
+        size = sum(transaction.serialized_size() for transaction in transactions)
+        if size > BLOCK_SPACE:
+            raise ValueError(f"{count} transactions take {size} bytes, a block has room for {BLOCK_SPACE}")
+        return transactions
+
+    transactions = []
+    size = 0
+    while True:
+        transaction = typical_transaction(rng)
+        size += transaction.serialized_size()
+        if size > BLOCK_SPACE:
+            return transactions
+        transactions.append(transaction)
+
+
+def synthetic_block(rng: random.Random, transactions: List[Transaction]) -> Block:
+    coinbase = create_coinbase_transaction(rng.randbytes(64), BLOCK_REWARD, 1000)
+    transactions = [coinbase] + transactions
+    summary = BlockSummary(
+        timestamp=1_700_000_000,
+        height=1000,
+        block_hash=rng.randbytes(32),
+        nonce=rng.getrandbits(32),
+        target=0xffffff,
+        previous_block_hash=rng.randbytes(32),
+        merkle_root_hash=merkle_root([transaction.hash() for transaction in transactions]),
+    )
+    return Block(BlockHeader(summary), transactions)
+
+
+def relay_once(
+    block: Block,
+    mempool: List[Transaction],
+    rng: random.Random,
+    latency: float,
+    bandwidth: float,
+) -> Dict[str, Any]:
+    full_bytes = len(encode_message(BlockData(block.serialize())))
+
+    started = perf_counter()
+    compact = CompactBlock.from_block(block, rng.getrandbits(64))
+    compact_bytes = len(encode_message(CompactBlockData(compact)))
+
+    partial = PartialBlock(compact)
+    partial.fill(mempool)
+    missing = partial.missing()
+
+    legs = 1
+    if missing:
+        block_hash = compact.hash()
+        compact_bytes += len(encode_message(GetBlockTransactions(block_hash, missing)))
+        compact_bytes += len(encode_message(BlockTransactions(block_hash, [block.transactions[index] for index in missing])))
+        partial.fill_missing(missing, [block.transactions[index] for index in missing])
+        legs += 2
+
+    rebuilt = partial.to_block()
+    reconstruct_seconds = perf_counter() - started
+    if rebuilt is None or rebuilt.merkle_root() != block.merkle_root():
+        raise AssertionError("Compact block did not rebuild the original block")
+
+    full_seconds = latency + full_bytes / bandwidth
+    compact_seconds = legs * latency + compact_bytes / bandwidth + reconstruct_seconds
+    return {
+        "missing": len(missing),
+        "full_bytes": full_bytes,
+        "compact_bytes": compact_bytes,
+        "bandwidth_saving": full_bytes / compact_bytes,
+        "reconstruct_ms": reconstruct_seconds * 1000,
+        "full_propagation_ms": full_seconds * 1000,
+        "compact_propagation_ms": compact_seconds * 1000,
+    }
+
+
+def run_compact_benchmark(
+    transactions: Optional[int] = None,
+    extra: int = 5000,
+    overlaps: Optional[List[float]] = None,
+    latency: float = 0.05,
+    bandwidth: float = 1_000_000,
+    seed: int = 0,
+) -> List[Dict[str, Any]]:
+    # extra is how many unrelated transactions sit in the receiver's mempool
+    # next to the ones the block has in common with it
+    rng = random.Random(seed)
+    block = synthetic_block(rng, block_transactions(rng, transactions))
+    unrelated = random_transactions(rng, extra)
+
+    results = []
+    for overlap in overlaps if overlaps is not None else [0.0, 0.5, 0.9, 0.99, 1.0]:
+        known = rng.sample(block.transactions[1:], round(overlap * (len(block.transactions) - 1)))
+        mempool = known + unrelated
+        rng.shuffle(mempool)
+
+        result = relay_once(block, mempool, rng, latency, bandwidth)
+        result["overlap"] = overlap
+        results.append(result)
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="flatcoin-bench-compact", description="Compare full and compact block relay")
+    parser.add_argument("--transactions", type=int, default=None,
+                        help="transactions in the block besides the coinbase (default: as many as fit)")
+    parser.add_argument("--extra", type=int, default=5000, help="unrelated transactions in the receiver's mempool")
+    parser.add_argument("--overlap", type=lambda value: [float(x) for x in value.split(",")], default=None,
+                        help="comma separated shares of the block already in the receiver's mempool")
+    parser.add_argument("--latency", type=float, default=0.05, help="one-way latency in seconds")
+    parser.add_argument("--bandwidth", type=float, default=1_000_000, help="link bandwidth in bytes per second")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    results = run_compact_benchmark(args.transactions, args.extra, args.overlap, args.latency, args.bandwidth, args.seed)
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+
+    print(f"{'overlap':>8} {'missing':>8} {'full B':>10} {'compact B':>10} {'saving':>8} {'rebuild ms':>11} {'full ms':>9} {'compact ms':>11}")
+    for result in results:
+        print(
+            f"{result['overlap']:>8.2f} {result['missing']:>8} {result['full_bytes']:>10,} {result['compact_bytes']:>10,} "
+            f"{result['bandwidth_saving']:>7.1f}x {result['reconstruct_ms']:>11.2f} "
+            f"{result['full_propagation_ms']:>9.1f} {result['compact_propagation_ms']:>11.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import argparse
+import json
+import os
+import tempfile
+from time import perf_counter, time
+from typing import Any, Dict, List, Optional
+
+import ecdsa
+
+from flatcoin.block import Block, BlockHeader, BlockSummary
+from flatcoin.chain import Chain
+from flatcoin.coinstate import CoinState
+from flatcoin.consensus import target_threshold
+from flatcoin.database import BlockStore
+from flatcoin.genesis import create_genesis_block
+from flatcoin.mining import NONCE_SPACE, search_nonces
+from flatcoin.params import BLOCK_REWARD
+from flatcoin.wallet import create_coinbase_transaction
+
+
+# Builds a chain of base blocks, then for every depth d mines d blocks on
+# the tip and a competing branch of d + 1 blocks from the same parent. The
+# branch's last block makes it the heavier one, and the time to add that
+# block is the reorganization: d blocks disconnected with their undo data
+# and d + 1 connected. Replaying the whole chain from genesis is timed
+# alongside, as the cost a reorganization would have without undo data.
+
+# low enough that a block takes a few hundred hashes
+BENCHMARK_TARGET = 0xffffff
+
+
+def new_public_key() -> bytes:
+    return ecdsa.SigningKey.generate(curve=ecdsa.SECP256k1).verifying_key.to_string()  # type: ignore
+
+
+def mine_block(previous_hash: bytes, height: int, public_key: bytes, target: int = BENCHMARK_TARGET) -> Block:
+    coinbase_transaction = create_coinbase_transaction(public_key, BLOCK_REWARD, height)
+    summary = BlockSummary(
+        timestamp=int(time()),
+        height=height,
+        block_hash=b"\x00" * 32,
+        nonce=0,
+        target=target,
+        previous_block_hash=previous_hash,
+        merkle_root_hash=b"\x00" * 32,
+    )
+    block = Block(BlockHeader(summary), [coinbase_transaction])
+    summary.merkle_root_hash = block.merkle_root()
+
+    (nonce, _) = search_nonces(block.header.serialize(), summary.nonce_offset(), target_threshold(target), 0, NONCE_SPACE)
+    if nonce is None:
+        raise ValueError("Nonce space exhausted")
+    summary.nonce = nonce
+    block.invalidate()
+    return block
+
+
+def mine_branch(previous_hash: bytes, height: int, count: int, public_key: bytes) -> List[Block]:
+    blocks = []
+    for offset in range(count):
+        block = mine_block(previous_hash, height + offset, public_key)
+        blocks.append(block)
+        previous_hash = block.hash()
+    return blocks
+
+
+def replay_seconds(chain: Chain) -> float:
+    started = perf_counter()
+    coinstate = CoinState.empty()
+    for height in range(chain.height):
+        coinstate = coinstate.apply_block(chain.disk.get_by_height(height))  # type: ignore
+    return perf_counter() - started
+
+
+def run_reorg_benchmark(base: int = 200, depths: Optional[List[int]] = None) -> List[Dict[str, Any]]:
+    with tempfile.TemporaryDirectory() as directory:
+        genesis = create_genesis_block(BLOCK_REWARD, new_public_key(), BENCHMARK_TARGET)
+        chain = Chain.with_genesis(
+            disk=BlockStore(":memory:"),
+            genesis=genesis,
+            checkpoint_path=os.path.join(directory, "coinstate.dat"),
+        )
+
+        # separate keys per branch, so the two sides' coinbases differ
+        (main_key, branch_key) = (new_public_key(), new_public_key())
+        for block in mine_branch(chain.tip_hash, chain.height, base, main_key):  # type: ignore
+            chain.add_block_with_validation(block)
+
+        results = []
+        for depth in depths if depths is not None else [1, 2, 4, 8, 16, 32, 64]:
+            (fork_hash, fork_height) = (chain.tip_hash, chain.height)
+            for block in mine_branch(fork_hash, fork_height, depth, main_key):  # type: ignore
+                chain.add_block_with_validation(block)
+
+            branch = mine_branch(fork_hash, fork_height, depth + 1, branch_key)  # type: ignore
+            for block in branch[:-1]:
+                chain.add_block_with_validation(block)
+            if chain.tip_hash == branch[-2].hash():
+                raise AssertionError("A branch with equal work replaced the tip")
+
+            started = perf_counter()
+            chain.add_block_with_validation(branch[-1])
+            seconds = perf_counter() - started
+            if chain.tip_hash != branch[-1].hash():
+                raise AssertionError("The heavier branch did not become the tip")
+
+            results.append({
+                "depth": depth,
+                "height": chain.height - 1,
+                "reorg_ms": seconds * 1000,
+                "per_block_ms": seconds * 1000 / (2 * depth + 1),
+                "replay_ms": replay_seconds(chain) * 1000,
+            })
+
+        chain.disk.close()
+        return results
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="flatcoin-bench-reorg", description="Measure reorganization latency against depth")
+    parser.add_argument("--base", type=int, default=200, help="blocks mined before the first fork")
+    parser.add_argument("--depth", type=lambda value: [int(x) for x in value.split(",")], default=None,
+                        help="comma separated reorganization depths")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    results = run_reorg_benchmark(args.base, args.depth)
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+
+    print(f"{'depth':>6} {'height':>7} {'reorg ms':>10} {'ms/block':>9} {'replay ms':>10}")
+    for result in results:
+        print(
+            f"{result['depth']:>6} {result['height']:>7} {result['reorg_ms']:>10.2f} "
+            f"{result['per_block_ms']:>9.3f} {result['replay_ms']:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from flatcoin.block import Block
+from flatcoin.coinstate import CoinState
+from flatcoin.consensus import validate_block, validate_block_signatures
+from flatcoin.database import BlockStore, FlatFileBlockStore
+from flatcoin.signatures import SignatureVerifier
+
+from flatcoin.benchmarks.chaingen import DEFAULT_USERS, SyntheticChain, generate_chain
+
+
+# The baseline every performance change is judged against. A chain is
+# generated from a seed (see chaingen), then each benchmark runs over all
+# of its blocks a few times and keeps the fastest run, the one least
+# disturbed by the rest of the machine:
+#
+#   python -m flatcoin.benchmarks.suite run --output before.json
+#   ... change something ...
+#   python -m flatcoin.benchmarks.suite run --output after.json
+#   python -m flatcoin.benchmarks.suite compare before.json after.json
+#
+# compare exits with status 1 when a benchmark got slower by more than the
+# threshold. Results record the chain's tip hash: two files with different
+# tips were not timed on the same work, and compare says so.
+
+DEFAULT_BLOCKS = 50
+DEFAULT_TRANSACTIONS = 50
+DEFAULT_REPEAT = 5
+
+# a benchmark this much slower than its baseline is a regression
+DEFAULT_THRESHOLD = 0.10
+
+# wallet queries are fast; each timed run makes this many rounds of them
+WALLET_ROUNDS = 20
+
+RESULTS_FORMAT = 1
+
+
+class Benchmark:
+
+    # setup() builds fresh inputs outside the timing, so caches filled by
+    # one run do not speed up the next; run(inputs) is what gets timed
+
+    def __init__(
+        self,
+        name: str,
+        operations: int,
+        run: Callable[[Any], Any],
+        setup: Callable[[], Any] = lambda: None,
+        teardown: Callable[[Any], None] = lambda inputs: None,
+    ):
+        self.name = name
+        self.operations = operations
+        self.run = run
+        self.setup = setup
+        self.teardown = teardown
+
+    def measure(self, repeat: int) -> float:
+        best = float("inf")
+        for _ in range(repeat):
+            inputs = self.setup()
+            try:
+                started = perf_counter()
+                self.run(inputs)
+                best = min(best, perf_counter() - started)
+            finally:
+                self.teardown(inputs)
+        return best
+
+
+def decoded(raw_blocks: List[bytes]) -> List[Block]:
+    return [Block.deserialize(raw) for raw in raw_blocks]
+
+
+def uncached(raw_blocks: List[bytes]) -> List[Block]:
+    # decoded blocks keep the bytes they came from; serializing them again
+    # would only copy those
+    blocks = decoded(raw_blocks)
+    for block in blocks:
+        block.invalidate()
+        for transaction in block.transactions:
+            transaction.invalidate()
+    return blocks
+
+
+def serialize_all(blocks: List[Block]) -> None:
+    for block in blocks:
+        block.serialize()
+
+
+def deserialize_all(raw_blocks: List[bytes]) -> None:
+    for raw in raw_blocks:
+        Block.deserialize(raw)
+
+
+def apply_all(blocks: List[Block]) -> None:
+    coinstate = CoinState.empty()
+    for block in blocks:
+        coinstate = coinstate.apply_block(block)
+
+
+def validate_all(blocks: List[Block], timestamp: int) -> None:
+    for block in blocks:
+        if not validate_block(block, timestamp):
+            raise AssertionError(f"Generated block {block.header.summary.height} failed validation")
+
+
+def verify_all(blocks: List[Block], states: List[CoinState]) -> None:
+    # a new verifier every run, its cache would remember the signatures
+    verifier = SignatureVerifier(workers=1)
+    for (block, coinstate) in zip(blocks, states):
+        if not validate_block_signatures(block, coinstate.unspent_transaction_outs, verifier):
+            raise AssertionError(f"Generated block {block.header.summary.height} has an invalid signature")
+
+
+def insert_all(disk: BlockStore, blocks: List[Tuple[bytes, int, bytes]]) -> None:
+    for (hash, height, block_bytes) in blocks:
+        disk.insert(hash, height, block_bytes)
+
+
+def chain_benchmarks(chain: SyntheticChain, directory: str) -> List[Benchmark]:
+    blocks = chain.blocks
+    raw_blocks = [bytes(block.serialize()) for block in blocks]
+    rows = [(block.hash(), block.header.summary.height, raw) for (block, raw) in zip(blocks, raw_blocks)]
+    hashes = [hash for (hash, _, _) in rows]
+    timestamp = blocks[-1].header.summary.timestamp
+
+    # the UTXO set each block is applied to
+    states = [CoinState.empty()]
+    for block in blocks[:-1]:
+        states.append(states[-1].apply_block(block))
+
+    def new_store() -> BlockStore:
+        return BlockStore(":memory:")
+
+    def new_flat_file_store() -> BlockStore:
+        path = tempfile.mkdtemp(dir=directory)
+        return FlatFileBlockStore(os.path.join(path, "index.sqlite"), os.path.join(path, "blocks"))
+
+    def filled(new: Callable[[], BlockStore]) -> Callable[[], BlockStore]:
+        def setup() -> BlockStore:
+            disk = new()
+            disk.insert_many(rows)
+            return disk
+        return setup
+
+    def close(disk: BlockStore) -> None:
+        disk.close()
+
+    def get_all(disk: BlockStore) -> None:
+        for hash in hashes:
+            disk.get(hash)
+
+    def get_all_by_height(disk: BlockStore) -> None:
+        for height in range(len(blocks)):
+            disk.get_by_height(height)
+
+    def balances(_: Any) -> None:
+        for _ in range(WALLET_ROUNDS):
+            for wallet in chain.wallets:
+                wallet.get_balance(chain.coinstate)
+
+    def unspent_outputs(_: Any) -> None:
+        for _ in range(WALLET_ROUNDS):
+            for wallet in chain.wallets:
+                wallet.get_unspent_outputs(chain.coinstate)
+
+    count = len(blocks)
+    queries = WALLET_ROUNDS * len(chain.wallets)
+    return [
+        Benchmark("block_serialize", count, serialize_all, lambda: uncached(raw_blocks)),
+        Benchmark("block_deserialize", count, lambda _: deserialize_all(raw_blocks)),
+        Benchmark("coinstate_apply_block", count, apply_all, lambda: decoded(raw_blocks)),
+        Benchmark("validate_block", count, lambda copies: validate_all(copies, timestamp), lambda: decoded(raw_blocks)),
+        Benchmark("validate_block_signatures", count, lambda copies: verify_all(copies, states), lambda: decoded(raw_blocks)),
+        Benchmark("blockstore_insert", count, lambda disk: insert_all(disk, rows), new_store, close),
+        Benchmark("blockstore_get", count, get_all, filled(new_store), close),
+        Benchmark("blockstore_get_by_height", count, get_all_by_height, filled(new_store), close),
+        Benchmark("flatfile_insert", count, lambda disk: insert_all(disk, rows), new_flat_file_store, close),
+        Benchmark("flatfile_get", count, get_all, filled(new_flat_file_store), close),
+        Benchmark("flatfile_get_by_height", count, get_all_by_height, filled(new_flat_file_store), close),
+        Benchmark("wallet_balance", queries, balances),
+        Benchmark("wallet_unspent_outputs", queries, unspent_outputs),
+    ]
+
+
+def run_suite(
+    blocks: int = DEFAULT_BLOCKS,
+    transactions: int = DEFAULT_TRANSACTIONS,
+    seed: int = 0,
+    users: int = DEFAULT_USERS,
+    repeat: int = DEFAULT_REPEAT,
+    only: Optional[List[str]] = None,
+) -> Dict[str, Any]:
+    started = perf_counter()
+    chain = generate_chain(blocks, transactions, seed, users)
+    generation_seconds = perf_counter() - started
+
+    results: Dict[str, Dict[str, Any]] = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for benchmark in chain_benchmarks(chain, directory):
+            if only is not None and benchmark.name not in only:
+                continue
+            seconds = benchmark.measure(repeat)
+            results[benchmark.name] = {
+                "seconds": seconds,
+                "operations": benchmark.operations,
+                "per_operation_us": seconds * 1_000_000 / benchmark.operations,
+            }
+
+    return {
+        "format": RESULTS_FORMAT,
+        "chain": {
+            "seed": seed,
+            "blocks": blocks,
+            "transactions_per_block": transactions,
+            "users": users,
+            "transactions": chain.transaction_count,
+            "inputs": chain.input_count,
+            "outputs": chain.output_count,
+            "bytes": chain.size,
+            "tip": chain.tip_hash().hex(),
+            "generation_seconds": generation_seconds,
+        },
+        "environment": {
+            "python": sys.version.split()[0],
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "processor": platform.machine(),
+        },
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def compare_results(
+    baseline: Dict[str, Any],
+    current: Dict[str, Any],
+    threshold: float = DEFAULT_THRESHOLD,
+) -> List[Dict[str, Any]]:
+    # per operation times, so runs over chains of different lengths can
+    # still be set side by side; status is "regression", "improvement",
+    # "unchanged", or "missing" for a benchmark only in the baseline
+    comparisons = []
+    for (name, before) in baseline["results"].items():
+        after = current["results"].get(name)
+        if after is None:
+            comparisons.append({"name": name, "status": "missing", "baseline_us": before["per_operation_us"]})
+            continue
+
+        change = after["per_operation_us"] / before["per_operation_us"] - 1
+        if change > threshold:
+            status = "regression"
+        elif change < -threshold:
+            status = "improvement"
+        else:
+            status = "unchanged"
+        comparisons.append({
+            "name": name,
+            "status": status,
+            "baseline_us": before["per_operation_us"],
+            "current_us": after["per_operation_us"],
+            "change": change,
+        })
+    return comparisons
+
+
+def load_results(path: str) -> Dict[str, Any]:
+    with open(path) as f:
+        results = json.load(f)
+    if results.get("format") != RESULTS_FORMAT:
+        raise ValueError(f"{path} is not a benchmark results file of format {RESULTS_FORMAT}")
+    return results
+
+
+def run_command(args: argparse.Namespace) -> int:
+    results = run_suite(args.blocks, args.transactions, args.seed, args.users, args.repeat, args.only)
+
+    if args.output is not None:
+        temporary_path = f"{args.output}.new"
+        with open(temporary_path, "w") as f:
+            json.dump(results, f, indent=4)
+        os.replace(temporary_path, args.output)
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return 0
+
+    chain = results["chain"]
+    print(
+        f"{chain['blocks']} blocks, {chain['transactions']} transactions, {chain['inputs']} inputs, "
+        f"{chain['outputs']} outputs, {chain['bytes']} bytes, tip {chain['tip'][:16]}"
+    )
+    print(f"{'benchmark':<28} {'ops':>7} {'total ms':>10} {'us/op':>11}")
+    for (name, result) in results["results"].items():
+        print(
+            f"{name:<28} {result['operations']:>7} {result['seconds'] * 1000:>10.2f} "
+            f"{result['per_operation_us']:>11.2f}"
+        )
+    return 0
+
+
+def compare_command(args: argparse.Namespace) -> int:
+    baseline = load_results(args.baseline)
+    current = load_results(args.current)
+    comparisons = compare_results(baseline, current, args.threshold)
+    regressions = [comparison for comparison in comparisons if comparison["status"] == "regression"]
+
+    if args.json:
+        print(json.dumps(comparisons, indent=4))
+        return 1 if regressions else 0
+
+    if baseline["chain"]["tip"] != current["chain"]["tip"]:
+        print("warning: the results were taken on different chains")
+
+    print(f"{'benchmark':<28} {'baseline us':>12} {'current us':>12} {'change':>8}")
+    for comparison in comparisons:
+        if comparison["status"] == "missing":
+            print(f"{comparison['name']:<28} {comparison['baseline_us']:>12.2f} {'-':>12} {'-':>8}  missing")
+            continue
+        flag = {"regression": "  REGRESSION", "improvement": "  improved"}.get(comparison["status"], "")
+        print(
+            f"{comparison['name']:<28} {comparison['baseline_us']:>12.2f} {comparison['current_us']:>12.2f} "
+            f"{comparison['change'] * 100:>+7.1f}%{flag}"
+        )
+
+    if regressions:
+        print(f"{len(regressions)} regression(s) past {args.threshold * 100:g}%")
+    return 1 if regressions else 0
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="flatcoin-bench", description="Time the hot paths on a generated chain")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run the benchmarks")
+    run.add_argument("--blocks", type=int, default=DEFAULT_BLOCKS, help="blocks in the generated chain")
+    run.add_argument("--transactions", type=int, default=DEFAULT_TRANSACTIONS,
+                     help="transactions per block, besides the coinbase")
+    run.add_argument("--seed", type=int, default=0, help="seed of the generated chain")
+    run.add_argument("--users", type=int, default=DEFAULT_USERS, help="wallets paying each other")
+    run.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="runs per benchmark, the fastest is kept")
+    run.add_argument("--only", type=lambda value: value.split(","), default=None,
+                     help="comma separated benchmarks to run")
+    run.add_argument("--output", default=None, help="write the results to this JSON file")
+    run.add_argument("--json", action="store_true", help="print the results as JSON")
+    run.set_defaults(handler=run_command)
+
+    compare = commands.add_parser("compare", help="compare two results files")
+    compare.add_argument("baseline", help="results to compare against")
+    compare.add_argument("current", help="results to check")
+    compare.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                         help="slowdown counted as a regression, 0.1 for 10%%")
+    compare.add_argument("--json", action="store_true", help="print the comparison as JSON")
+    compare.set_defaults(handler=compare_command)
+
+    args = parser.parse_args(argv)
+    sys.exit(args.handler(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,30 @@
 import struct
-from typing import BinaryIO, List, Optional
+from typing import BinaryIO, Iterator, List, Optional, Tuple, Union
 
 from flatcoin.hash import sha256d
-from flatcoin.serialization import Serializable, safe_read, stream_deserialize_list, stream_deserialize_vlq, stream_serialize_list, stream_serialize_vlq
-from flatcoin.transaction import Transaction
+from flatcoin.merkle import MerkleProof, MerkleTree, merkle_root
+from flatcoin.serialization import (
+    UINT32,
+    Serializable,
+    check_available,
+    decode_list_from,
+    pack_vlq_into,
+    safe_read,
+    serialize_list_into,
+    serialized_list_size,
+    stream_deserialize_list,
+    stream_deserialize_vlq,
+    stream_serialize_list,
+    stream_serialize_vlq,
+    unpack_vlq_from,
+    vlq_size,
+    write_fixed_into,
+)
+from flatcoin.transaction import Transaction, skip_transaction
 
 
 class BlockSummary(Serializable):
     
-    # TODO: add target and merkle_root_hash
-    
     def __init__(
         self,
         timestamp: int,
@@ -18,6 +33,7 @@ class BlockSummary(Serializable):
         nonce: int,
         target: int,
         previous_block_hash: bytes,
+        merkle_root_hash: bytes,
     ):
         self.timestamp = timestamp
         self.height = height
@@ -25,9 +41,15 @@ class BlockSummary(Serializable):
         self.nonce = nonce
         self.target = target
         self.previous_block_hash = previous_block_hash
+        self.merkle_root_hash = merkle_root_hash
         
     def hash(self) -> bytes:
         return sha256d(self.serialize())
+    
+    def nonce_offset(self) -> int:
+        # where the 4 nonce bytes start in the serialized summary (and header),
+        # for miners that patch them in place
+        return 4 + vlq_size(self.height) + 32
         
     def stream_serialize(self, f: BinaryIO) -> None:
         f.write(struct.pack(b">I", self.timestamp))
@@ -36,6 +58,7 @@ class BlockSummary(Serializable):
         f.write(struct.pack(b">I", self.nonce))
         f.write(struct.pack(b">I", self.target))
         f.write(self.previous_block_hash)
+        f.write(self.merkle_root_hash)
         
     @classmethod
     def stream_deserialize(cls, f: BinaryIO) -> "BlockSummary":
@@ -45,7 +68,35 @@ class BlockSummary(Serializable):
         (nonce,) = struct.unpack(b">I", safe_read(f, 4))
         (target,) = struct.unpack(b">I", safe_read(f, 4))
         previous_block_hash = safe_read(f, 32)
-        return cls(timestamp, height, block_hash, nonce, target, previous_block_hash) 
+        merkle_root_hash = safe_read(f, 32)
+        return cls(timestamp, height, block_hash, nonce, target, previous_block_hash, merkle_root_hash)
+    
+    def serialized_size(self) -> int:
+        return 108 + vlq_size(self.height)
+    
+    def serialize_into(self, buf: bytearray, offset: int) -> int:
+        UINT32.pack_into(buf, offset, self.timestamp)
+        offset = pack_vlq_into(buf, offset + 4, self.height)
+        offset = write_fixed_into(buf, offset, self.block_hash, 32)
+        UINT32.pack_into(buf, offset, self.nonce)
+        UINT32.pack_into(buf, offset + 4, self.target)
+        offset = write_fixed_into(buf, offset + 8, self.previous_block_hash, 32)
+        return write_fixed_into(buf, offset, self.merkle_root_hash, 32)
+    
+    @classmethod
+    def decode_from(cls, view: memoryview, offset: int) -> Tuple["BlockSummary", int]:
+        check_available(view, offset, 4)
+        (timestamp,) = UINT32.unpack_from(view, offset)
+        (height, offset) = unpack_vlq_from(view, offset + 4)
+        
+        check_available(view, offset, 104)
+        block_hash = bytes(view[offset:offset + 32])
+        (nonce,) = UINT32.unpack_from(view, offset + 32)
+        (target,) = UINT32.unpack_from(view, offset + 36)
+        previous_block_hash = bytes(view[offset + 40:offset + 72])
+        merkle_root_hash = bytes(view[offset + 72:offset + 104])
+        summary = cls(timestamp, height, block_hash, nonce, target, previous_block_hash, merkle_root_hash)
+        return (summary, offset + 104)
     
     
 class BlockHeader(Serializable):
@@ -66,8 +117,28 @@ class BlockHeader(Serializable):
     @classmethod
     def stream_deserialize(cls, f: BinaryIO) -> "BlockHeader":
         summary = BlockSummary.stream_deserialize(f)
+        (version,) = struct.unpack(b"B", safe_read(f, 1))
         
-        return cls(summary)
+        header = cls(summary)
+        header.version = version
+        return header
+    
+    def serialized_size(self) -> int:
+        return self.summary.serialized_size() + 1
+    
+    def serialize_into(self, buf: bytearray, offset: int) -> int:
+        offset = self.summary.serialize_into(buf, offset)
+        buf[offset] = self.version
+        return offset + 1
+    
+    @classmethod
+    def decode_from(cls, view: memoryview, offset: int) -> Tuple["BlockHeader", int]:
+        (summary, offset) = BlockSummary.decode_from(view, offset)
+        check_available(view, offset, 1)
+        
+        header = cls(summary)
+        header.version = view[offset]
+        return (header, offset + 1)
         
         
 class Block(Serializable):
@@ -76,9 +147,41 @@ class Block(Serializable):
         self.header = header
         self.transactions = transactions
         self.cached_hash = hash
+        # the encoded block, either the bytes it was decoded from or the
+        # first serialize(); see invalidate()
+        self.cached_bytes: Optional[Union[bytes, memoryview]] = None
+        # built on first use; whoever edits transactions updates or drops it
+        self.cached_merkle_tree: Optional[MerkleTree] = None
+        
+    def invalidate(self) -> None:
+        # must be called after editing the header or the transaction list in
+        # place; the merkle tree is left to the caller, who may have kept it
+        # up to date
+        self.cached_hash = None
+        self.cached_bytes = None
+        
+    def __getstate__(self) -> dict:
+        # see Transaction.__getstate__
+        state = self.__dict__.copy()
+        if isinstance(self.cached_bytes, memoryview):
+            state["cached_bytes"] = None
+        return state
         
     def hash(self) -> bytes:
-        return self.cached_hash or self.header.hash()
+        if self.cached_hash is None:
+            self.cached_hash = self.header.hash()
+        return self.cached_hash
+    
+    def merkle_tree(self) -> MerkleTree:
+        if self.cached_merkle_tree is None:
+            self.cached_merkle_tree = MerkleTree([transaction.hash() for transaction in self.transactions])
+        return self.cached_merkle_tree
+    
+    def merkle_root(self) -> bytes:
+        return self.merkle_tree().root
+    
+    def merkle_proof(self, tx_hash: bytes) -> Optional[MerkleProof]:
+        return self.merkle_tree().merkle_proof(tx_hash)
     
     def stream_serialize(self, f: BinaryIO) -> None:
         self.header.stream_serialize(f)
@@ -92,4 +195,106 @@ class Block(Serializable):
         f.seek(start_position)
         hash = sha256d(f.read(end_position - start_position))
         transactions = stream_deserialize_list(f, Transaction)
-        return cls(header, transactions, hash)
\ No newline at end of file
+        return cls(header, transactions, hash)
+    
+    def serialize(self) -> bytes:
+        if self.cached_bytes is None:
+            self.cached_bytes = super().serialize()
+        return bytes(self.cached_bytes)
+    
+    def serialized_size(self) -> int:
+        if self.cached_bytes is not None:
+            return len(self.cached_bytes)
+        return self.header.serialized_size() + serialized_list_size(self.transactions)
+    
+    def serialize_into(self, buf: bytearray, offset: int) -> int:
+        if self.cached_bytes is not None:
+            end = offset + len(self.cached_bytes)
+            buf[offset:end] = self.cached_bytes
+            return end
+        
+        offset = self.header.serialize_into(buf, offset)
+        return serialize_list_into(buf, offset, self.transactions)
+    
+    @classmethod
+    def decode_from(cls, view: memoryview, offset: int) -> Tuple["Block", int]:
+        start = offset
+        (header, offset) = BlockHeader.decode_from(view, offset)
+        hash = sha256d(view[start:offset])
+        (transactions, offset) = decode_list_from(view, offset, Transaction)
+        
+        block = cls(header, transactions, hash)
+        block.cached_bytes = view[start:offset]
+        return (block, offset)
+
+
+class BlockView:
+
+    # Read-only view over a serialized block, typically a memoryview into a
+    # mapped block file. Only the header is decoded up front; transactions are
+    # located by walking their length prefixes and decoded one at a time when
+    # asked for. Transaction hashes are taken over the raw slices.
+
+    def __init__(self, data: Union[bytes, bytearray, memoryview]):
+        self.view = memoryview(data)
+        (self.header, self.header_end) = BlockHeader.decode_from(self.view, 0)
+        self.cached_hash = sha256d(self.view[:self.header_end])
+        (self.transaction_count, self.transactions_start) = unpack_vlq_from(self.view, self.header_end)
+        # start offset of every transaction plus the end of the last one,
+        # filled in as far as anything has been read
+        self.offsets: List[int] = [self.transactions_start]
+
+    def hash(self) -> bytes:
+        return self.cached_hash
+
+    def __len__(self) -> int:
+        return self.transaction_count
+
+    def _offset_table(self, index: int) -> None:
+        if not 0 <= index < self.transaction_count:
+            raise IndexError(f"Block has {self.transaction_count} transactions, no index {index}")
+
+        offsets = self.offsets
+        while len(offsets) <= index + 1:
+            offsets.append(skip_transaction(self.view, offsets[-1]))
+
+    def transaction_bytes(self, index: int) -> memoryview:
+        self._offset_table(index)
+        return self.view[self.offsets[index]:self.offsets[index + 1]]
+
+    def transaction_hash(self, index: int) -> bytes:
+        return sha256d(self.transaction_bytes(index))
+
+    def transaction(self, index: int, transaction_hash: Optional[bytes] = None) -> Transaction:
+        self._offset_table(index)
+        (transaction, _) = Transaction.decode_from(self.view, self.offsets[index], transaction_hash)
+        return transaction
+
+    def transaction_hashes(self) -> Iterator[bytes]:
+        for index in range(self.transaction_count):
+            yield self.transaction_hash(index)
+
+    def transactions(self, hashes: Optional[List[bytes]] = None) -> Iterator[Transaction]:
+        for index in range(self.transaction_count):
+            yield self.transaction(index, hashes[index] if hashes is not None else None)
+
+    def find_transaction(self, transaction_hash: bytes) -> Optional[Transaction]:
+        for index in range(self.transaction_count):
+            if self.transaction_hash(index) == transaction_hash:
+                return self.transaction(index)
+        return None
+
+    def merkle_root(self) -> bytes:
+        return merkle_root(list(self.transaction_hashes()))
+
+    def size(self) -> int:
+        if self.transaction_count:
+            self._offset_table(self.transaction_count - 1)
+        return self.offsets[-1]
+
+    def to_block(self, transaction_hashes: Optional[List[bytes]] = None) -> Block:
+        # transaction_hashes, if given, must be the hashes of this block's
+        # transactions, in order
+        block = Block(self.header, list(self.transactions(transaction_hashes)), self.cached_hash)
+        block.cached_bytes = self.view[:self.size()]
+        return block
@@ -0,0 +1,109 @@
+import mmap
+import os
+import re
+from typing import BinaryIO, Dict, Optional, Tuple
+
+
+BLOCK_FILE_PATTERN = re.compile(r"^blk(\d{5})\.dat$")
+
+DEFAULT_MAX_BLOCK_FILE_SIZE = 128 * 1024 * 1024
+
+# pruning frees space a whole segment at a time, so a pruned node writes
+# smaller ones
+PRUNED_MAX_BLOCK_FILE_SIZE = 16 * 1024 * 1024
+
+
+def block_file_name(file_number: int) -> str:
+    return "blk%05d.dat" % file_number
+
+
+# Serialized blocks are appended back to back into blkNNNNN.dat segments and
+# addressed by (file number, offset, length). Reads hand out memoryviews into
+# a per-segment mmap, so nothing is copied until the caller decodes.
+class BlockFiles:
+
+    def __init__(self, directory: str, max_file_size: int = DEFAULT_MAX_BLOCK_FILE_SIZE):
+        self.directory = directory
+        self.max_file_size = max_file_size
+
+        os.makedirs(directory, exist_ok=True)
+
+        existing = [
+            int(match.group(1))
+            for match in map(BLOCK_FILE_PATTERN.match, os.listdir(directory))
+            if match is not None
+        ]
+
+        self.current_file: int = max(existing, default=0)
+        self.handle: BinaryIO = open(self.path(self.current_file), "ab")
+        self.current_size: int = self.handle.tell()
+
+        self.maps: Dict[int, mmap.mmap] = {}
+
+    def path(self, file_number: int) -> str:
+        return os.path.join(self.directory, block_file_name(file_number))
+
+    def append(self, data: bytes) -> Tuple[int, int]:
+        if self.current_size > 0 and self.current_size + len(data) > self.max_file_size:
+            self._rotate()
+
+        offset = self.current_size
+        self.handle.write(data)
+        self.current_size += len(data)
+
+        return (self.current_file, offset)
+
+    def _rotate(self) -> None:
+        self.sync()
+        self.handle.close()
+
+        self.current_file += 1
+        self.handle = open(self.path(self.current_file), "ab")
+        self.current_size = 0
+
+    def sync(self) -> None:
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+
+    def read(self, file_number: int, offset: int, length: int) -> memoryview:
+        mapped = self._map(file_number, offset + length)
+        return memoryview(mapped)[offset:offset + length]
+
+    def _map(self, file_number: int, needed: int) -> mmap.mmap:
+        mapped: Optional[mmap.mmap] = self.maps.get(file_number)
+
+        if mapped is None or len(mapped) < needed:
+            if file_number == self.current_file:
+                self.handle.flush()
+
+            # an older, shorter map may still be exported through memoryviews
+            # handed out earlier, so it is dropped rather than closed and goes
+            # away with the last view
+            with open(self.path(file_number), "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            if len(mapped) < needed:
+                raise ValueError(f"Block file {block_file_name(file_number)} is truncated")
+
+            self.maps[file_number] = mapped
+
+        return mapped
+
+    def file_numbers(self) -> range:
+        return range(0, self.current_file + 1)
+
+    def remove(self, file_number: int) -> None:
+        # for pruning; the segment being appended to is never removed, and
+        # views still pointing into a removed one stay readable until dropped
+        if file_number == self.current_file:
+            return
+        self.maps.pop(file_number, None)
+        try:
+            os.remove(self.path(file_number))
+        except FileNotFoundError:
+            pass
+
+    def close(self) -> None:
+        self.sync()
+        self.handle.close()
+        self.maps.clear()
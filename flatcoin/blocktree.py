@@ -0,0 +1,63 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+from flatcoin.block import Block
+
+
+# blocks whose parent has not arrived yet; past this many the oldest goes
+MAX_ORPHAN_BLOCKS = 100
+
+
+class OrphanPool:
+
+    # Blocks that passed the stateless checks but cannot be placed in the
+    # block tree yet, kept in arrival order so the oldest is evicted first
+    # and indexed by parent hash so they are found as soon as it connects.
+
+    def __init__(self, max_blocks: int = MAX_ORPHAN_BLOCKS):
+        self.max_blocks = max_blocks
+        self.blocks: "OrderedDict[bytes, Block]" = OrderedDict()
+        self.by_parent: Dict[bytes, Set[bytes]] = {}
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    def __contains__(self, hash: bytes) -> bool:
+        return hash in self.blocks
+
+    def add(self, block: Block) -> None:
+        hash = block.hash()
+        if hash in self.blocks:
+            return
+
+        self.blocks[hash] = block
+        self.by_parent.setdefault(block.header.summary.previous_block_hash, set()).add(hash)
+
+        while len(self.blocks) > self.max_blocks:
+            self.remove(next(iter(self.blocks)))
+
+    def remove(self, hash: bytes) -> Optional[Block]:
+        block = self.blocks.pop(hash, None)
+        if block is None:
+            return None
+
+        parent = block.header.summary.previous_block_hash
+        siblings = self.by_parent.get(parent)
+        if siblings is not None:
+            siblings.discard(hash)
+            if not siblings:
+                del self.by_parent[parent]
+        return block
+
+    def pop_children(self, parent: bytes) -> List[Block]:
+        children = [self.blocks[hash] for hash in self.by_parent.get(parent, ())]
+        for child in children:
+            self.remove(child.hash())
+        return children
+
+    def root(self, hash: bytes) -> bytes:
+        # the missing block an orphan is waiting on, following its chain of
+        # orphan parents down; this is what to ask peers for
+        while hash in self.blocks:
+            hash = self.blocks[hash].header.summary.previous_block_hash
+        return hash
@@ -1,16 +1,32 @@
-from time import time
-from typing import Optional
+import threading
+from time import perf_counter, time
+from typing import Callable, List, Optional, Tuple
+from flatcoin import metrics
 from flatcoin.block import Block
-from flatcoin.coinstate import CoinState
-from flatcoin.consensus import validate_block
-from flatcoin.database import BlockStore, DefaultBlockStore
-from flatcoin.genesis import create_genesis_block
-from flatcoin.utils import open_or_init_wallet, save_block_to_file
-from flatcoin.wallet import create_coinbase_transaction
+from flatcoin.blocktree import OrphanPool
+from flatcoin.coinstate import BlockUndo, CoinState, CoinStateCheckpoint
+from flatcoin.consensus import validate_block, validate_block_signatures, validate_proof_of_work
+from flatcoin.database import CHAIN_DIRECTORY, BlockStore, DefaultBlockStore
+from flatcoin.genesis import network_genesis_block
+from flatcoin.headerindex import HAVE_DATA, HeaderIndex
+from flatcoin.mempool import Mempool, MempoolEntry
+from flatcoin.pruning import Pruner
+from flatcoin.reading import human
+from flatcoin.signatures import SignatureVerifier
+from flatcoin.transaction import Transaction
+from flatcoin.validator import InvalidBlockError
 
 
-CHAIN_CACHE_DIRECTORY = "chain-state"
-CHAIN_BLOCKS_DIRECTORY = f"{CHAIN_CACHE_DIRECTORY}/blocks"
+COINSTATE_CHECKPOINT_FILE = f"{CHAIN_DIRECTORY}/coinstate.dat"
+
+# how many blocks may be connected before the UTXO set is written out again;
+# this bounds the number of blocks replayed by Chain.load
+COINSTATE_CHECKPOINT_INTERVAL = 500
+
+blocks_connected = metrics.counter("flatcoin_blocks_connected_total", "Blocks connected to the main chain")
+transactions_connected = metrics.counter("flatcoin_transactions_connected_total", "Transactions in blocks connected to the main chain")
+blocks_disconnected = metrics.counter("flatcoin_blocks_disconnected_total", "Blocks disconnected by reorganizations")
+reorganizations = metrics.counter("flatcoin_reorganizations_total", "Switches of the main chain to another branch")
 
 
 class Chain:
@@ -21,49 +37,409 @@ class Chain:
         coinstate: CoinState,
         genesis: Optional[Block],
         height: int,
+        tip_hash: Optional[bytes] = None,
+        checkpoint_height: int = -1,
+        verifier: Optional[SignatureVerifier] = None,
+        mempool: Optional[Mempool] = None,
+        headers: Optional[HeaderIndex] = None,
+        checkpoint_path: str = COINSTATE_CHECKPOINT_FILE,
+        pruner: Optional[Pruner] = None,
     ):
         self.disk = disk
         self.coinstate = coinstate
         self.genesis = genesis
         self.height = height
+        self.tip_hash = tip_hash
+        self.checkpoint_height = checkpoint_height
+        self.checkpoint_path = checkpoint_path
+        self.verifier = verifier if verifier is not None else SignatureVerifier()
+        # shares the verifier so signatures checked on admission are not
+        # checked again when the transaction arrives in a block
+        self.mempool = mempool if mempool is not None else Mempool(verifier=self.verifier)
+        self.headers = headers if headers is not None else HeaderIndex.from_store(disk)
+        # set to keep only recent blocks; pruning runs with every checkpoint
+        self.pruner = pruner
+        self.orphans = OrphanPool()
+        self.startup_seconds: Optional[float] = None
+        # held by whatever changes the chain, and by readers on other threads
+        # that need the headers, tip and store to agree; blocks connected on
+        # a node's connect thread are read from its event loop
+        self.lock = threading.RLock()
+        # (depth, seconds) of the last reorganization
+        self.last_reorganization: Optional[Tuple[int, float]] = None
+        
+    def register_metrics(self) -> None:
+        # the gauges are global, so only the process's own chain registers
+        # them; they keep a reference to it, and a later call by another
+        # chain takes them over. They are read from whichever thread exports
+        # them, so under the lock
+        def locked(function: Callable[[], int]) -> Callable[[], int]:
+            def read() -> int:
+                with self.lock:
+                    return function()
+            return read
+        
+        metrics.gauge("flatcoin_chain_height", "Height of the main chain tip").set_function(locked(lambda: self.height - 1))
+        metrics.gauge("flatcoin_utxo_count", "Unspent transaction outputs").set_function(
+            locked(lambda: len(self.coinstate.unspent_transaction_outs))
+        )
+        metrics.gauge("flatcoin_mempool_transactions", "Transactions in the mempool").set_function(
+            locked(lambda: len(self.mempool))
+        )
+        metrics.gauge("flatcoin_orphan_blocks", "Blocks waiting for their parent").set_function(
+            locked(lambda: len(self.orphans))
+        )
+        metrics.gauge("flatcoin_blockstore_blocks", "Blocks stored, on any branch").set_function(locked(self.disk.item_count))
+        metrics.gauge("flatcoin_blockstore_bytes", "Bytes of block bodies stored").set_function(locked(self.disk.stored_bytes))
         
     @classmethod
-    def with_genesis(cls) -> "Chain":
-        disk = DefaultBlockStore.instance
-        coinstate = CoinState.empty()
+    def with_genesis(
+        cls,
+        coinstate: Optional[CoinState] = None,
+        disk: Optional[BlockStore] = None,
+        genesis: Optional[Block] = None,
+        checkpoint_path: str = COINSTATE_CHECKPOINT_FILE,
+    ) -> "Chain":
+        # without a genesis the chain is the network's; pass one for a private chain
+        if disk is None:
+            disk = DefaultBlockStore.get()
+        if coinstate is None:
+            coinstate = CoinState.empty()
         
-        wallet = open_or_init_wallet()
-        public_key = next(iter(wallet.keypair))
+        if genesis is None:
+            genesis = network_genesis_block()
         
-        coinbase_transaction = create_coinbase_transaction(
-            miner_public_key=public_key,
-            reward=50_000_000,
-            block_height=0,
-        )
+        if not validate_proof_of_work(genesis.hash(), genesis.header.summary.target):
+            raise ValueError(f"Genesis block {human(genesis.hash())} does not meet its own target")
         
-        genesis = create_genesis_block(coinbase_transaction.outputs[0].value, public_key)
         coinstate = coinstate.apply_block(genesis)
         
-        disk.insert(genesis.hash(), genesis.serialize())
-        save_block_to_file(CHAIN_BLOCKS_DIRECTORY, genesis)
+        disk.insert(genesis.hash(), genesis.header.summary.height, genesis.serialize())
+        
+        headers = HeaderIndex()
+        slot = headers.add(genesis.header, genesis.hash())
+        headers.status[slot] |= HAVE_DATA
+        headers.set_tip(slot)
         
-        return cls(
+        chain = cls(
             disk=disk,
             coinstate=coinstate,
             genesis=genesis,
-            height=1
+            height=1,
+            tip_hash=genesis.hash(),
+            headers=headers,
+            checkpoint_path=checkpoint_path,
+        )
+        chain.save_checkpoint()
+        
+        return chain
+    
+    @classmethod
+    def load(
+        cls,
+        disk: Optional[BlockStore] = None,
+        coinstate: Optional[CoinState] = None,
+        checkpoint_path: str = COINSTATE_CHECKPOINT_FILE,
+    ) -> "Chain":
+        # pass an on-disk CoinState to resume from its last flush instead of
+        # the snapshot at checkpoint_path
+        started = perf_counter()
+        
+        if disk is None:
+            disk = DefaultBlockStore.get()
+        
+        tip = disk.tip()
+        if tip is None:
+            raise ValueError("Blockstore is empty, create the chain with Chain.with_genesis() first")
+        
+        (tip_height, tip_hash) = tip
+        
+        if coinstate is not None and coinstate.is_on_disk:
+            best_block = coinstate.unspent_transaction_outs.best_block() # type: ignore
+            (checkpoint_height, checkpoint_hash) = best_block if best_block is not None else (-1, None)
+            
+            if checkpoint_hash is not None and disk.main_chain_hash(checkpoint_height) != checkpoint_hash:
+                raise ValueError(f"Coin database is at height {checkpoint_height}, which does not match the blockstore")
+        else:
+            checkpoint = CoinStateCheckpoint.load(checkpoint_path)
+            if checkpoint is not None and disk.main_chain_hash(checkpoint.height) != checkpoint.block_hash:
+                print(f"Ignoring UTXO checkpoint at height {checkpoint.height}, it does not match the blockstore")
+                checkpoint = None
+                
+            if checkpoint is not None:
+                coinstate = checkpoint.coinstate
+                checkpoint_height = checkpoint.height
+            else:
+                coinstate = CoinState.empty()
+                checkpoint_height = -1
+            
+        for height in range(checkpoint_height + 1, tip_height + 1):
+            block = disk.get_by_height(height)
+            if block is None and height < disk.prune_height():
+                raise ValueError(f"Block at height {height} was pruned, the chain cannot start without its UTXO checkpoint")
+            if block is None:
+                raise ValueError(f"Block at height {height} is missing from the blockstore")
+            coinstate = coinstate.apply_block(block)
+            
+        chain = cls(
+            disk=disk,
+            coinstate=coinstate,
+            genesis=disk.get_by_height(0),
+            height=tip_height + 1,
+            tip_hash=tip_hash,
+            checkpoint_height=checkpoint_height,
+            headers=HeaderIndex.from_store(disk),
+            checkpoint_path=checkpoint_path,
         )
+        chain.startup_seconds = perf_counter() - started
+        
+        print(
+            f"Loaded chain at height {tip_height} in {chain.startup_seconds:.3f}s "
+            f"(replayed {tip_height - checkpoint_height} blocks since checkpoint)"
+        )
+        
+        return chain
+        
+    @property
+    def target(self) -> int:
+        # the network's proof of work target, set by the genesis block; no
+        # block may ask for less work
+        return self.headers.targets[self.headers.main_chain[0]]
         
     def add_block_with_validation(self, block: Block) -> None:
-        validate_block(block, int(time()))
+        # Blocks form a tree: one extending the tip is connected straight
+        # away, one on another branch is stored and becomes the tip through
+        # reorganize() once its branch has more work, and one whose parent
+        # is unknown waits in the orphan pool. Orphans are retried whenever
+        # the block they wait on arrives.
+        hash = block.hash()
+        with self.lock:
+            slot = self.headers.slot_of(hash)
+            if slot is not None and self.headers.is_invalid(slot):
+                raise InvalidBlockError(f"Block {human(hash)} is known to be invalid")
+            if (slot is not None and self.headers.has_data(slot)) or hash in self.orphans:
+                return
+        
+        with metrics.trace_block(block.header.summary.height, hash, len(block.transactions)):
+            if not validate_block(block, int(time()), self.target):
+                raise InvalidBlockError(f"Block {human(hash)} failed validation")
+            
+            with self.lock:
+                self._accept_block(block)
+        with self.lock:
+            self._connect_orphans(hash)
+        
+    def _accept_block(self, block: Block) -> None:
+        hash = block.hash()
+        summary = block.header.summary
+        
+        if summary.previous_block_hash == self.tip_hash:
+            undo = self.connect_block(block)
+            self.disk.insert(hash, summary.height, block.serialize(), undo.serialize())
+            if self.checkpoint_due():
+                self.save_checkpoint()
+            return
+        
+        parent = self.headers.slot_of(summary.previous_block_hash)
+        if parent is None or not self.headers.has_data(parent):
+            self.orphans.add(block)
+            return
+        
+        try:
+            slot = self.headers.add(block.header, hash)
+        except ValueError as e:
+            raise InvalidBlockError(f"Block {human(hash)} does not follow its parent: {e}") from e
+        if self.headers.is_invalid(slot):
+            raise InvalidBlockError(f"Block {human(hash)} builds on an invalid block")
+        
+        self.disk.insert_many([(hash, summary.height, block.serialize())], on_main_chain=False)
+        self.headers.status[slot] |= HAVE_DATA
+        
+        # the first branch seen keeps the tip until another has more work
+        if self.headers.chainwork[slot] > self.headers.chainwork[self.headers.tip]:
+            self.reorganize(slot)
+            
+    def _connect_orphans(self, hash: bytes) -> None:
+        # invalid orphans are dropped along with everything built on them
+        parents = [hash]
+        while parents:
+            for orphan in self.orphans.pop_children(parents.pop()):
+                try:
+                    self._accept_block(orphan)
+                except InvalidBlockError:
+                    continue
+                parents.append(orphan.hash())
+            
+    def connect_block(self, block: Block, update_mempool: bool = True) -> BlockUndo:
+        # the contextual checks and every in-memory update for a block that
+        # already passed validate_block; storing it and its undo data is left
+        # to the caller, and so is the mempool when update_mempool is False
+        with metrics.trace_block(block.header.summary.height, block.hash(), len(block.transactions)), self.lock:
+            return self._connect_block(block, update_mempool)
+        
+    @metrics.timed("flatcoin_connect_block_seconds", "Time spent connecting blocks to the main chain")
+    def _connect_block(self, block: Block, update_mempool: bool) -> BlockUndo:
+        summary = block.header.summary
+        if summary.height != self.height or summary.previous_block_hash != self.tip_hash:
+            raise InvalidBlockError(f"Block {human(block.hash())} does not extend the current tip")
+        
+        if not validate_block_signatures(block, self.coinstate.unspent_transaction_outs, self.verifier):
+            raise self._invalid(block, "has an invalid or missing signature")
         
         if block.transactions:
-            self.coinstate = self.coinstate.apply_block(block)
+            # a coin spent twice in the block, or one that does not exist,
+            # only shows up here; the UTXO set is left as it was
+            try:
+                (self.coinstate, undo) = self.coinstate.apply_block_with_undo(block)
+            except ValueError as e:
+                raise self._invalid(block, f"cannot be applied: {e}") from e
+        else:
+            undo = BlockUndo([], [])
         
-        self.disk.insert(block.hash(), block.serialize())
-        save_block_to_file(CHAIN_BLOCKS_DIRECTORY, block)
+        if update_mempool:
+            self.mempool.block_connected(block)
+        slot = self.headers.add(block.header, block.hash())
+        self.headers.status[slot] |= HAVE_DATA
+        self.headers.set_tip(slot)
         
         self.height += 1
+        self.tip_hash = block.hash()
+        
+        blocks_connected.inc()
+        transactions_connected.inc(len(block.transactions))
+        return undo
+        
+    def _invalid(self, block: Block, reason: str) -> InvalidBlockError:
+        # the header commits to everything checked here and already passed
+        # validate_block, so it is remembered as invalid and neither the
+        # block nor anything built on it is fetched or connected again
+        self.headers.mark_invalid(self.headers.add(block.header, block.hash()))
+        return InvalidBlockError(f"Block {human(block.hash())} {reason}")
+        
+    def disconnect_tip(self, block: Block, undo: BlockUndo) -> None:
+        # the reverse of connect_block for the block at the tip
+        if block.hash() != self.tip_hash:
+            raise ValueError(f"Block {human(block.hash())} is not the tip")
+        
+        if block.transactions:
+            self.coinstate = self.coinstate.undo_block(block, undo)
+        
+        self.headers.set_tip(self.headers.parents[self.headers.tip])
+        self.height -= 1
+        self.tip_hash = block.header.summary.previous_block_hash
+        blocks_disconnected.inc()
+        
+    def _stored_block_with_undo(self, hash: bytes) -> Tuple[Block, BlockUndo]:
+        block = self.disk.get(hash)
+        undo_bytes = self.disk.get_undo(hash)
+        if block is None or undo_bytes is None:
+            raise ValueError(f"Block {human(hash)} or its undo data is missing from the blockstore")
+        return (block, BlockUndo.deserialize(undo_bytes))
+    
+    @metrics.timed("flatcoin_reorganize_seconds", "Time spent switching the main chain to another branch")
+    def reorganize(self, target: int) -> None:
+        # Makes the stored block at slot target the tip: the blocks above the
+        # fork point are disconnected tip first with their undo data, then
+        # target's branch is connected upwards, so the cost is the depth of
+        # the reorganization whatever the height. If a block on the new
+        # branch fails, it and its descendants are marked invalid and the
+        # old branch is put back.
+        started = perf_counter()
+        headers = self.headers
+        fork = headers.fork_point(headers.tip, target)
+        fork_height = headers.heights[fork]
+        
+        branch: List[int] = []
+        slot = target
+        while slot != fork:
+            if headers.is_invalid(slot):
+                raise InvalidBlockError(f"Block {human(headers.hash_at(slot))} is known to be invalid")
+            branch.append(slot)
+            slot = headers.parents[slot]
+        branch.reverse()
+        
+        # everything is read before the first change, so a block missing or
+        # stored without undo data fails the reorganization cleanly
+        disconnected: List[Tuple[Block, BlockUndo]] = []
+        slot = headers.tip
+        while slot != fork:
+            disconnected.append(self._stored_block_with_undo(headers.hash_at(slot)))
+            slot = headers.parents[slot]
+            
+        blocks: List[Block] = []
+        for slot in branch:
+            block = self.disk.get(headers.hash_at(slot))
+            if block is None:
+                raise ValueError(f"Block {human(headers.hash_at(slot))} is missing from the blockstore")
+            blocks.append(block)
+            
+        for (block, undo) in disconnected:
+            self.disconnect_tip(block, undo)
+            
+        # the mempool is only told once the new branch is in for good, so a
+        # rollback leaves it as it was
+        connected: List[Tuple[Block, BlockUndo]] = []
+        try:
+            for block in blocks:
+                connected.append((block, self.connect_block(block, update_mempool=False)))
+        except Exception:
+            # whatever went wrong, the old branch goes back; a block found
+            # invalid was already marked so by connect_block
+            for (block, undo) in reversed(connected):
+                self.disconnect_tip(block, undo)
+            for (block, _) in reversed(disconnected):
+                self.connect_block(block, update_mempool=False)
+            raise
+        
+        self.disk.set_main_chain(
+            fork_height,
+            [(block.header.summary.height, block.hash()) for (block, _) in connected],
+            [(block.hash(), undo.serialize()) for (block, undo) in connected],
+        )
+        for (block, _) in connected:
+            self.mempool.block_connected(block)
+        self.mempool.reorganized([block for (block, _) in reversed(disconnected)], self.coinstate)
+        
+        # the snapshot on disk may be of a block that just left the main chain
+        if self.checkpoint_height > fork_height or self.checkpoint_due():
+            self.save_checkpoint()
+            
+        self.last_reorganization = (len(disconnected), perf_counter() - started)
+        reorganizations.inc()
+        
+    def checkpoint_due(self) -> bool:
+        return self.height - 1 - self.checkpoint_height >= COINSTATE_CHECKPOINT_INTERVAL
+            
+    def submit_transaction(self, transaction: Transaction) -> MempoolEntry:
+        with self.lock:
+            return self.mempool.add(transaction, self.coinstate)
+        
+    def save_checkpoint(self, path: Optional[str] = None) -> None:
+        if self.tip_hash is None:
+            return
+        
+        if path is None:
+            path = self.checkpoint_path
+        
+        with self.lock:
+            if self.coinstate.is_on_disk:
+                self.coinstate.unspent_transaction_outs.flush() # type: ignore
+            else:
+                CoinStateCheckpoint(self.height - 1, self.tip_hash, self.coinstate).save(path)
+                
+            self.checkpoint_height = self.height - 1
+            self.prune()
+        
+    def prune(self) -> int:
+        # returns how many blocks were dropped
+        if self.pruner is None:
+            return 0
+        
+        height = self.pruner.prune_height(self.disk, self.height - 1, self.checkpoint_height)
+        pruned = self.disk.prune(height)
+        if pruned:
+            self.headers.mark_pruned(height)
+        return pruned
         
     def __repr__(self) -> str:
         return "Chain w/ %s blocks" % self.height
\ No newline at end of file
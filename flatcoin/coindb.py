@@ -0,0 +1,370 @@
+import os
+import sqlite3
+from collections import OrderedDict
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+from flatcoin.transaction import Output, OutputReference
+
+
+# rough resident size of one cached coin: the OutputReference and Output
+# objects, their hash/public key bytes and the OrderedDict slot
+ESTIMATED_COIN_SIZE = 600
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_FLUSH_BLOCKS = 100
+
+INSERT_COIN = "INSERT OR REPLACE INTO coins (reference, value, public_key) VALUES (?, ?, ?)"
+SELECT_COIN = "SELECT value, public_key FROM coins WHERE reference = ?"
+DELETE_COIN = "DELETE FROM coins WHERE reference = ?"
+SELECT_COIN_COUNT = "SELECT COUNT(*) FROM coins"
+SELECT_COINS_BY_PUBLIC_KEY = "SELECT reference, value FROM coins WHERE public_key = ?"
+SELECT_META = "SELECT value FROM meta WHERE key = ?"
+UPDATE_META = "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)"
+
+
+def reference_key(reference: OutputReference) -> bytes:
+    return reference.tx_hash + reference.index.to_bytes(4, "big")
+
+
+def reference_from_key(key: bytes) -> OutputReference:
+    return OutputReference(key[:32], int.from_bytes(key[32:], "big"))
+
+
+class CoinDatabase:
+
+    schema_version = 2
+
+    def __init__(self, path: str):
+        self.is_memory: bool = path == ":memory:"
+        self.is_new: bool = self.is_memory or not os.path.isfile(path)
+
+        # written from Node.sync's connect thread; see BlockStore
+        self.connection: sqlite3.Connection = sqlite3.connect(path, cached_statements=32, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+
+        self._ensure_schema()
+
+    def _ensure_schema(self) -> None:
+        (version,) = self.connection.execute("PRAGMA user_version").fetchone()
+
+        if version == self.schema_version:
+            return
+
+        if version > self.schema_version:
+            raise ValueError(f"Coin database schema version {version} is newer than supported version {self.schema_version}")
+
+        with self.connection:
+            self.connection.execute("""
+
+                CREATE TABLE IF NOT EXISTS coins (
+                    reference BLOB PRIMARY KEY,
+                    value INTEGER NOT NULL,
+                    public_key BLOB NOT NULL
+                ) WITHOUT ROWID
+
+            """)
+            self.connection.execute("""
+
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL
+                )
+
+            """)
+            self.connection.execute("""
+
+                CREATE INDEX IF NOT EXISTS coins_public_key ON coins (public_key)
+
+            """)
+            self.connection.execute(f"PRAGMA user_version = {self.schema_version}")
+
+    def get(self, reference: OutputReference) -> Optional[Output]:
+        row = self.connection.execute(SELECT_COIN, (reference_key(reference),)).fetchone()
+        return Output(row[0], row[1]) if row is not None else None
+
+    def count(self) -> int:
+        (count,) = self.connection.execute(SELECT_COIN_COUNT).fetchone()
+        return count
+
+    def items(self) -> Iterator[Tuple[OutputReference, Output]]:
+        cursor = self.connection.execute("SELECT reference, value, public_key FROM coins")
+        for (key, value, public_key) in cursor:
+            yield (reference_from_key(key), Output(value, public_key))
+
+    def outputs_for(self, public_key: bytes) -> Iterator[Tuple[OutputReference, Output]]:
+        cursor = self.connection.execute(SELECT_COINS_BY_PUBLIC_KEY, (public_key,))
+        for (key, value) in cursor:
+            yield (reference_from_key(key), Output(value, public_key))
+
+    def best_block(self) -> Optional[Tuple[int, bytes]]:
+        height = self.connection.execute(SELECT_META, ("best_height",)).fetchone()
+        block_hash = self.connection.execute(SELECT_META, ("best_hash",)).fetchone()
+        if height is None or block_hash is None:
+            return None
+        return (height[0], block_hash[0])
+
+    def write_batch(self, changes: Dict[OutputReference, Optional[Output]], best_block: Optional[Tuple[int, bytes]]) -> None:
+        # coins and the best block they correspond to are committed together,
+        # so after a crash the database is always consistent with some block
+        with self.connection:
+            self.connection.executemany(DELETE_COIN, (
+                (reference_key(reference),) for (reference, output) in changes.items() if output is None
+            ))
+            self.connection.executemany(INSERT_COIN, (
+                (reference_key(reference), output.value, output.public_key)
+                for (reference, output) in changes.items() if output is not None
+            ))
+            if best_block is not None:
+                (height, block_hash) = best_block
+                self.connection.execute(UPDATE_META, ("best_height", height))
+                self.connection.execute(UPDATE_META, ("best_hash", block_hash))
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class CoinCache:
+
+    # Write-back LRU cache in front of a CoinDatabase. It speaks the same
+    # mapping/mutate() protocol as the immutables.Map normally held by
+    # CoinState, but it is a single shared, mutable view: applying a block
+    # updates it in place rather than producing an independent snapshot.
+    #
+    # Clean entries are evicted least-recently-used first once the cache
+    # grows past cache_bytes. Dirty entries stay until the next flush, which
+    # happens after every flush_blocks connected blocks or as soon as they
+    # alone take up flush_bytes. A spent coin is kept as a None tombstone
+    # until then.
+
+    def __init__(
+        self,
+        database: CoinDatabase,
+        cache_bytes: int = DEFAULT_CACHE_BYTES,
+        flush_blocks: int = DEFAULT_FLUSH_BLOCKS,
+        flush_bytes: Optional[int] = None,
+    ):
+        self.database = database
+        self.cache_bytes = cache_bytes
+        self.flush_blocks = flush_blocks
+        self.flush_bytes = flush_bytes if flush_bytes is not None else cache_bytes // 2
+
+        self.entries: OrderedDict[OutputReference, Optional[Output]] = OrderedDict()
+        self.dirty: Set[OutputReference] = set()
+        # created since the last flush and never written, so spending one
+        # only has to forget it
+        self.fresh: Set[OutputReference] = set()
+        # unflushed coins by public key, so outputs_for only has to overlay
+        # the owner's own changes on top of the indexed query
+        self.dirty_by_public_key: Dict[bytes, Set[OutputReference]] = {}
+
+        self.count = database.count()
+        self.best = database.best_block()
+        self.blocks_since_flush = 0
+        # set while a caller still has connected blocks queued for the block
+        # store, so a flush never records a best block the store lacks
+        self.hold_flushes = False
+
+    @classmethod
+    def open(cls, path: str, cache_bytes: int = DEFAULT_CACHE_BYTES, flush_blocks: int = DEFAULT_FLUSH_BLOCKS) -> "CoinCache":
+        return cls(CoinDatabase(path), cache_bytes=cache_bytes, flush_blocks=flush_blocks)
+
+    def _lookup(self, reference: OutputReference) -> Optional[Output]:
+        if reference in self.entries:
+            self.entries.move_to_end(reference)
+            return self.entries[reference]
+
+        output = self.database.get(reference)
+        if output is not None:
+            self.entries[reference] = output
+            self._evict()
+        return output
+
+    def __contains__(self, reference: object) -> bool:
+        return isinstance(reference, OutputReference) and self._lookup(reference) is not None
+
+    def __getitem__(self, reference: OutputReference) -> Output:
+        output = self._lookup(reference)
+        if output is None:
+            raise KeyError(reference)
+        return output
+
+    def get(self, reference: OutputReference, default: Optional[Output] = None) -> Optional[Output]:
+        output = self._lookup(reference)
+        return output if output is not None else default
+
+    def __len__(self) -> int:
+        return self.count
+
+    def items(self) -> Iterator[Tuple[OutputReference, Output]]:
+        # stored coins overlaid with the unflushed changes; flushing here
+        # instead could persist half of a block that is being applied
+        for (reference, output) in self.database.items():
+            if reference not in self.dirty:
+                yield (reference, output)
+
+        for reference in list(self.dirty):
+            output = self.entries[reference]
+            if output is not None:
+                yield (reference, output)
+
+    def keys(self) -> Iterator[OutputReference]:
+        return (reference for (reference, _) in self.items())
+
+    def values(self) -> Iterator[Output]:
+        return (output for (_, output) in self.items())
+
+    def __iter__(self) -> Iterator[OutputReference]:
+        return self.keys()
+
+    def outputs_for(self, public_key: bytes) -> Dict[OutputReference, Output]:
+        outputs = {
+            reference: output
+            for (reference, output) in self.database.outputs_for(public_key)
+            if reference not in self.dirty
+        }
+
+        for reference in self.dirty_by_public_key.get(public_key, ()):
+            output = self.entries[reference]
+            if output is not None:
+                outputs[reference] = output
+
+        return outputs
+
+    def mutate(self) -> "CoinCacheMutation":
+        return CoinCacheMutation(self)
+
+    def _apply(self, changes: Dict[OutputReference, Optional[Output]]) -> None:
+        for (reference, output) in changes.items():
+            if output is None:
+                self.count -= 1
+                spent = self.entries.get(reference)
+                if spent is not None and reference in self.dirty:
+                    self.dirty_by_public_key[spent.public_key].discard(reference)
+                if reference in self.fresh:
+                    self.fresh.discard(reference)
+                    self.dirty.discard(reference)
+                    self.entries.pop(reference, None)
+                    continue
+            else:
+                self.count += 1
+                if reference not in self.dirty:
+                    self.fresh.add(reference)
+                self.dirty_by_public_key.setdefault(output.public_key, set()).add(reference)
+
+            self.entries[reference] = output
+            self.entries.move_to_end(reference)
+            self.dirty.add(reference)
+
+        self._evict()
+
+    def _evict(self) -> None:
+        budget = self.cache_bytes // ESTIMATED_COIN_SIZE
+        if len(self.entries) <= budget:
+            return
+
+        # dirty entries are skipped and moved to the back so the scan always
+        # makes progress; they become evictable after the next flush
+        for _ in range(len(self.entries)):
+            if len(self.entries) <= budget:
+                break
+            (reference, output) = self.entries.popitem(last=False)
+            if reference in self.dirty:
+                self.entries[reference] = output
+
+    def block_connected(self, height: int, block_hash: bytes) -> None:
+        self.best = (height, block_hash)
+        self.blocks_since_flush += 1
+        if not self.hold_flushes:
+            self.flush_if_due()
+
+    def flush_if_due(self) -> None:
+        # flushes only happen between blocks so the stored best block always
+        # matches the stored coins
+        if (
+            self.blocks_since_flush >= self.flush_blocks
+            or len(self.dirty) * ESTIMATED_COIN_SIZE >= self.flush_bytes
+        ):
+            self.flush()
+
+    def block_disconnected(self, height: int, block_hash: bytes) -> None:
+        # (height, block_hash) is the new tip after the disconnect
+        self.block_connected(height, block_hash)
+
+    def best_block(self) -> Optional[Tuple[int, bytes]]:
+        return self.database.best_block()
+
+    def flush(self) -> None:
+        if not self.dirty and self.blocks_since_flush == 0:
+            return
+
+        changes = {reference: self.entries[reference] for reference in self.dirty}
+        self.database.write_batch(changes, self.best)
+
+        for (reference, output) in changes.items():
+            if output is None:
+                del self.entries[reference]
+
+        self.dirty.clear()
+        self.fresh.clear()
+        self.dirty_by_public_key.clear()
+        self.blocks_since_flush = 0
+
+        self._evict()
+
+    def close(self) -> None:
+        self.flush()
+        self.database.close()
+
+
+class CoinCacheMutation:
+
+    # Mirrors immutables.MapMutation: changes are staged here and only reach
+    # the cache on finish(), so a transaction that fails half way leaves no
+    # trace behind.
+
+    def __init__(self, cache: CoinCache):
+        self.cache = cache
+        self.changes: Dict[OutputReference, Optional[Output]] = {}
+
+    def __enter__(self) -> "CoinCacheMutation":
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+    def _lookup(self, reference: OutputReference) -> Optional[Output]:
+        if reference in self.changes:
+            return self.changes[reference]
+        return self.cache.get(reference)
+
+    def __contains__(self, reference: object) -> bool:
+        return isinstance(reference, OutputReference) and self._lookup(reference) is not None
+
+    def __getitem__(self, reference: OutputReference) -> Output:
+        output = self._lookup(reference)
+        if output is None:
+            raise KeyError(reference)
+        return output
+
+    def get(self, reference: OutputReference, default: Optional[Output] = None) -> Optional[Output]:
+        output = self._lookup(reference)
+        return output if output is not None else default
+
+    def __setitem__(self, reference: OutputReference, output: Output) -> None:
+        self.changes[reference] = output
+
+    def __delitem__(self, reference: OutputReference) -> None:
+        if self._lookup(reference) is None:
+            raise KeyError(reference)
+
+        if reference in self.changes and reference not in self.cache:
+            # created and spent within this mutation, the cache never sees it
+            del self.changes[reference]
+        else:
+            self.changes[reference] = None
+
+    def finish(self) -> CoinCache:
+        self.cache._apply(self.changes)
+        self.changes = {}
+        return self.cache
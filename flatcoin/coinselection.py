@@ -0,0 +1,228 @@
+from bisect import bisect_left
+from typing import List, Mapping, Optional, Tuple
+
+from flatcoin.params import MAX_BLOCK_SIZE
+from flatcoin.serialization import vlq_size
+from flatcoin.transaction import Output, OutputReference
+
+
+# encoded sizes, see Transaction.serialized_size
+INPUT_SIZE = 100
+OUTPUT_SIZE = 72
+
+# branch and bound gives up after visiting this many nodes, however large
+# the wallet
+MAX_BNB_TRIES = 100_000
+
+# what a consolidation may spend at most, leaving the transaction well
+# inside a block
+MAX_CONSOLIDATION_INPUTS = int(MAX_BLOCK_SIZE) // (2 * INPUT_SIZE)
+
+
+Coin = Tuple[OutputReference, Output]
+
+
+class InsufficientFundsError(ValueError):
+    pass
+
+
+def transaction_size(n_inputs: int, n_outputs: int) -> int:
+    return 1 + vlq_size(n_inputs) + INPUT_SIZE * n_inputs + vlq_size(n_outputs) + OUTPUT_SIZE * n_outputs
+
+
+class Selection:
+
+    def __init__(self, coins: List[Coin], amount: int, fee: int):
+        self.coins = coins
+        self.amount = amount
+        # what the transaction pays the network, with any excess too small
+        # for a change output folded in
+        self.fee = fee
+
+    @property
+    def total(self) -> int:
+        return sum(output.value for (_, output) in self.coins)
+
+    @property
+    def change(self) -> int:
+        return self.total - self.amount - self.fee
+
+    def __len__(self) -> int:
+        return len(self.coins)
+
+
+def _fee(fee: int, fee_per_byte: int, n_inputs: int, n_outputs: int) -> int:
+    return fee + fee_per_byte * transaction_size(n_inputs, n_outputs)
+
+
+def spendable_candidates(coins: Mapping[OutputReference, Output], fee_per_byte: int) -> List[Tuple[int, Coin]]:
+    # (effective value, coin), largest first; coins that cost more to
+    # spend than they are worth are left out
+    input_fee = fee_per_byte * INPUT_SIZE
+    candidates = [
+        (output.value - input_fee, (reference, output))
+        for (reference, output) in coins.items()
+        if output.value > input_fee
+    ]
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+    return candidates
+
+
+def select_branch_and_bound(
+    candidates: List[Tuple[int, Coin]],
+    target: int,
+    cost_of_change: int,
+    max_inputs: Optional[int] = None,
+    max_tries: int = MAX_BNB_TRIES,
+) -> Optional[List[Coin]]:
+    # Depth-first search over include/exclude decisions, largest coin first,
+    # for a set whose effective value lands in [target, target +
+    # cost_of_change], i.e. needs no change output. Of the matches found
+    # the one with the fewest inputs, then the least excess, wins. A branch
+    # is cut as soon as it overshoots, cannot reach the target with
+    # everything left or needs more than max_inputs coins, and the search
+    # stops after max_tries nodes.
+    values = [value for (value, _) in candidates]
+    remaining = [0] * (len(values) + 1)
+    for index in range(len(values) - 1, -1, -1):
+        remaining[index] = remaining[index + 1] + values[index]
+
+    if remaining[0] < target:
+        return None
+
+    upper = target + cost_of_change
+    best: Optional[List[int]] = None
+    best_key: Optional[Tuple[int, int]] = None
+    # a match must have fewer inputs than this
+    input_limit = len(values) + 1 if max_inputs is None else max_inputs + 1
+
+    chosen: List[int] = []
+    total = 0
+    index = 0
+    tries = 0
+
+    while tries < max_tries:
+        tries += 1
+        backtrack = False
+
+        if total > upper or total + remaining[index] < target:
+            backtrack = True
+        elif total >= target:
+            key = (len(chosen), total - target)
+            if best_key is None or key < best_key:
+                (best, best_key) = (list(chosen), key)
+                input_limit = min(input_limit, len(chosen) + 1)
+            backtrack = True
+        elif len(chosen) + 1 >= input_limit:
+            # one more input cannot beat the best match
+            backtrack = True
+        elif index == len(values):
+            backtrack = True
+
+        if backtrack:
+            # drop the most recent inclusion and try the branch without it;
+            # equal values next to it would only repeat the same search
+            if not chosen:
+                break
+            last = chosen.pop()
+            total -= values[last]
+            index = last + 1
+            while index < len(values) and values[index] == values[last]:
+                index += 1
+            continue
+
+        chosen.append(index)
+        total += values[index]
+        index += 1
+
+    if best is None:
+        return None
+    return [candidates[index][1] for index in best]
+
+
+def select_fewest_inputs(candidates: List[Tuple[int, Coin]], target: int) -> Optional[List[Coin]]:
+    # The k largest coins are the most any k coins can cover, so taking
+    # coins largest first until the target is met gives the fewest inputs.
+    # The last of them is then swapped for the smallest coin that still
+    # covers the target, which keeps the big coins and the change small.
+    total = 0
+    count = 0
+    for (value, _) in candidates:
+        total += value
+        count += 1
+        if total >= target:
+            break
+    else:
+        return None
+
+    base = total - candidates[count - 1][0]
+    needed = target - base
+
+    # candidates[count - 1:] is sorted largest first; find the smallest value
+    # that is still >= needed
+    rest = [value for (value, _) in candidates[count - 1:]]
+    rest.reverse()
+    position = bisect_left(rest, needed)
+    last = len(candidates) - 1 - position
+
+    return [coin for (_, coin) in candidates[:count - 1]] + [candidates[last][1]]
+
+
+def select_coins(
+    coins: Mapping[OutputReference, Output],
+    amount: int,
+    fee: int = 0,
+    fee_per_byte: int = 0,
+    max_tries: int = MAX_BNB_TRIES,
+) -> Selection:
+    # Picks inputs paying amount to one recipient plus a fee of fee +
+    # fee_per_byte * transaction size: an exact match that needs no change
+    # when there is one with no more inputs than the fewest that cover the
+    # amount with change, otherwise those.
+    if amount <= 0:
+        raise ValueError("Amount must be positive")
+
+    candidates = spendable_candidates(coins, fee_per_byte)
+
+    # effective values already pay for the inputs; what is left is the
+    # transaction's fixed part and its outputs
+    change_target = amount + _fee(fee, fee_per_byte, 0, 2)
+    fewest = select_fewest_inputs(candidates, change_target)
+
+    no_change_target = amount + _fee(fee, fee_per_byte, 0, 1)
+    # a change output costs its own bytes now and an input to spend later
+    cost_of_change = fee_per_byte * (OUTPUT_SIZE + INPUT_SIZE)
+    max_inputs = len(fewest) if fewest is not None else None
+
+    exact = select_branch_and_bound(candidates, no_change_target, cost_of_change, max_inputs, max_tries)
+    if exact is not None:
+        total = sum(output.value for (_, output) in exact)
+        return Selection(exact, amount, total - amount)
+
+    if fewest is None:
+        raise InsufficientFundsError("Insufficient funds")
+
+    return Selection(fewest, amount, _fee(fee, fee_per_byte, len(fewest), 2))
+
+
+def select_consolidation(
+    coins: Mapping[OutputReference, Output],
+    fee: int = 0,
+    fee_per_byte: int = 0,
+    max_inputs: int = MAX_CONSOLIDATION_INPUTS,
+) -> Selection:
+    # For idle periods, when fees are low: the smallest coins, up to
+    # max_inputs of them, merged into one output back to the wallet so
+    # later payments need fewer inputs. amount is what that output receives.
+    candidates = spendable_candidates(coins, fee_per_byte)
+    candidates.reverse()
+    chosen = [coin for (_, coin) in candidates[:max_inputs]]
+    if len(chosen) < 2:
+        raise InsufficientFundsError("Nothing to consolidate")
+
+    total_fee = _fee(fee, fee_per_byte, len(chosen), 1)
+    amount = sum(output.value for (_, output) in chosen) - total_fee
+    if amount <= 0:
+        raise InsufficientFundsError("Consolidating these coins would cost more than they are worth")
+
+    return Selection(chosen, amount, total_fee)
@@ -1,46 +1,268 @@
+import os
+from typing import BinaryIO, Dict, Iterable, List, Mapping, Optional, Tuple
+
 import immutables
 
+from flatcoin import metrics
 from flatcoin.block import Block
+from flatcoin.coindb import DEFAULT_CACHE_BYTES, DEFAULT_FLUSH_BLOCKS, CoinCache
 from flatcoin.reading import human
+from flatcoin.serialization import Serializable, safe_read, stream_deserialize_list, stream_deserialize_vlq, stream_serialize_list, stream_serialize_vlq, vlq_size
 from flatcoin.transaction import Output, OutputReference, Transaction
 
 
+EMPTY_OUTPUTS: immutables.Map[OutputReference, Output] = immutables.Map()
+
+
+def index_owned_outputs(
+    unspent_transaction_outs: Iterable[Tuple[OutputReference, Output]]
+) -> immutables.Map[bytes, immutables.Map[OutputReference, Output]]:
+    grouped: Dict[bytes, Dict[OutputReference, Output]] = {}
+    for reference, output in unspent_transaction_outs:
+        grouped.setdefault(output.public_key, {})[reference] = output
+        
+    return immutables.Map({
+        public_key: immutables.Map(outputs) for (public_key, outputs) in grouped.items()
+    })
+
+
+def is_coinbase_transaction(transaction: Transaction) -> bool:
+    return (
+        len(transaction.inputs) == 1
+        and  transaction.inputs[0].output_reference.tx_hash == b"\x00" * 32
+    )
+
+
+def apply_transaction_to(
+    temp: immutables.MapMutation[OutputReference, Output],
+    transaction: Transaction,
+    spent: List[Tuple[OutputReference, Output]],
+    created: List[Tuple[OutputReference, Output]],
+) -> None:
+    # inputs are checked against the mutation, not the state it started
+    # from, so spending an output twice within a block (or a transaction)
+    # fails while spending one created earlier in the same block works
+    if not is_coinbase_transaction(transaction):
+        for inp in transaction.inputs:
+            reference = inp.output_reference
+            if reference not in temp:
+                raise ValueError(f"Input {human(reference.tx_hash)}:{reference.index} not found or already spent")
+            spent.append((reference, temp[reference]))
+            del temp[reference]
+            
+    transaction_hash = transaction.hash()
+    for index, output in enumerate(transaction.outputs):
+        output_reference = OutputReference(transaction_hash, index)
+        temp[output_reference] = output
+        created.append((output_reference, output))
+
+
 class CoinState:
     
     def __init__(
         self,
-        unspent_transaction_outs: immutables.Map[OutputReference, Output]
+        unspent_transaction_outs: immutables.Map[OutputReference, Output],
+        owned_outputs: Optional[immutables.Map[bytes, immutables.Map[OutputReference, Output]]] = None,
     ):
         self.unspent_transaction_outs = unspent_transaction_outs
+        
+        # public key -> the unspent outputs paying to it, kept alongside the
+        # UTXO map so balance and coin lookups cost O(owned); the disk backed
+        # CoinCache maintains its own index instead
+        if owned_outputs is None and not self.is_on_disk:
+            owned_outputs = index_owned_outputs(unspent_transaction_outs.items())
+        self.owned_outputs = owned_outputs
     
     @classmethod
     def empty(cls) -> "CoinState":
-        return cls(unspent_transaction_outs=immutables.Map())
+        return cls(unspent_transaction_outs=immutables.Map(), owned_outputs=immutables.Map())
+    
+    @classmethod
+    def on_disk(
+        cls,
+        path: str,
+        cache_bytes: int = DEFAULT_CACHE_BYTES,
+        flush_blocks: int = DEFAULT_FLUSH_BLOCKS,
+    ) -> "CoinState":
+        # the UTXO set lives in a CoinDatabase behind a bounded CoinCache; see
+        # CoinCache for how this differs from the in-memory map
+        return cls(unspent_transaction_outs=CoinCache.open(path, cache_bytes, flush_blocks)) # type: ignore
+    
+    @property
+    def is_on_disk(self) -> bool:
+        return isinstance(self.unspent_transaction_outs, CoinCache)
     
     def apply_transaction(self, transaction: Transaction) -> "CoinState":
+        spent: List[Tuple[OutputReference, Output]] = []
+        created: List[Tuple[OutputReference, Output]] = []
+        
         with self.unspent_transaction_outs.mutate() as temp:
-            
-            is_coinbase = (
-                len(transaction.inputs) == 1
-                and  transaction.inputs[0].output_reference.tx_hash == b"\x00" * 32
-            )
-            
-            if not is_coinbase:
-                for inp in transaction.inputs:
-                    reference = inp.output_reference
-                    if reference not in self.unspent_transaction_outs:
-                        raise ValueError(f"Input {human(reference.tx_hash)}:{reference.index} not found or already spent")
-                    del temp[reference]
+            apply_transaction_to(temp, transaction, spent, created)
+            return CoinState(temp.finish(), self._update_owned_outputs(spent, created))
+        
+    def _update_owned_outputs(
+        self,
+        spent: List[Tuple[OutputReference, Output]],
+        created: List[Tuple[OutputReference, Output]],
+    ) -> Optional[immutables.Map[bytes, immutables.Map[OutputReference, Output]]]:
+        if self.owned_outputs is None:
+            return None
+        
+        with self.owned_outputs.mutate() as owned:
+            for reference, output in spent:
+                outputs = owned[output.public_key].delete(reference)
+                if outputs:
+                    owned[output.public_key] = outputs
+                else:
+                    del owned[output.public_key]
                     
-            transaction_hash = transaction.hash()
-            for index, output in enumerate(transaction.outputs):
-                output_reference = OutputReference(transaction_hash, index)
-                temp[output_reference] = output
+            for reference, output in created:
+                owned[output.public_key] = owned.get(output.public_key, EMPTY_OUTPUTS).set(reference, output)
                 
-            return CoinState(temp.finish())
+            return owned.finish()
+        
+    def outputs_for(self, public_key: bytes) -> Mapping[OutputReference, Output]:
+        if self.owned_outputs is None:
+            return self.unspent_transaction_outs.outputs_for(public_key) # type: ignore
+        return self.owned_outputs.get(public_key, EMPTY_OUTPUTS)
+    
+    def balance_of(self, public_key: bytes) -> int:
+        return sum(output.value for output in self.outputs_for(public_key).values())
         
     def apply_block(self, block: Block) -> "CoinState":
-        state = self
-        for transaction in block.transactions:
-            state = state.apply_transaction(transaction)
-        return state
\ No newline at end of file
+        (state, _) = self.apply_block_with_undo(block)
+        return state
+    
+    @metrics.timed("flatcoin_apply_block_seconds", "Time spent applying blocks to the UTXO set")
+    def apply_block_with_undo(self, block: Block) -> Tuple["CoinState", "BlockUndo"]:
+        # the whole block goes through a single mutation, so a failing
+        # transaction leaves this state untouched and there is one finish()
+        # per block rather than one per transaction
+        spent: List[Tuple[OutputReference, Output]] = []
+        created: List[Tuple[OutputReference, Output]] = []
+        
+        with self.unspent_transaction_outs.mutate() as temp:
+            for transaction in block.transactions:
+                apply_transaction_to(temp, transaction, spent, created)
+            unspent_transaction_outs = temp.finish()
+            
+        # outputs both created and spent inside the block cancel out
+        spent_references = {reference for (reference, _) in spent}
+        created_references = {reference for (reference, _) in created}
+        spent = [(reference, output) for (reference, output) in spent if reference not in created_references]
+        created = [(reference, output) for (reference, output) in created if reference not in spent_references]
+        
+        state = CoinState(unspent_transaction_outs, self._update_owned_outputs(spent, created))
+        
+        if state.is_on_disk:
+            state.unspent_transaction_outs.block_connected(block.header.summary.height, block.hash()) # type: ignore
+            
+        return (state, BlockUndo(spent, [reference for (reference, _) in created]))
+    
+    @metrics.timed("flatcoin_undo_block_seconds", "Time spent rolling blocks back from the UTXO set")
+    def undo_block(self, block: Block, undo: "BlockUndo") -> "CoinState":
+        removed: List[Tuple[OutputReference, Output]] = []
+        
+        with self.unspent_transaction_outs.mutate() as temp:
+            for reference in undo.created:
+                if reference not in temp:
+                    raise ValueError(f"Output {human(reference.tx_hash)}:{reference.index} created by the block is not unspent")
+                removed.append((reference, temp[reference]))
+                del temp[reference]
+                
+            for reference, output in undo.spent:
+                temp[reference] = output
+                
+            unspent_transaction_outs = temp.finish()
+            
+        state = CoinState(unspent_transaction_outs, self._update_owned_outputs(removed, undo.spent))
+        
+        if state.is_on_disk:
+            summary = block.header.summary
+            state.unspent_transaction_outs.block_disconnected(summary.height - 1, summary.previous_block_hash) # type: ignore
+            
+        return state
+    
+    
+class BlockUndo(Serializable):
+    
+    # What connecting a block did to the UTXO set: the outputs it spent
+    # (with their contents, so they can be put back) and the references it
+    # created. Outputs created and spent within the block are left out.
+    
+    def __init__(self, spent: List[Tuple[OutputReference, Output]], created: List[OutputReference]):
+        self.spent = spent
+        self.created = created
+        
+    def stream_serialize(self, f: BinaryIO) -> None:
+        stream_serialize_vlq(f, len(self.spent))
+        for reference, output in self.spent:
+            reference.stream_serialize(f)
+            output.stream_serialize(f)
+        stream_serialize_list(f, self.created)
+        
+    @classmethod
+    def stream_deserialize(cls, f: BinaryIO) -> "BlockUndo":
+        spent = []
+        for _ in range(stream_deserialize_vlq(f)):
+            reference = OutputReference.stream_deserialize(f)
+            spent.append((reference, Output.stream_deserialize(f)))
+        created = stream_deserialize_list(f, OutputReference)
+        return cls(spent, created)
+    
+    def serialized_size(self) -> int:
+        return vlq_size(len(self.spent)) + 108 * len(self.spent) + vlq_size(len(self.created)) + 36 * len(self.created)
+    
+    
+class CoinStateCheckpoint(Serializable):
+    
+    # A full copy of the UTXO set as of the block at `height`, so a restarting
+    # node only has to replay the blocks that came after it.
+    
+    def __init__(self, height: int, block_hash: bytes, coinstate: CoinState):
+        self.height = height
+        self.block_hash = block_hash
+        self.coinstate = coinstate
+        
+    def stream_serialize(self, f: BinaryIO) -> None:
+        stream_serialize_vlq(f, self.height)
+        f.write(self.block_hash)
+        
+        unspent_transaction_outs = self.coinstate.unspent_transaction_outs
+        stream_serialize_vlq(f, len(unspent_transaction_outs))
+        for reference, output in unspent_transaction_outs.items():
+            reference.stream_serialize(f)
+            output.stream_serialize(f)
+            
+    def serialized_size(self) -> int:
+        count = len(self.coinstate.unspent_transaction_outs)
+        return vlq_size(self.height) + 32 + vlq_size(count) + 108 * count
+            
+    @classmethod
+    def stream_deserialize(cls, f: BinaryIO) -> "CoinStateCheckpoint":
+        height = stream_deserialize_vlq(f)
+        block_hash = safe_read(f, 32)
+        
+        with immutables.Map().mutate() as temp:
+            for _ in range(stream_deserialize_vlq(f)):
+                reference = OutputReference.stream_deserialize(f)
+                temp[reference] = Output.stream_deserialize(f)
+            unspent_transaction_outs = temp.finish()
+            
+        return cls(height, block_hash, CoinState(unspent_transaction_outs))
+    
+    def save(self, path: str) -> None:
+        with open(f"{path}.new", "wb") as f:
+            self.stream_serialize(f)
+            f.flush()
+            os.fsync(f.fileno())
+            
+        os.replace(f"{path}.new", path)
+        
+    @classmethod
+    def load(cls, path: str) -> Optional["CoinStateCheckpoint"]:
+        if not os.path.isfile(path):
+            return None
+        
+        with open(path, "rb") as f:
+            return cls.stream_deserialize(f)
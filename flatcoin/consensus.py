@@ -1,6 +1,11 @@
+from typing import Mapping
+
+from flatcoin import metrics
 from flatcoin.block import Block, BlockHeader
-from flatcoin.params import MAX_BLOCK_SIZE, MAX_FUTURE_BLOCK_TIME
-from flatcoin.transaction import Transaction
+from flatcoin.merkle import merkle_root
+from flatcoin.params import DEFAULT_TARGET, MAX_BLOCK_SIZE, MAX_FUTURE_BLOCK_TIME, TARGET_SHIFT
+from flatcoin.signatures import SignatureVerifier
+from flatcoin.transaction import Output, OutputReference, Transaction
 
 def validate_coinbase_transaction(transaction: Transaction) -> bool:
     if not len(transaction.inputs) == 1:
@@ -16,19 +21,37 @@ def validate_transaction(transaction: Transaction) -> bool:
     if len(transaction.outputs) == 0:
         return False
 
-    if len(transaction.serialize()) > MAX_BLOCK_SIZE:
+    if transaction.serialized_size() > MAX_BLOCK_SIZE:
         return False
 
     return True
 
-def validate_block_header(block_header: BlockHeader, current_timestamp: int) -> bool:
+def target_threshold(target: int) -> bytes:
+    # big-endian, so comparing raw digests with <= compares them as integers
+    return (target << TARGET_SHIFT).to_bytes(32, "big")
+
+
+def validate_proof_of_work(header_hash: bytes, target: int) -> bool:
+    return header_hash <= target_threshold(target)
+
+def validate_block_header(block_header: BlockHeader, current_timestamp: int, target: int = DEFAULT_TARGET) -> bool:
+    # target is the network's, the one its genesis block was mined at; a
+    # header may ask for more work than that but never for less, or its
+    # proof of work would prove nothing
     if block_header.summary.timestamp > current_timestamp + MAX_FUTURE_BLOCK_TIME:
         return False
 
+    if block_header.summary.target > target:
+        return False
+
+    if not validate_proof_of_work(block_header.hash(), block_header.summary.target):
+        return False
+
     return True
     
-def validate_block(block: Block, current_timestamp: int) -> bool:
-    valid_header = validate_block_header(block.header, current_timestamp)
+@metrics.timed("flatcoin_validate_block_seconds", "Time spent on stateless block validation")
+def validate_block(block: Block, current_timestamp: int, target: int = DEFAULT_TARGET) -> bool:
+    valid_header = validate_block_header(block.header, current_timestamp, target)
 
     if not valid_header:
         return False
@@ -36,7 +59,11 @@ def validate_block(block: Block, current_timestamp: int) -> bool:
     if len(block.transactions) == 0:
         return False
 
-    if len(block.serialize()) > MAX_BLOCK_SIZE:
+    if block.serialized_size() > MAX_BLOCK_SIZE:
+        return False
+
+    # computed afresh rather than from the block's cached tree
+    if block.header.summary.merkle_root_hash != merkle_root([transaction.hash() for transaction in block.transactions]):
         return False
 
     coinbase_transaction = block.transactions[0]
@@ -52,4 +79,14 @@ def validate_block(block: Block, current_timestamp: int) -> bool:
         if not valid_transaction:
             return False
 
-    return True
\ No newline at end of file
+    return True
+
+
+def validate_block_signatures(
+    block: Block,
+    unspent_transaction_outs: Mapping[OutputReference, Output],
+    verifier: SignatureVerifier,
+) -> bool:
+    # stateful: needs the UTXO set the block is applied on top of to know
+    # which public key each input has to be signed by
+    return verifier.verify_transactions(block.transactions, unspent_transaction_outs)
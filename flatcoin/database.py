@@ -1,79 +1,598 @@
 import os
+import re
 import sqlite3
-from typing import Any, List
+from typing import Any, Iterable, Iterator, List, Optional, Tuple, Union
 
-from flatcoin.block import Block
+from flatcoin import metrics
+from flatcoin.block import Block, BlockHeader, BlockView
+from flatcoin.blockfiles import DEFAULT_MAX_BLOCK_FILE_SIZE, BlockFiles
+from flatcoin.serialization import DeserializationError, SerializationError
 from flatcoin.utils import create_chain_directory
 
 
+# sqlite3 keeps a per-connection cache of prepared statements keyed by the SQL
+# text, so every query below is a module constant and gets compiled only once.
+STATEMENT_CACHE_SIZE = 64
+
+INSERT_BLOCK = "INSERT OR IGNORE INTO chain (hash, height, block_bytes) VALUES (?, ?, ?)"
+SELECT_BY_HASH = "SELECT block_bytes FROM chain WHERE hash = ?"
+SELECT_BY_HEIGHT = "SELECT chain.block_bytes FROM main_chain JOIN chain ON chain.hash = main_chain.hash WHERE main_chain.height = ?"
+SELECT_CONTAINS = "SELECT 1 FROM chain WHERE hash = ?"
+SELECT_COUNT = "SELECT COUNT(*) FROM chain"
+SELECT_TIP = "SELECT height, hash FROM main_chain ORDER BY height DESC LIMIT 1"
+DELETE_BLOCK = "DELETE FROM chain WHERE hash = ?"
+
+INSERT_LOCATION = "INSERT OR IGNORE INTO chain (hash, height, file, offset, length) VALUES (?, ?, ?, ?, ?)"
+SELECT_LOCATION_BY_HASH = "SELECT file, offset, length FROM chain WHERE hash = ?"
+SELECT_LOCATION_BY_HEIGHT = "SELECT chain.file, chain.offset, chain.length FROM main_chain JOIN chain ON chain.hash = main_chain.hash WHERE main_chain.height = ?"
+
+# main_chain is the active chain by height; blocks on other branches are in
+# chain but not in main_chain
+SET_MAIN_CHAIN = "INSERT OR REPLACE INTO main_chain (height, hash) VALUES (?, ?)"
+TRUNCATE_MAIN_CHAIN = "DELETE FROM main_chain WHERE height > ?"
+SELECT_MAIN_CHAIN_HASH = "SELECT hash FROM main_chain WHERE height = ?"
+FILL_MAIN_CHAIN = "INSERT OR IGNORE INTO main_chain (height, hash) SELECT height, hash FROM chain ORDER BY height"
+
+INSERT_UNDO = "INSERT OR REPLACE INTO undo (hash, undo_bytes) VALUES (?, ?)"
+SELECT_UNDO = "SELECT undo_bytes FROM undo WHERE hash = ?"
+DELETE_UNDO = "DELETE FROM undo WHERE hash = ?"
+
+# every stored block's header is kept a second time here, so the header
+# index is built at startup without reading a single block body, and
+# headers stay when pruning drops the bodies
+INSERT_HEADER = "INSERT OR IGNORE INTO headers (hash, height, header_bytes) VALUES (?, ?, ?)"
+SELECT_HEADER = "SELECT header_bytes FROM headers WHERE hash = ?"
+SELECT_HEADERS = (
+    "SELECT headers.hash, headers.header_bytes, chain.hash IS NOT NULL "
+    "FROM headers LEFT JOIN chain ON chain.hash = headers.hash ORDER BY headers.height"
+)
+SELECT_MISSING_HEADERS = "SELECT hash, height FROM chain WHERE hash NOT IN (SELECT hash FROM headers)"
+DELETE_HEADER = "DELETE FROM headers WHERE hash = ?"
+COPY_PRUNED_HEADERS = "INSERT OR IGNORE INTO headers (hash, height, header_bytes) SELECT hash, height, header_bytes FROM pruned_headers"
+SELECT_PRUNE_HEIGHT = "SELECT COALESCE(MIN(height), 0) FROM chain"
+SELECT_HASHES_BELOW = "SELECT hash FROM chain WHERE height < ?"
+DELETE_BLOCKS_BELOW = "DELETE FROM chain WHERE height < ?"
+DELETE_UNDO_BELOW = "DELETE FROM undo WHERE hash IN (SELECT hash FROM chain WHERE height < ?)"
+SELECT_SIZE_BY_HEIGHT = "SELECT height, SUM(LENGTH(block_bytes)) FROM chain GROUP BY height ORDER BY height DESC"
+SELECT_LOCATION_SIZE_BY_HEIGHT = "SELECT height, SUM(length) FROM chain GROUP BY height ORDER BY height DESC"
+SELECT_FILES_IN_USE = "SELECT DISTINCT file FROM chain"
+SELECT_STORED_BYTES = "SELECT COALESCE(SUM(LENGTH(block_bytes)), 0) FROM chain"
+SELECT_STORED_LOCATION_BYTES = "SELECT COALESCE(SUM(length), 0) FROM chain"
+
+# PRAGMA auto_vacuum value of a database that gives free pages back on
+# PRAGMA incremental_vacuum
+AUTO_VACUUM_INCREMENTAL = 2
+
+Undo = Tuple[bytes, bytes]
+
+# (hash, height, header bytes)
+HeaderRow = Tuple[bytes, int, bytes]
+
+LEGACY_BLOCK_FILE_PATTERN = re.compile(r"^(\d{8})-([0-9a-f]{64})$")
+
+blocks_pruned = metrics.counter("flatcoin_blocks_pruned_total", "Block bodies dropped by pruning")
+vacuum_failures = metrics.counter(
+    "flatcoin_blockstore_vacuum_failures_total", "Prunes whose freed pages could not be given back yet"
+)
+
+
+def decode_legacy_block(block_bytes: bytes) -> Block:
+    # a block that no longer decodes (the header gained its merkle root
+    # since) fails the whole migration, which leaves the old store untouched
+    try:
+        return Block.deserialize(block_bytes)
+    except (ValueError, DeserializationError, SerializationError) as e:
+        raise ValueError(f"Blockstore holds a block in a format this version cannot read: {e}") from e
+
+
+def header_row(hash: bytes, height: int, block_bytes: Union[bytes, memoryview]) -> HeaderRow:
+    # the header is the block's prefix, so it is cut out rather than encoded
+    (_, end) = BlockHeader.decode_from(memoryview(block_bytes), 0)
+    return (hash, height, bytes(block_bytes[:end]))
+
+
 class BlockStore:
-    
+
+    # version 2 added the main_chain and undo tables, 3 pruned_headers, 4
+    # replaced pruned_headers with headers, holding every block's header
+    schema_version = 4
+    # the oldest version migrated in place; anything older is rebuilt
+    keyed_version = 1
+
     def __init__(self, path: str):
-        
+
         self.is_memory: bool = path == ":memory:"
         self.is_new: bool = self.is_memory or not os.path.isfile(path)
-        
+
         if self.is_new and not self.is_memory:
             print(f"Creating blockstore at {path}")
         elif not self.is_memory:
             print(f"Loading blockstore from {path}")
-        
-        self.connection: sqlite3.Connection = sqlite3.connect(path)
-        
-        if self.is_new:
-            self._ensure_schema()
-        
+
+        # Node.sync writes from its connect thread while the event loop
+        # keeps reading; sqlite serializes the calls
+        self.connection: sqlite3.Connection = sqlite3.connect(
+            path, cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False
+        )
+
+        self._configure()
+        self._ensure_schema()
+
+    def _configure(self) -> None:
+        # WAL lets readers keep going while a batch is being written, and with
+        # synchronous=NORMAL a commit no longer waits on an fsync of the main db
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        # only takes effect on a new database, see _free_pages
+        self.connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+    def _schema_version(self) -> int:
+        (version,) = self.connection.execute("PRAGMA user_version").fetchone()
+        return version
+
     def _ensure_schema(self) -> None:
+        version = self._schema_version()
+
+        if version == self.schema_version:
+            return
+
+        if version > self.schema_version:
+            raise ValueError(f"Blockstore schema version {version} is newer than supported version {self.schema_version}")
+
+        with self.connection:
+            self.connection.execute("BEGIN")
+
+            if self._has_table("chain"):
+                self._migrate(version)
+            else:
+                self._create_tables()
+
+            self.connection.execute(f"PRAGMA user_version = {self.schema_version}")
+
+        self._migration_committed()
+
+    def _migration_committed(self) -> None:
+        # for whatever may only be removed once the migrated store is safely
+        # on disk
+        pass
+
+    def _has_table(self, name: str) -> bool:
+        cursor = self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (name,)
+        )
+        return cursor.fetchone() is not None
+
+    def _create_tables(self) -> None:
         self.connection.execute("""
 
             CREATE TABLE IF NOT EXISTS chain (
-                hash BLOB,
-                block_bytes BLOB
+                hash BLOB PRIMARY KEY,
+                height INTEGER NOT NULL,
+                block_bytes BLOB NOT NULL
+            ) WITHOUT ROWID
+
+        """)
+        self.connection.execute("""
+
+            CREATE INDEX IF NOT EXISTS chain_height ON chain (height)
+
+        """)
+        self._create_chain_tables()
+
+    def _create_chain_tables(self) -> None:
+        self.connection.execute("""
+
+            CREATE TABLE IF NOT EXISTS main_chain (
+                height INTEGER PRIMARY KEY,
+                hash BLOB NOT NULL
             )
-            
+
         """)
-        
-    def insert(self, hash: bytes, block_bytes: bytes) -> None:
         self.connection.execute("""
-            
-            INSERT INTO chain (hash, block_bytes) VALUES (?, ?)
-                                    
-        """, (hash, block_bytes))
-        self.connection.commit()
-        
-    # TODO: make sure to check if the block bytes equals b"\x00"
-    # if so, this means it could not find the block with the given hash
-    def get(self, hash: bytes) -> Block:
-        cursor = self.connection.execute(
-            "SELECT block_bytes FROM chain WHERE hash = ?", 
-            (hash,)
-        )
-        row = cursor.fetchone()
-        return Block.deserialize(row[0] if row is not None else b"\x00")
-    
-    def remove(self, hash: bytes) -> None:
+
+            CREATE TABLE IF NOT EXISTS undo (
+                hash BLOB PRIMARY KEY,
+                undo_bytes BLOB NOT NULL
+            ) WITHOUT ROWID
+
+        """)
+        self.connection.execute("""
+
+            CREATE TABLE IF NOT EXISTS headers (
+                hash BLOB PRIMARY KEY,
+                height INTEGER NOT NULL,
+                header_bytes BLOB NOT NULL
+            ) WITHOUT ROWID
+
+        """)
         self.connection.execute("""
 
-            DELETE FROM chain WHERE hash = ?
-            
-        """, (hash,))
-        self.connection.commit()
-        
+            CREATE INDEX IF NOT EXISTS headers_height ON headers (height)
+
+        """)
+
+    def _migrate(self, version: int) -> None:
+        # later versions only added tables; stores from before main_chain
+        # existed hold exactly the main chain
+        if version >= self.keyed_version:
+            self._create_chain_tables()
+            if version == self.keyed_version:
+                self.connection.execute(FILL_MAIN_CHAIN)
+            self._fill_headers()
+            return
+
+        if version == 0:
+            # everything is decoded once before anything is written, so a
+            # store this version cannot read is left as it was
+            for (_, block_bytes) in self.connection.execute("SELECT hash, block_bytes FROM chain"):
+                decode_legacy_block(block_bytes)
+
+        self.connection.execute("ALTER TABLE chain RENAME TO chain_old")
+        self.connection.execute("DROP INDEX IF EXISTS chain_height")
+        self._create_tables()
+
+        self._insert_rows(self._old_rows(version))
+
+        self.connection.execute("DROP TABLE chain_old")
+        self.connection.execute(FILL_MAIN_CHAIN)
+        self._fill_headers()
+
+    def _fill_headers(self) -> None:
+        # headers of blocks stored before the headers table existed are read
+        # from their bodies, once
+        if self._has_table("pruned_headers"):
+            self.connection.execute(COPY_PRUNED_HEADERS)
+            self.connection.execute("DROP TABLE pruned_headers")
+
+        missing = self.connection.execute(SELECT_MISSING_HEADERS).fetchall()
+        rows = [header_row(hash, height, self.get_bytes(hash)) for (hash, height) in missing]  # type: ignore
+        self.connection.executemany(INSERT_HEADER, rows)
+
+    def _old_rows(self, version: int) -> Iterator[Tuple[bytes, int, bytes]]:
+        if version == 0:
+            # the original table had no height column and no key, so the height is
+            # recovered from each stored header and duplicate rows collapse into one
+            cursor = self.connection.execute("SELECT hash, block_bytes FROM chain_old")
+            return (
+                (hash, BlockHeader.deserialize(block_bytes).summary.height, block_bytes)
+                for (hash, block_bytes) in cursor
+            )
+
+        return iter(self.connection.execute("SELECT hash, height, block_bytes FROM chain_old"))
+
+    def _insert_rows(self, blocks: Iterable[Tuple[bytes, int, bytes]]) -> None:
+        self.connection.executemany(INSERT_BLOCK, blocks)
+
+    def insert(self, hash: bytes, height: int, block_bytes: bytes, undo_bytes: Optional[bytes] = None) -> None:
+        self.insert_many([(hash, height, block_bytes)], [(hash, undo_bytes)] if undo_bytes is not None else ())
+
+    @metrics.timed("flatcoin_blockstore_insert_seconds", "Time spent writing blocks to the store")
+    def insert_many(
+        self,
+        blocks: Iterable[Tuple[bytes, int, bytes]],
+        undo: Iterable[Undo] = (),
+        on_main_chain: bool = True,
+    ) -> None:
+        # blocks on the main chain also take over their heights there; undo
+        # is (hash, serialized BlockUndo) for blocks connected to the UTXO set
+        blocks = list(blocks)
+        with self.connection:
+            self._insert_rows(blocks)
+            self.connection.executemany(INSERT_HEADER, [header_row(*block) for block in blocks])
+            if on_main_chain:
+                self.connection.executemany(SET_MAIN_CHAIN, ((height, hash) for (hash, height, _) in blocks))
+            self.connection.executemany(INSERT_UNDO, undo)
+
+    def set_main_chain(self, fork_height: int, blocks: Iterable[Tuple[int, bytes]], undo: Iterable[Undo] = ()) -> None:
+        # after a reorganization: everything above fork_height is replaced by
+        # blocks, (height, hash) pairs that are already stored
+        with self.connection:
+            self.connection.execute(TRUNCATE_MAIN_CHAIN, (fork_height,))
+            self.connection.executemany(SET_MAIN_CHAIN, blocks)
+            self.connection.executemany(INSERT_UNDO, undo)
+
+    def main_chain_hash(self, height: int) -> Optional[bytes]:
+        row = self.connection.execute(SELECT_MAIN_CHAIN_HASH, (height,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_undo(self, hash: bytes) -> Optional[bytes]:
+        row = self.connection.execute(SELECT_UNDO, (hash,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_header(self, hash: bytes) -> Optional[BlockHeader]:
+        # found for pruned blocks too
+        row = self.connection.execute(SELECT_HEADER, (hash,)).fetchone()
+        return BlockHeader.deserialize(row[0]) if row is not None else None
+
+    def prune_height(self) -> int:
+        # blocks below this height have no body any more; the heights from
+        # here to the tip are the ones that can be served
+        (height,) = self.connection.execute(SELECT_PRUNE_HEIGHT).fetchone()
+        return height
+
+    def header_items(self) -> Iterator[Tuple[bytes, bytes, bool]]:
+        # (hash, header bytes, whether the body is stored) for every header,
+        # in height order, streamed from the cursor
+        return iter(self.connection.execute(SELECT_HEADERS))
+
+    def height_for_budget(self, max_bytes: int) -> int:
+        # the lowest height whose blocks, with everything above them, fit in
+        # max_bytes
+        total = 0
+        height = self.prune_height()
+        for (block_height, size) in self._sizes_by_height():
+            total += size
+            if total > max_bytes:
+                return block_height + 1
+            height = block_height
+        return height
+
+    def _sizes_by_height(self) -> Iterable[Tuple[int, int]]:
+        # (height, bytes stored at that height), highest first
+        return self.connection.execute(SELECT_SIZE_BY_HEIGHT)
+
+    def min_prune_bytes(self) -> int:
+        # the smallest budget pruning can keep the store under
+        return 0
+
+    def prune(self, height: int) -> int:
+        # Drops every stored block below height, on any branch, together
+        # with its undo data; the headers stay. Returns how many blocks
+        # went.
+        if height <= self.prune_height():
+            return 0
+
+        hashes = [hash for (hash,) in self.connection.execute(SELECT_HASHES_BELOW, (height,))]
+        with self.connection:
+            self.connection.execute(DELETE_UNDO_BELOW, (height,))
+            self.connection.execute(DELETE_BLOCKS_BELOW, (height,))
+        self._free_pages()
+        blocks_pruned.inc(len(hashes))
+        return len(hashes)
+
+    def _free_pages(self) -> None:
+        # Deleted rows only put their pages on sqlite's free list, so the
+        # file keeps its size until the pages are given back. A store
+        # created before auto_vacuum was set is rebuilt once by VACUUM,
+        # which also switches it to incremental mode for the next prune.
+        (mode,) = self.connection.execute("PRAGMA auto_vacuum").fetchone()
+        try:
+            if mode == AUTO_VACUUM_INCREMENTAL:
+                # executescript steps the pragma until every free page is
+                # gone; a plain execute frees only one
+                self.connection.executescript("PRAGMA incremental_vacuum")
+            else:
+                self.connection.execute("VACUUM")
+            # the main file only shrinks when the WAL is written back to it
+            self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.OperationalError:
+            # a read still running on the connection; the pages stay free
+            # and are given back by the next prune
+            vacuum_failures.inc()
+
+    @metrics.timed("flatcoin_blockstore_get_seconds", "Time spent reading blocks from the store")
+    def get_bytes(self, hash: bytes) -> Optional[bytes]:
+        row = self.connection.execute(SELECT_BY_HASH, (hash,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get(self, hash: bytes) -> Optional[Block]:
+        block_bytes = self.get_bytes(hash)
+        return Block.deserialize(block_bytes) if block_bytes is not None else None
+
+    @metrics.timed("flatcoin_blockstore_get_seconds", "Time spent reading blocks from the store")
+    def get_bytes_by_height(self, height: int) -> Optional[bytes]:
+        row = self.connection.execute(SELECT_BY_HEIGHT, (height,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_by_height(self, height: int) -> Optional[Block]:
+        block_bytes = self.get_bytes_by_height(height)
+        return Block.deserialize(block_bytes) if block_bytes is not None else None
+
+    # views decode only the header until transactions are asked for
+    def get_view(self, hash: bytes) -> Optional[BlockView]:
+        block_bytes = self.get_bytes(hash)
+        return BlockView(block_bytes) if block_bytes is not None else None
+
+    def get_view_by_height(self, height: int) -> Optional[BlockView]:
+        block_bytes = self.get_bytes_by_height(height)
+        return BlockView(block_bytes) if block_bytes is not None else None
+
+    def contains(self, hash: bytes) -> bool:
+        return self.connection.execute(SELECT_CONTAINS, (hash,)).fetchone() is not None
+
+    def __contains__(self, hash: bytes) -> bool:
+        return self.contains(hash)
+
+    def tip(self) -> Optional[Tuple[int, bytes]]:
+        return self.connection.execute(SELECT_TIP).fetchone()
+
+    def remove(self, hash: bytes) -> None:
+        self.remove_many([hash])
+
+    def remove_many(self, hashes: Iterable[bytes]) -> None:
+        hashes = [(hash,) for hash in hashes]
+        with self.connection:
+            self.connection.executemany(DELETE_BLOCK, hashes)
+            self.connection.executemany(DELETE_UNDO, hashes)
+            self.connection.executemany(DELETE_HEADER, hashes)
+
     def items(self) -> List[Any]:
         cursor = self.connection.execute("""
-            
-            SELECT block_bytes FROM chain
-                                             
+
+            SELECT block_bytes FROM chain ORDER BY height
+
         """)
         items = cursor.fetchall()
         return items
-    
+
     def item_count(self) -> int:
-        return len(self.items())
-        
-        
+        (count,) = self.connection.execute(SELECT_COUNT).fetchone()
+        return count
+
+    def stored_bytes(self) -> int:
+        # block bodies only
+        (size,) = self.connection.execute(SELECT_STORED_BYTES).fetchone()
+        return size
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class FlatFileBlockStore(BlockStore):
+
+    # Block bodies live in append-only segment files (see flatcoin.blockfiles)
+    # and the chain table only maps (hash, height) to their location, so each
+    # block is written exactly once and counts/tip come from the index.
+
+    # version 3 added the main_chain and undo tables, 4 pruned_headers, 5
+    # replaced pruned_headers with headers
+    schema_version = 5
+    keyed_version = 2
+
+    def __init__(self, path: str, blocks_directory: str, max_file_size: int = DEFAULT_MAX_BLOCK_FILE_SIZE):
+        self.files = BlockFiles(blocks_directory, max_file_size)
+        # imported by a migration, deleted once it has committed
+        self.legacy_block_files: List[str] = []
+        super().__init__(path)
+
+    def _create_tables(self) -> None:
+        self.connection.execute("""
+
+            CREATE TABLE IF NOT EXISTS chain (
+                hash BLOB PRIMARY KEY,
+                height INTEGER NOT NULL,
+                file INTEGER NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            ) WITHOUT ROWID
+
+        """)
+        self.connection.execute("""
+
+            CREATE INDEX IF NOT EXISTS chain_height ON chain (height)
+
+        """)
+        self._create_chain_tables()
+
+    def _migrate(self, version: int) -> None:
+        if version >= self.keyed_version:
+            super()._migrate(version)
+            return
+
+        legacy = self._legacy_block_files()
+        super()._migrate(version)
+        self._import_legacy_block_files(legacy)
+        self.connection.execute(FILL_MAIN_CHAIN)
+        self._fill_headers()
+
+    def _legacy_block_files(self) -> List[Tuple[str, int, bytes]]:
+        # blocks used to be written a second time as one "%08d-<hash>" file
+        # each; (path, height, hash) of those, all checked to decode
+        legacy = []
+        for entry in os.scandir(self.files.directory):
+            match = LEGACY_BLOCK_FILE_PATTERN.match(entry.name)
+            if match is not None and entry.is_file():
+                with open(entry.path, "rb") as f:
+                    decode_legacy_block(f.read())
+                legacy.append((entry.path, int(match.group(1)), bytes.fromhex(match.group(2))))
+        return sorted(legacy, key=lambda item: item[1])
+
+    def _import_legacy_block_files(self, legacy: List[Tuple[str, int, bytes]]) -> None:
+        # anything missing from the old table is picked up; the files go
+        # once the migration has committed
+        for (path, height, hash) in legacy:
+            if not self.contains(hash):
+                with open(path, "rb") as f:
+                    self._insert_rows([(hash, height, f.read())])
+
+        self.files.sync()
+        self.legacy_block_files = [path for (path, _, _) in legacy]
+
+    def _migration_committed(self) -> None:
+        for path in self.legacy_block_files:
+            os.remove(path)
+        self.legacy_block_files = []
+
+    def _insert_rows(self, blocks: Iterable[Tuple[bytes, int, bytes]]) -> None:
+        rows = []
+        seen = set()
+        for (hash, height, block_bytes) in blocks:
+            if hash in seen or self.contains(hash):
+                continue
+            seen.add(hash)
+            (file_number, offset) = self.files.append(block_bytes)
+            rows.append((hash, height, file_number, offset, len(block_bytes)))
+
+        # the index must never point at bytes that are not on disk yet
+        self.files.sync()
+        self.connection.executemany(INSERT_LOCATION, rows)
+
+    def _read(self, row: Optional[Tuple[int, int, int]]) -> Optional[memoryview]:
+        if row is None:
+            return None
+        (file_number, offset, length) = row
+        return self.files.read(file_number, offset, length)
+
+    @metrics.timed("flatcoin_blockstore_get_seconds", "Time spent reading blocks from the store")
+    def get_bytes(self, hash: bytes) -> Optional[memoryview]:
+        return self._read(self.connection.execute(SELECT_LOCATION_BY_HASH, (hash,)).fetchone())
+
+    @metrics.timed("flatcoin_blockstore_get_seconds", "Time spent reading blocks from the store")
+    def get_bytes_by_height(self, height: int) -> Optional[memoryview]:
+        return self._read(self.connection.execute(SELECT_LOCATION_BY_HEIGHT, (height,)).fetchone())
+
+    def items(self) -> List[Any]:
+        cursor = self.connection.execute("""
+
+            SELECT file, offset, length FROM chain ORDER BY height
+
+        """)
+        return [(self._read(row),) for row in cursor.fetchall()]
+
+    def _sizes_by_height(self) -> Iterable[Tuple[int, int]]:
+        return self.connection.execute(SELECT_LOCATION_SIZE_BY_HEIGHT)
+
+    def stored_bytes(self) -> int:
+        (size,) = self.connection.execute(SELECT_STORED_LOCATION_BYTES).fetchone()
+        return size
+
+    def min_prune_bytes(self) -> int:
+        # space goes a whole segment at a time and the one being written
+        # never goes, so the newest blocks always take up to a segment
+        return self.files.max_file_size
+
+    def prune(self, height: int) -> int:
+        # segment files are only deleted once no block in them is left; one
+        # that also holds newer blocks stays until those are pruned too
+        pruned = super().prune(height)
+        if pruned:
+            in_use = {file_number for (file_number,) in self.connection.execute(SELECT_FILES_IN_USE)}
+            for file_number in self.files.file_numbers():
+                if file_number not in in_use:
+                    self.files.remove(file_number)
+        return pruned
+
+    def close(self) -> None:
+        self.files.close()
+        super().close()
+
+
 CHAIN_DIRECTORY = "chain-state"
 
 class DefaultBlockStore:
-    create_chain_directory()
-    instance = BlockStore(f"{CHAIN_DIRECTORY}/chain-cache.db")
\ No newline at end of file
+
+    # the store in the working directory, opened on first use rather than at
+    # import since opening an old store migrates it; max_file_size only
+    # counts for the call that opens it
+    instance: Optional[FlatFileBlockStore] = None
+
+    @classmethod
+    def get(cls, max_file_size: int = DEFAULT_MAX_BLOCK_FILE_SIZE) -> FlatFileBlockStore:
+        if cls.instance is None:
+            create_chain_directory()
+            cls.instance = FlatFileBlockStore(
+                f"{CHAIN_DIRECTORY}/chain-cache.db", f"{CHAIN_DIRECTORY}/blocks", max_file_size
+            )
+        return cls.instance
+
@@ -1,9 +1,14 @@
 from flatcoin.coinstate import CoinState
 from flatcoin.reading import computer
 import time
+from typing import Optional
 from flatcoin.block import Block, BlockHeader, BlockSummary
 from flatcoin.transaction import Transaction, Input, Output, OutputReference
 from flatcoin.hash import sha256d
+from flatcoin.merkle import merkle_root
+from flatcoin.consensus import target_threshold
+from flatcoin.mining import NONCE_SPACE, search_nonces
+from flatcoin.params import BLOCK_REWARD, DEFAULT_TARGET
 
 
 just_believe_in_me = (
@@ -29,25 +34,41 @@ genesis_block_data = computer(
 )
 
 
-def create_genesis_block(coinbase_value: int, public_key: bytes) -> Block:
+# the network's genesis block is fixed, so independently started nodes agree
+# on it; the reward goes to the key of the original genesis block
+NETWORK_GENESIS_TIMESTAMP = 1_650_000_000
+NETWORK_GENESIS_PUBLIC_KEY = genesis_block_data[-64:]
+NETWORK_GENESIS_NONCE = 35816
+NETWORK_GENESIS_HASH = bytes.fromhex("00009ecad270fd82ae48ee8e83e5802a091dcdd6ba32acb572860b1bc7d73c63")
+
+
+def create_genesis_block(
+    coinbase_value: int,
+    public_key: bytes,
+    target: int = DEFAULT_TARGET,
+    timestamp: Optional[int] = None,
+    nonce: Optional[int] = None,
+) -> Block:
+    # target becomes the network's: every later block has to meet it. Without
+    # a nonce the block is mined here
     fake_prev_hash = b"\x00" * 32
     coinbase_input = Input(OutputReference(fake_prev_hash, 0xffffffff), b"\x00" * 64)
     coinbase_output = Output(coinbase_value, public_key)
     coinbase_tx = Transaction([coinbase_input], [coinbase_output], None)
 
-    timestamp = int(time.time())
+    if timestamp is None:
+        timestamp = int(time.time())
     height = 0
     previous_block_hash = b"\x00" * 32
-    nonce = 0
-    target = 0xffff
 
     header_summary = BlockSummary(
         timestamp=timestamp,
         height=height,
         block_hash=b"\x00" * 32,  
-        nonce=nonce,
+        nonce=0,
         target=target,
         previous_block_hash=previous_block_hash,
+        merkle_root_hash=merkle_root([coinbase_tx.hash()]),
     )
 
     header = BlockHeader(summary=header_summary)
@@ -56,4 +77,23 @@ def create_genesis_block(coinbase_value: int, public_key: bytes) -> Block:
     block_hash = sha256d(genesis_block.serialize())
     genesis_block.header.summary.block_hash = block_hash
     
+    if nonce is None:
+        # mined like any other block, so it meets the target it sets
+        (nonce, _) = search_nonces(
+            genesis_block.header.serialize(), header_summary.nonce_offset(), target_threshold(target), 0, NONCE_SPACE
+        )
+        if nonce is None:
+            raise ValueError("Nonce space exhausted")
+    header_summary.nonce = nonce
+    genesis_block.invalidate()
+    
     return genesis_block
+
+
+def network_genesis_block() -> Block:
+    genesis = create_genesis_block(
+        BLOCK_REWARD, NETWORK_GENESIS_PUBLIC_KEY, DEFAULT_TARGET, NETWORK_GENESIS_TIMESTAMP, NETWORK_GENESIS_NONCE
+    )
+    if genesis.hash() != NETWORK_GENESIS_HASH:
+        raise ValueError("Network genesis block does not match its hash")
+    return genesis
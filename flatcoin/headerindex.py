@@ -0,0 +1,244 @@
+from array import array
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from flatcoin.block import BlockHeader
+
+if TYPE_CHECKING:
+    from flatcoin.database import BlockStore
+
+
+NO_SLOT = -1
+
+# status flags per slot
+HAVE_DATA = 1
+INVALID = 2
+
+
+def block_work(target: int) -> int:
+    # expected number of hashes for a header to meet target, in units of
+    # 2**224 hashes so it fits a 64 bit counter: a hash passes with
+    # probability (target + 1) / 2**32 after the TARGET_SHIFT
+    return (1 << 32) // (target + 1)
+
+
+def _invert_lowest_one(n: int) -> int:
+    return n & (n - 1)
+
+
+def skip_height(height: int) -> int:
+    # the height the skip pointer of a header at this height jumps to; any
+    # ancestor is reached in O(log n) steps by mixing skips and parent links
+    if height < 2:
+        return 0
+    if height & 1:
+        return _invert_lowest_one(_invert_lowest_one(height - 1)) + 1
+    return _invert_lowest_one(height)
+
+
+class HeaderIndex:
+
+    # Every known header gets a slot, and each field lives in its own flat
+    # array indexed by slot, so a header costs a fixed ~80 bytes plus its
+    # entry in slot_by_hash:
+    #   hashes       32 bytes per slot
+    #   heights      height of the header
+    #   timestamps   BlockSummary.timestamp
+    #   targets      BlockSummary.target
+    #   parents      slot of the previous header, NO_SLOT for genesis
+    #   skips        slot of the ancestor at skip_height(height)
+    #   chainwork    cumulative block_work up to and including this header
+    #   status       HAVE_DATA once the block is stored, INVALID once it
+    #                or an ancestor failed to connect
+    # main_chain maps height -> slot along the active chain ending at tip.
+
+    def __init__(self):
+        self.hashes = bytearray()
+        self.heights = array("q")
+        self.timestamps = array("Q")
+        self.targets = array("L")
+        self.parents = array("q")
+        self.skips = array("q")
+        self.chainwork = array("Q")
+        self.status = array("B")
+
+        self.slot_by_hash: Dict[bytes, int] = {}
+        self.main_chain = array("q")
+        self.tip = NO_SLOT
+        # slot with the most cumulative work, the fork choice candidate
+        self.best = NO_SLOT
+
+    @classmethod
+    def from_store(cls, disk: "BlockStore") -> "HeaderIndex":
+        # reads the store's headers table only, never a block body; headers
+        # come back in height order, side branches and pruned blocks
+        # included, and the tip is wherever the store's main chain ends
+        index = cls()
+        for (hash, header_bytes, has_data) in disk.header_items():
+            slot = index.add(BlockHeader.deserialize(header_bytes), hash)
+            if has_data:
+                index.status[slot] |= HAVE_DATA
+
+        tip = disk.tip()
+        if tip is not None:
+            index.set_tip(index.slot_by_hash[tip[1]])
+        return index
+
+    def __len__(self) -> int:
+        return len(self.heights)
+
+    def __contains__(self, hash: bytes) -> bool:
+        return hash in self.slot_by_hash
+
+    def slot_of(self, hash: bytes) -> Optional[int]:
+        return self.slot_by_hash.get(hash)
+
+    def add(self, header: BlockHeader, hash: Optional[bytes] = None) -> int:
+        if hash is None:
+            hash = header.hash()
+
+        slot = self.slot_by_hash.get(hash)
+        if slot is not None:
+            return slot
+
+        summary = header.summary
+        status = 0
+        if summary.height == 0:
+            parent = NO_SLOT
+            previous_work = 0
+        else:
+            found = self.slot_by_hash.get(summary.previous_block_hash)
+            if found is None:
+                raise ValueError(f"Parent of header at height {summary.height} is not in the index")
+            if self.heights[found] != summary.height - 1:
+                raise ValueError(f"Header at height {summary.height} does not follow its parent")
+            parent = found
+            previous_work = self.chainwork[parent]
+            status = self.status[parent] & INVALID
+
+        slot = len(self.heights)
+        self.hashes += hash
+        self.heights.append(summary.height)
+        self.timestamps.append(summary.timestamp)
+        self.targets.append(summary.target)
+        self.parents.append(parent)
+        self.skips.append(self.ancestor(parent, skip_height(summary.height)) if parent != NO_SLOT else NO_SLOT)
+        self.chainwork.append(previous_work + block_work(summary.target))
+        self.status.append(status)
+        self.slot_by_hash[hash] = slot
+
+        if not status and (self.best == NO_SLOT or self.chainwork[slot] > self.chainwork[self.best]):
+            self.best = slot
+
+        return slot
+
+    def has_data(self, slot: int) -> bool:
+        return bool(self.status[slot] & HAVE_DATA)
+
+    def is_invalid(self, slot: int) -> bool:
+        return bool(self.status[slot] & INVALID)
+
+    def mark_pruned(self, height: int) -> None:
+        # the bodies of every block below height are gone
+        for slot in range(len(self.heights)):
+            if self.heights[slot] < height:
+                self.status[slot] &= ~HAVE_DATA
+
+    def mark_invalid(self, slot: int) -> None:
+        # descendants added later inherit the flag from their parent; ones
+        # already known are found by walking every later slot, which is rare
+        # enough not to need a child index
+        self.status[slot] |= INVALID
+        for later in range(slot + 1, len(self.heights)):
+            parent = self.parents[later]
+            if parent != NO_SLOT and self.status[parent] & INVALID:
+                self.status[later] |= INVALID
+
+        if self.status[self.best] & INVALID:
+            valid = [candidate for candidate in range(len(self.heights)) if not self.status[candidate] & INVALID]
+            self.best = max(valid, key=lambda candidate: self.chainwork[candidate]) if valid else NO_SLOT
+
+    def hash_at(self, slot: int) -> bytes:
+        return bytes(self.hashes[32 * slot:32 * slot + 32])
+
+    def ancestor(self, slot: int, height: int) -> int:
+        if slot == NO_SLOT or height < 0 or height > self.heights[slot]:
+            return NO_SLOT
+
+        heights = self.heights
+        while heights[slot] != height:
+            skip = self.skips[slot]
+            skip_to = skip_height(heights[slot])
+            previous_skip_to = skip_height(heights[slot] - 1)
+            # take the skip unless it overshoots; when the parent's skip lands
+            # closer to the target than ours, step to the parent instead
+            if skip != NO_SLOT and (
+                skip_to == height
+                or (skip_to > height and not (previous_skip_to < skip_to - 2 and previous_skip_to >= height))
+            ):
+                slot = skip
+            else:
+                slot = self.parents[slot]
+        return slot
+
+    def set_tip(self, slot: int) -> None:
+        # rewrites main_chain from the fork point with the old tip upwards
+        height = self.heights[slot]
+        del self.main_chain[height + 1:]
+        while len(self.main_chain) <= height:
+            self.main_chain.append(NO_SLOT)
+
+        while slot != NO_SLOT and self.main_chain[self.heights[slot]] != slot:
+            self.main_chain[self.heights[slot]] = slot
+            slot = self.parents[slot]
+
+        self.tip = self.main_chain[height]
+
+    @property
+    def tip_height(self) -> int:
+        return len(self.main_chain) - 1
+
+    def slot_at_height(self, height: int) -> Optional[int]:
+        if 0 <= height < len(self.main_chain):
+            return self.main_chain[height]
+        return None
+
+    def hash_at_height(self, height: int) -> Optional[bytes]:
+        slot = self.slot_at_height(height)
+        return self.hash_at(slot) if slot is not None else None
+
+    def is_on_main_chain(self, hash: bytes) -> bool:
+        slot = self.slot_by_hash.get(hash)
+        return slot is not None and self.slot_at_height(self.heights[slot]) == slot
+
+    def fork_point(self, a: int, b: int) -> int:
+        # last common ancestor of two slots
+        if self.heights[a] > self.heights[b]:
+            a = self.ancestor(a, self.heights[b])
+        elif self.heights[b] > self.heights[a]:
+            b = self.ancestor(b, self.heights[a])
+
+        while a != b:
+            if self.skips[a] != self.skips[b]:
+                (a, b) = (self.skips[a], self.skips[b])
+            else:
+                (a, b) = (self.parents[a], self.parents[b])
+        return a
+
+    def locator(self, slot: Optional[int] = None) -> List[bytes]:
+        # the last 10 hashes back from slot, then exponentially sparser, always
+        # ending at genesis; enough for a peer to find where chains diverge
+        if slot is None:
+            slot = self.tip
+
+        hashes: List[bytes] = []
+        step = 1
+        while slot != NO_SLOT:
+            hashes.append(self.hash_at(slot))
+            height = self.heights[slot]
+            if height == 0:
+                break
+
+            if len(hashes) >= 10:
+                step *= 2
+            slot = self.ancestor(slot, max(height - step, 0))
+        return hashes
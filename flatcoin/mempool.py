@@ -0,0 +1,262 @@
+import heapq
+from itertools import count
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from flatcoin.block import Block
+from flatcoin.coinstate import CoinState, is_coinbase_transaction
+from flatcoin.consensus import validate_transaction
+from flatcoin.params import MAX_BLOCK_SIZE
+from flatcoin.reading import human
+from flatcoin.signatures import SignatureVerifier
+from flatcoin.transaction import Output, OutputReference, Transaction
+
+
+DEFAULT_MEMPOOL_MAX_BYTES = 32 * 1024 * 1024
+
+
+class MempoolError(Exception):
+    pass
+
+
+class MempoolEntry:
+
+    def __init__(self, transaction: Transaction, transaction_hash: bytes, fee: int, size: int, sequence: int):
+        self.transaction = transaction
+        self.transaction_hash = transaction_hash
+        self.fee = fee
+        self.size = size
+        self.fee_rate = fee / size
+        # admission order, breaks fee rate ties in favour of older entries
+        self.sequence = sequence
+        # unconfirmed parents this entry spends from
+        self.parents: Set[bytes] = set()
+
+
+class Mempool:
+
+    # Unconfirmed transactions, indexed three ways:
+    #   entries           tx hash -> MempoolEntry
+    #   spends            OutputReference -> hash of the entry spending it,
+    #                     for O(1) double spend and conflict detection
+    #   by_fee_rate /     max- and min-heaps on fee rate for block templates
+    #   by_low_fee_rate   and eviction; removals are lazy, stale heap items
+    #                     are skipped when they surface
+
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_MEMPOOL_MAX_BYTES,
+        verifier: Optional[SignatureVerifier] = None,
+    ):
+        self.max_bytes = max_bytes
+        self.verifier = verifier
+
+        self.entries: Dict[bytes, MempoolEntry] = {}
+        self.spends: Dict[OutputReference, bytes] = {}
+        self.by_fee_rate: List[Tuple[float, int, bytes]] = []
+        self.by_low_fee_rate: List[Tuple[float, int, bytes]] = []
+        self.total_bytes = 0
+
+        self.sequence = count()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, transaction_hash: bytes) -> bool:
+        return transaction_hash in self.entries
+
+    def get(self, transaction_hash: bytes) -> Optional[Transaction]:
+        entry = self.entries.get(transaction_hash)
+        return entry.transaction if entry is not None else None
+
+    def transactions(self) -> Iterator[Transaction]:
+        return (entry.transaction for entry in self.entries.values())
+
+    def add(self, transaction: Transaction, coinstate: CoinState) -> MempoolEntry:
+        transaction_hash = transaction.hash()
+
+        if transaction_hash in self.entries:
+            raise MempoolError(f"Transaction {human(transaction_hash)} is already in the mempool")
+
+        if is_coinbase_transaction(transaction):
+            raise MempoolError("Coinbase transactions are only valid in blocks")
+
+        if not validate_transaction(transaction):
+            raise MempoolError(f"Transaction {human(transaction_hash)} failed validation")
+
+        spent: Dict[OutputReference, Output] = {}
+        parents: Set[bytes] = set()
+
+        for inp in transaction.inputs:
+            reference = inp.output_reference
+
+            if reference in spent:
+                raise MempoolError(f"Transaction {human(transaction_hash)} spends {human(reference.tx_hash)}:{reference.index} twice")
+
+            conflict = self.spends.get(reference)
+            if conflict is not None:
+                raise MempoolError(f"Input {human(reference.tx_hash)}:{reference.index} is already spent by {human(conflict)}")
+
+            output = self._unconfirmed_output(reference)
+            if output is not None:
+                parents.add(reference.tx_hash)
+            else:
+                output = coinstate.unspent_transaction_outs.get(reference)
+
+            if output is None:
+                raise MempoolError(f"Input {human(reference.tx_hash)}:{reference.index} not found or already spent")
+
+            spent[reference] = output
+
+        fee = sum(output.value for output in spent.values()) - sum(output.value for output in transaction.outputs)
+        if fee < 0:
+            raise MempoolError(f"Transaction {human(transaction_hash)} spends more than its inputs")
+
+        if self.verifier is not None and not self.verifier.verify_transaction(transaction, spent):
+            raise MempoolError(f"Transaction {human(transaction_hash)} has an invalid or missing signature")
+
+        entry = MempoolEntry(transaction, transaction_hash, fee, transaction.serialized_size(), next(self.sequence))
+        entry.parents = parents
+        self._insert(entry)
+
+        self._trim()
+        if transaction_hash not in self.entries:
+            raise MempoolError("Mempool is full and the transaction fee rate is too low")
+
+        return entry
+
+    def _unconfirmed_output(self, reference: OutputReference) -> Optional[Output]:
+        entry = self.entries.get(reference.tx_hash)
+        if entry is None or reference.index >= len(entry.transaction.outputs):
+            return None
+        return entry.transaction.outputs[reference.index]
+
+    def _insert(self, entry: MempoolEntry) -> None:
+        self.entries[entry.transaction_hash] = entry
+        for inp in entry.transaction.inputs:
+            self.spends[inp.output_reference] = entry.transaction_hash
+
+        heapq.heappush(self.by_fee_rate, (-entry.fee_rate, entry.sequence, entry.transaction_hash))
+        heapq.heappush(self.by_low_fee_rate, (entry.fee_rate, entry.sequence, entry.transaction_hash))
+        self.total_bytes += entry.size
+
+    def _is_live(self, item: Tuple[float, int, bytes]) -> bool:
+        entry = self.entries.get(item[2])
+        return entry is not None and entry.sequence == item[1]
+
+    def remove(self, transaction_hash: bytes, with_descendants: bool = True) -> List[Transaction]:
+        removed: List[Transaction] = []
+        pending = [transaction_hash]
+
+        while pending:
+            entry = self.entries.pop(pending.pop(), None)
+            if entry is None:
+                continue
+
+            for inp in entry.transaction.inputs:
+                if self.spends.get(inp.output_reference) == entry.transaction_hash:
+                    del self.spends[inp.output_reference]
+
+            for index in range(len(entry.transaction.outputs)):
+                child = self.spends.get(OutputReference(entry.transaction_hash, index))
+                if child is None:
+                    continue
+                if with_descendants:
+                    pending.append(child)
+                else:
+                    # the parent got confirmed, the child now spends a real coin
+                    self.entries[child].parents.discard(entry.transaction_hash)
+
+            self.total_bytes -= entry.size
+            removed.append(entry.transaction)
+
+        self._compact()
+        return removed
+
+    def _compact(self) -> None:
+        # stale heap items are only dropped when they reach the top; rebuild
+        # once they make up most of the heap so memory stays proportional
+        if len(self.by_fee_rate) > 2 * len(self.entries) + 64:
+            self.by_fee_rate = [item for item in self.by_fee_rate if self._is_live(item)]
+            self.by_low_fee_rate = [item for item in self.by_low_fee_rate if self._is_live(item)]
+            heapq.heapify(self.by_fee_rate)
+            heapq.heapify(self.by_low_fee_rate)
+
+    def _trim(self) -> None:
+        while self.total_bytes > self.max_bytes and self.by_low_fee_rate:
+            item = heapq.heappop(self.by_low_fee_rate)
+            if self._is_live(item):
+                self.remove(item[2])
+
+    def block_connected(self, block: Block) -> None:
+        for transaction in block.transactions:
+            transaction_hash = transaction.hash()
+
+            if transaction_hash in self.entries:
+                self.remove(transaction_hash, with_descendants=False)
+                continue
+
+            if is_coinbase_transaction(transaction):
+                continue
+
+            for inp in transaction.inputs:
+                conflict = self.spends.get(inp.output_reference)
+                if conflict is not None:
+                    self.remove(conflict)
+
+    def reorganized(self, disconnected: List[Block], coinstate: CoinState) -> None:
+        # disconnected are the blocks that left the main chain, oldest first,
+        # and coinstate is the UTXO set on the new branch. Their transactions
+        # are offered again; entries whose inputs the new branch no longer
+        # has are dropped, and entries spending a transaction that is
+        # unconfirmed again get it back as a parent.
+        for block in disconnected:
+            for transaction in block.transactions:
+                if is_coinbase_transaction(transaction) or transaction.hash() in self.entries:
+                    continue
+                try:
+                    self.add(transaction, coinstate)
+                except MempoolError:
+                    continue
+
+        for entry in list(self.entries.values()):
+            if entry.transaction_hash not in self.entries:
+                continue
+            for inp in entry.transaction.inputs:
+                reference = inp.output_reference
+                if self._unconfirmed_output(reference) is not None:
+                    entry.parents.add(reference.tx_hash)
+                elif coinstate.unspent_transaction_outs.get(reference) is None:
+                    self.remove(entry.transaction_hash)
+                    break
+
+    def select_transactions(self, max_bytes: int = int(MAX_BLOCK_SIZE)) -> List[Transaction]:
+        # highest fee rate first, but an entry is only taken after all of its
+        # unconfirmed parents; children are parked until then
+        heap = [item for item in self.by_fee_rate if self._is_live(item)]
+        heapq.heapify(heap)
+
+        selected: List[Transaction] = []
+        included: Set[bytes] = set()
+        waiting: Dict[bytes, List[Tuple[float, int, bytes]]] = {}
+        size = 0
+
+        while heap:
+            item = heapq.heappop(heap)
+            entry = self.entries[item[2]]
+
+            missing = entry.parents - included
+            if missing:
+                waiting.setdefault(next(iter(missing)), []).append(item)
+                continue
+
+            if size + entry.size > max_bytes:
+                continue
+
+            selected.append(entry.transaction)
+            included.add(entry.transaction_hash)
+            size += entry.size
+
+            for child in waiting.pop(entry.transaction_hash, []):
+                heapq.heappush(heap, child)
+
+        return selected
@@ -0,0 +1,190 @@
+from typing import BinaryIO, Dict, List, Optional, Sequence
+
+from flatcoin import metrics
+from flatcoin.hash import sha256d
+from flatcoin.serialization import (
+    Serializable,
+    safe_read,
+    stream_deserialize_vlq,
+    stream_serialize_vlq,
+)
+
+
+EMPTY_MERKLE_ROOT = b"\x00" * 32
+
+
+# A node is sha256d(left + right). A node without a right sibling is carried
+# up to the next level unchanged instead of being paired with a copy of
+# itself, so two different transaction lists never share a root.
+
+# sha256d itself is too cheap to time call by call; a whole tree is not
+@metrics.timed("flatcoin_merkle_root_seconds", "Time spent hashing merkle trees")
+def merkle_root(leaves: Sequence[bytes]) -> bytes:
+    if not leaves:
+        return EMPTY_MERKLE_ROOT
+
+    level = list(leaves)
+    while len(level) > 1:
+        paired = [sha256d(level[i] + level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) & 1:
+            paired.append(level[-1])
+        level = paired
+    return level[0]
+
+
+class MerkleProof(Serializable):
+
+    # the sibling hashes from the leaf up to the root; which side each one is
+    # on, and which levels have no sibling, follow from index and count
+
+    def __init__(self, index: int, count: int, hashes: List[bytes]):
+        self.index = index
+        self.count = count
+        self.hashes = hashes
+
+    def stream_serialize(self, f: BinaryIO) -> None:
+        stream_serialize_vlq(f, self.index)
+        stream_serialize_vlq(f, self.count)
+        stream_serialize_vlq(f, len(self.hashes))
+        for hash in self.hashes:
+            f.write(hash)
+
+    @classmethod
+    def stream_deserialize(cls, f: BinaryIO) -> "MerkleProof":
+        index = stream_deserialize_vlq(f)
+        count = stream_deserialize_vlq(f)
+        n_hashes = stream_deserialize_vlq(f)
+        hashes = [safe_read(f, 32) for _ in range(n_hashes)]
+        return cls(index, count, hashes)
+
+
+def verify_merkle_proof(leaf: bytes, proof: MerkleProof, root: bytes) -> bool:
+    if not 0 <= proof.index < proof.count:
+        return False
+
+    node = leaf
+    index = proof.index
+    count = proof.count
+    hashes = iter(proof.hashes)
+    used = 0
+
+    while count > 1:
+        if index & 1:
+            sibling = next(hashes, None)
+            if sibling is None:
+                return False
+            node = sha256d(sibling + node)
+            used += 1
+        elif index + 1 < count:
+            sibling = next(hashes, None)
+            if sibling is None:
+                return False
+            node = sha256d(node + sibling)
+            used += 1
+
+        index >>= 1
+        count = (count + 1) >> 1
+
+    return used == len(proof.hashes) and node == root
+
+
+class MerkleTree:
+
+    # Keeps every level, levels[0] being the leaves. Changing, appending or
+    # removing leaves only rehashes the parents of the positions that moved,
+    # so a block template that gains a transaction or gets a new coinbase
+    # costs O(log n) hashes instead of rebuilding the tree.
+
+    def __init__(self, leaves: Optional[Sequence[bytes]] = None):
+        self.levels: List[List[bytes]] = [list(leaves) if leaves is not None else []]
+        self.positions: Dict[bytes, int] = {}
+        self._index_from(0)
+        self._rehash(0, len(self.levels[0]))
+
+    def __len__(self) -> int:
+        return len(self.levels[0])
+
+    @property
+    def leaves(self) -> List[bytes]:
+        return self.levels[0]
+
+    @property
+    def root(self) -> bytes:
+        top = self.levels[-1]
+        return top[0] if top else EMPTY_MERKLE_ROOT
+
+    def _index_from(self, start: int) -> None:
+        leaves = self.levels[0]
+        for index in range(start, len(leaves)):
+            self.positions[leaves[index]] = index
+
+    def _rehash(self, start: int, stop: int) -> None:
+        # recomputes the parents of positions [start, stop) level by level;
+        # stop may run past the end when leaves were removed
+        depth = 0
+        while len(self.levels[depth]) > 1:
+            level = self.levels[depth]
+            if depth + 1 == len(self.levels):
+                self.levels.append([])
+            parents = self.levels[depth + 1]
+
+            parent_count = (len(level) + 1) >> 1
+            del parents[parent_count:]
+
+            start >>= 1
+            stop = min((stop + 1) >> 1, parent_count)
+            for index in range(start, stop):
+                left = 2 * index
+                node = sha256d(level[left] + level[left + 1]) if left + 1 < len(level) else level[left]
+                if index < len(parents):
+                    parents[index] = node
+                else:
+                    parents.append(node)
+
+            depth += 1
+
+        del self.levels[depth + 1:]
+
+    def set_leaf(self, index: int, leaf: bytes) -> None:
+        leaves = self.levels[0]
+        if self.positions.get(leaves[index]) == index:
+            del self.positions[leaves[index]]
+        leaves[index] = leaf
+        self.positions[leaf] = index
+        self._rehash(index, index + 1)
+
+    def append(self, leaf: bytes) -> None:
+        leaves = self.levels[0]
+        leaves.append(leaf)
+        self.positions[leaf] = len(leaves) - 1
+        self._rehash(len(leaves) - 1, len(leaves))
+
+    def remove(self, index: int) -> bytes:
+        # everything right of index shifts down one place and is rehashed
+        leaves = self.levels[0]
+        leaf = leaves.pop(index)
+        if self.positions.get(leaf) == index:
+            del self.positions[leaf]
+        self._index_from(index)
+        self._rehash(index, len(leaves) + 1)
+        return leaf
+
+    def index_of(self, leaf: bytes) -> Optional[int]:
+        return self.positions.get(leaf)
+
+    def proof(self, index: int) -> MerkleProof:
+        if not 0 <= index < len(self.levels[0]):
+            raise IndexError(f"Merkle tree has {len(self.levels[0])} leaves, no index {index}")
+
+        hashes: List[bytes] = []
+        position = index
+        for level in self.levels[:-1]:
+            sibling = position ^ 1
+            if sibling < len(level):
+                hashes.append(level[sibling])
+            position >>= 1
+        return MerkleProof(index, len(self.levels[0]), hashes)
+
+    def merkle_proof(self, tx_hash: bytes) -> Optional[MerkleProof]:
+        index = self.positions.get(tx_hash)
+        return self.proof(index) if index is not None else None
@@ -0,0 +1,346 @@
+import asyncio
+import functools
+import json
+import os
+from bisect import bisect_left
+from collections import deque
+from contextlib import nullcontext
+from time import perf_counter
+from typing import Any, Callable, ContextManager, Deque, Dict, List, Optional, Tuple, TypeVar, Union
+
+
+# Counters, gauges and timing histograms for the hot paths, exported in the
+# Prometheus text format. Everything is registered at import time but
+# records nothing until enable() is called: a disabled timer costs one
+# attribute check and an extra call, a few hundred nanoseconds, so it is
+# kept to functions doing far more work than that and stays in place in
+# production code.
+#
+# With tracing on, every timed call made while a block is being added is
+# also summed per metric into that block's BlockTrace, so a slow block
+# shows where its time went.
+
+# seconds; from one hash of a header up to a large block's signatures
+DEFAULT_BUCKETS = (
+    0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005,
+    0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0,
+)
+
+# slow block traces kept in memory
+MAX_BLOCK_TRACES = 100
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# a scrape that has not sent its request by then is dropped
+HTTP_TIMEOUT = 10.0
+
+
+class _Settings:
+
+    def __init__(self):
+        self.enabled = False
+        self.tracing = False
+        # blocks taking less than this are not kept
+        self.slow_block_seconds = 0.0
+        # where kept traces are appended as JSON lines, if anywhere
+        self.trace_path: Optional[str] = None
+        self.trace: Optional["BlockTrace"] = None
+
+
+settings = _Settings()
+
+
+def enable() -> None:
+    settings.enabled = True
+
+
+def disable() -> None:
+    settings.enabled = False
+    settings.tracing = False
+
+
+def is_enabled() -> bool:
+    return settings.enabled
+
+
+class Counter:
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        if settings.enabled:
+            self.value += amount
+
+    def samples(self) -> List[Tuple[str, Union[int, float]]]:
+        return [(self.name, self.value)]
+
+
+class Gauge:
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value: Union[int, float] = 0
+        # read at export time instead of value when set
+        self.function: Optional[Callable[[], Union[int, float]]] = None
+
+    def set(self, value: Union[int, float]) -> None:
+        self.value = value
+
+    def set_function(self, function: Callable[[], Union[int, float]]) -> None:
+        self.function = function
+
+    def samples(self) -> List[Tuple[str, Union[int, float]]]:
+        if self.function is None:
+            return [(self.name, self.value)]
+        try:
+            return [(self.name, self.function())]
+        except Exception:
+            # whatever the gauge reads from may be closed by now
+            return []
+
+
+class Histogram:
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # one more than buckets, for +Inf; not cumulative until exported
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self) -> List[Tuple[str, Union[int, float]]]:
+        samples: List[Tuple[str, Union[int, float]]] = []
+        cumulative = 0
+        for (bound, count) in zip(self.buckets, self.counts):
+            cumulative += count
+            samples.append((f'{self.name}_bucket{{le="{bound:g}"}}', cumulative))
+        samples.append((f'{self.name}_bucket{{le="+Inf"}}', self.count))
+        samples.append((f"{self.name}_sum", self.sum))
+        samples.append((f"{self.name}_count", self.count))
+        return samples
+
+
+Metric = Union[Counter, Gauge, Histogram]
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def _get(self, cls: type, name: str, help: str) -> Any:
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help)
+        elif not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} is already registered as a {metric.kind}")
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name: str, help: str) -> Histogram:
+        return self._get(Histogram, name, help)
+
+    def render(self) -> str:
+        lines = []
+        for metric in sorted(self.metrics.values(), key=lambda metric: metric.name):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for (sample, value) in metric.samples():
+                lines.append(f"{sample} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name: str, help: str) -> Counter:
+    return registry.counter(name, help)
+
+
+def gauge(name: str, help: str) -> Gauge:
+    return registry.gauge(name, help)
+
+
+def histogram(name: str, help: str) -> Histogram:
+    return registry.histogram(name, help)
+
+
+def render() -> str:
+    return registry.render()
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def timed(name: str, help: str) -> Callable[[F], F]:
+    # decorator recording each call's duration in the histogram name
+    def decorate(function: F) -> F:
+        observed = registry.histogram(name, help)
+        # a closure cell is the cheapest thing to check while disabled
+        state = settings
+
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not state.enabled:
+                return function(*args, **kwargs)
+
+            started = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                seconds = perf_counter() - started
+                observed.observe(seconds)
+                if settings.trace is not None:
+                    settings.trace.add(name, seconds)
+
+        return wrapper  # type: ignore
+
+    return decorate
+
+
+class BlockTrace:
+
+    def __init__(self, height: int, hash: bytes, transactions: int):
+        self.height = height
+        self.hash = hash
+        self.transactions = transactions
+        # metric name -> [calls, seconds]
+        self.spans: Dict[str, List[Union[int, float]]] = {}
+        self.started = perf_counter()
+        self.seconds = 0.0
+
+    def add(self, name: str, seconds: float) -> None:
+        span = self.spans.setdefault(name, [0, 0.0])
+        span[0] += 1
+        span[1] += seconds
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "height": self.height,
+            "hash": self.hash.hex(),
+            "transactions": self.transactions,
+            "seconds": self.seconds,
+            "spans": {name: {"calls": calls, "seconds": seconds} for (name, (calls, seconds)) in self.spans.items()},
+        }
+
+
+block_traces: Deque[BlockTrace] = deque(maxlen=MAX_BLOCK_TRACES)
+
+
+def enable_tracing(slow_block_seconds: float = 0.0, path: Optional[str] = None) -> None:
+    # traces of blocks taking at least slow_block_seconds are kept in
+    # block_traces and appended to path
+    enable()
+    settings.tracing = True
+    settings.slow_block_seconds = slow_block_seconds
+    settings.trace_path = path
+
+
+def trace_block(height: int, hash: bytes, transactions: int) -> ContextManager[Optional[BlockTrace]]:
+    # a trace already running (connect_block inside add_block_with_validation)
+    # collects the inner calls too
+    if not settings.tracing or settings.trace is not None:
+        return nullcontext()
+    return _BlockTraceContext(height, hash, transactions)
+
+
+class _BlockTraceContext:
+
+    def __init__(self, height: int, hash: bytes, transactions: int):
+        self.trace = BlockTrace(height, hash, transactions)
+
+    def __enter__(self) -> BlockTrace:
+        settings.trace = self.trace
+        return self.trace
+
+    def __exit__(self, *exc_info: Any) -> None:
+        settings.trace = None
+        trace = self.trace
+        trace.seconds = perf_counter() - trace.started
+        if trace.seconds < settings.slow_block_seconds:
+            return
+
+        block_traces.append(trace)
+        if settings.trace_path is not None:
+            with open(settings.trace_path, "a") as f:
+                f.write(json.dumps(trace.as_dict()) + "\n")
+
+
+def write_text_file(path: str) -> None:
+    # for the node exporter's textfile collector, which must never see a
+    # half written file
+    temporary_path = f"{path}.new"
+    with open(temporary_path, "w") as f:
+        f.write(render())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+
+
+class MetricsServer:
+
+    # Serves render() at /metrics over plain HTTP/1.0 on the running event
+    # loop. The chain is changed on the node's connect thread, so the gauges
+    # reading it take the chain's lock (see Chain.register_metrics). Port 0
+    # picks a free port, read back from self.port after start().
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> "MetricsServer":
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readline(), HTTP_TIMEOUT)
+            # the headers are read and ignored
+            while (await asyncio.wait_for(reader.readline(), HTTP_TIMEOUT)).strip():
+                pass
+
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/", "/metrics"):
+                (status, content_type, body) = ("200 OK", CONTENT_TYPE, render().encode())
+            else:
+                (status, content_type, body) = ("404 Not Found", "text/plain", b"Not found\n")
+
+            writer.write(
+                f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
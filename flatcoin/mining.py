@@ -0,0 +1,214 @@
+import hashlib
+import multiprocessing
+import os
+import struct
+from multiprocessing.synchronize import Event
+from time import perf_counter, time
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+from flatcoin.block import Block, BlockHeader, BlockSummary
+from flatcoin.consensus import target_threshold
+from flatcoin.params import BLOCK_REWARD, MAX_BLOCK_SIZE
+from flatcoin.transaction import Transaction
+from flatcoin.wallet import create_coinbase_transaction
+
+if TYPE_CHECKING:
+    from flatcoin.chain import Chain
+
+
+NONCE_SPACE = 1 << 32
+
+# how many nonces a worker tries between looks at the shared stop flag
+STOP_CHECK_INTERVAL = 1 << 14
+
+# room left in a template for the header and the coinbase transaction
+TEMPLATE_RESERVED_BYTES = 1_000
+
+pack_nonce = struct.Struct(b">I").pack
+
+
+class WorkerReport:
+
+    def __init__(self, worker: int, hashes: int, seconds: float):
+        self.worker = worker
+        self.hashes = hashes
+        self.seconds = seconds
+
+    @property
+    def hashes_per_second(self) -> float:
+        return self.hashes / self.seconds if self.seconds > 0 else 0.0
+
+
+class MiningResult:
+
+    def __init__(self, block: Block, reports: List[WorkerReport], seconds: float):
+        self.block = block
+        self.reports = reports
+        self.seconds = seconds
+
+    @property
+    def hashes(self) -> int:
+        return sum(report.hashes for report in self.reports)
+
+    @property
+    def hashes_per_second(self) -> float:
+        return self.hashes / self.seconds if self.seconds > 0 else 0.0
+
+
+def create_block_template(chain: "Chain", public_key: bytes, target: Optional[int] = None) -> Block:
+    # target defaults to the chain's; a harder one is allowed, an easier
+    # one would make the block invalid
+    transactions = chain.mempool.select_transactions(int(MAX_BLOCK_SIZE) - TEMPLATE_RESERVED_BYTES)
+    fees = sum(chain.mempool.entries[transaction.hash()].fee for transaction in transactions)
+
+    coinbase_transaction = create_coinbase_transaction(
+        miner_public_key=public_key,
+        reward=BLOCK_REWARD + fees,
+        block_height=chain.height,
+    )
+
+    summary = BlockSummary(
+        timestamp=int(time()),
+        height=chain.height,
+        block_hash=b"\x00" * 32,
+        nonce=0,
+        target=target if target is not None else chain.target,
+        previous_block_hash=chain.tip_hash or b"\x00" * 32,
+        merkle_root_hash=b"\x00" * 32,
+    )
+    block = Block(BlockHeader(summary), [coinbase_transaction] + transactions)
+    summary.merkle_root_hash = block.merkle_root()
+
+    return block
+
+
+def _set_template_reward(block: Block, fee_change: int) -> None:
+    coinbase_transaction = block.transactions[0]
+    output = coinbase_transaction.outputs[0]
+    block.transactions[0] = create_coinbase_transaction(
+        miner_public_key=output.public_key,
+        reward=output.value + fee_change,
+        block_height=block.header.summary.height,
+    )
+    block.merkle_tree().set_leaf(0, block.transactions[0].hash())
+
+
+def add_template_transaction(block: Block, transaction: Transaction, fee: int) -> None:
+    # the coinbase leaf and the new leaf are rehashed, not the whole tree;
+    # the tree is taken before the append, in case it has to be built
+    tree = block.merkle_tree()
+    block.transactions.append(transaction)
+    tree.append(transaction.hash())
+    _set_template_reward(block, fee)
+
+    block.header.summary.merkle_root_hash = block.merkle_root()
+    block.invalidate()
+
+
+def remove_template_transaction(block: Block, transaction_hash: bytes, fee: int) -> None:
+    tree = block.merkle_tree()
+    index = tree.index_of(transaction_hash)
+    if index is None or index == 0:
+        raise ValueError("Transaction is not in the template")
+
+    del block.transactions[index]
+    tree.remove(index)
+    _set_template_reward(block, -fee)
+
+    block.header.summary.merkle_root_hash = block.merkle_root()
+    block.invalidate()
+
+
+def search_nonces(
+    header: bytes,
+    nonce_offset: int,
+    threshold: bytes,
+    start: int,
+    stop: int,
+    stop_flag: Optional[Event] = None,
+) -> Tuple[Optional[int], int]:
+    # everything before the nonce is hashed once and the sha256 state copied
+    # for each attempt, so only the nonce and the bytes after it are rehashed
+    midstate = hashlib.sha256(header[:nonce_offset])
+    suffix = header[nonce_offset + 4:]
+    sha256 = hashlib.sha256
+
+    for batch_start in range(start, stop, STOP_CHECK_INTERVAL):
+        if stop_flag is not None and stop_flag.is_set():
+            return (None, batch_start - start)
+
+        for nonce in range(batch_start, min(batch_start + STOP_CHECK_INTERVAL, stop)):
+            inner = midstate.copy()
+            inner.update(pack_nonce(nonce) + suffix)
+            if sha256(inner.digest()).digest() <= threshold:
+                return (nonce, nonce - start + 1)
+
+    return (None, stop - start)
+
+
+_stop_flag: Optional[Event] = None
+
+
+def _init_worker(stop_flag: Event) -> None:
+    global _stop_flag
+    _stop_flag = stop_flag
+
+
+def _mine_range(args: Tuple[int, bytes, int, bytes, int, int]) -> Tuple[int, Optional[int], int, float]:
+    (worker, header, nonce_offset, threshold, start, stop) = args
+
+    started = perf_counter()
+    (nonce, hashes) = search_nonces(header, nonce_offset, threshold, start, stop, _stop_flag)
+    if nonce is not None and _stop_flag is not None:
+        _stop_flag.set()
+
+    return (worker, nonce, hashes, perf_counter() - started)
+
+
+class Miner:
+
+    def __init__(self, workers: Optional[int] = None):
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+
+        context = multiprocessing.get_context()
+        self.stop_flag = context.Event()
+        self.pool = context.Pool(self.workers, initializer=_init_worker, initargs=(self.stop_flag,))
+
+    def mine(self, block: Block) -> MiningResult:
+        # each worker sweeps its own slice of the 32-bit nonce space; when the
+        # whole space is exhausted the timestamp is rolled and the sweep starts
+        # over on the new header
+        summary = block.header.summary
+        threshold = target_threshold(summary.target)
+        nonce_offset = summary.nonce_offset()
+        slice_size = -(-NONCE_SPACE // self.workers)
+
+        totals = [WorkerReport(worker, 0, 0.0) for worker in range(self.workers)]
+        started = perf_counter()
+
+        while True:
+            header = block.header.serialize()
+            self.stop_flag.clear()
+
+            jobs = [
+                (worker, header, nonce_offset, threshold, worker * slice_size, min((worker + 1) * slice_size, NONCE_SPACE))
+                for worker in range(self.workers)
+            ]
+
+            found: Optional[int] = None
+            for (worker, nonce, hashes, seconds) in self.pool.imap_unordered(_mine_range, jobs):
+                totals[worker].hashes += hashes
+                totals[worker].seconds += seconds
+                if nonce is not None and found is None:
+                    found = nonce
+
+            if found is not None:
+                summary.nonce = found
+                block.invalidate()
+                return MiningResult(block, totals, perf_counter() - started)
+
+            summary.timestamp = max(summary.timestamp + 1, int(time()))
+
+    def close(self) -> None:
+        self.pool.terminate()
+        self.pool.join()
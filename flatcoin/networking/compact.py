@@ -0,0 +1,203 @@
+import struct
+from hashlib import blake2b
+from typing import BinaryIO, Dict, Iterable, List, Optional, Sequence, Set
+
+from flatcoin.block import Block, BlockHeader
+from flatcoin.hash import sha256d
+from flatcoin.serialization import (
+    DeserializationError,
+    Serializable,
+    safe_read,
+    stream_deserialize_list,
+    stream_deserialize_vlq,
+    stream_serialize_list,
+    stream_serialize_vlq,
+)
+from flatcoin.transaction import Transaction
+
+
+# A compact block is the header, a short ID per transaction and the few
+# transactions the receiver cannot have yet (the coinbase). Short IDs are
+# keyed by the block hash and a per-message nonce, so nobody can make two
+# mempool transactions collide in every block ahead of time.
+
+SHORT_ID_SIZE = 6
+
+# more than fits in MAX_PAYLOAD_SIZE anyway; bounds allocation on decode
+MAX_COMPACT_TRANSACTIONS = 500_000
+
+
+def short_id_key(block_hash: bytes, nonce: int) -> bytes:
+    return block_hash + struct.pack(b">Q", nonce)
+
+
+def short_id(key: bytes, transaction_hash: bytes) -> bytes:
+    return blake2b(transaction_hash, digest_size=SHORT_ID_SIZE, key=key).digest()
+
+
+class PrefilledTransaction(Serializable):
+
+    def __init__(self, index: int, transaction: Transaction):
+        # position in the block, not in the short ID list
+        self.index = index
+        self.transaction = transaction
+
+    def stream_serialize(self, f: BinaryIO) -> None:
+        stream_serialize_vlq(f, self.index)
+        f.write(self.transaction.serialize())
+
+    @classmethod
+    def stream_deserialize(cls, f: BinaryIO) -> "PrefilledTransaction":
+        index = stream_deserialize_vlq(f)
+        transaction = Transaction.stream_deserialize(f)
+        return cls(index, transaction)
+
+
+class CompactBlock(Serializable):
+
+    def __init__(
+        self,
+        header: BlockHeader,
+        nonce: int,
+        short_ids: List[bytes],
+        prefilled: List[PrefilledTransaction],
+        hash: Optional[bytes] = None,
+    ):
+        self.header = header
+        self.nonce = nonce
+        self.short_ids = short_ids
+        self.prefilled = prefilled
+        self.cached_hash = hash
+
+    def hash(self) -> bytes:
+        if self.cached_hash is None:
+            self.cached_hash = self.header.hash()
+        return self.cached_hash
+
+    @property
+    def transaction_count(self) -> int:
+        return len(self.short_ids) + len(self.prefilled)
+
+    def key(self) -> bytes:
+        return short_id_key(self.hash(), self.nonce)
+
+    @classmethod
+    def from_block(cls, block: Block, nonce: int, prefill: Sequence[int] = (0,)) -> "CompactBlock":
+        # prefill is the block positions sent in full; the coinbase by default
+        key = short_id_key(block.hash(), nonce)
+        prefilled_indexes = set(index for index in prefill if index < len(block.transactions))
+
+        short_ids = []
+        prefilled = []
+        for (index, transaction) in enumerate(block.transactions):
+            if index in prefilled_indexes:
+                prefilled.append(PrefilledTransaction(index, transaction))
+            else:
+                short_ids.append(short_id(key, transaction.hash()))
+
+        return cls(block.header, nonce, short_ids, prefilled, block.hash())
+
+    def stream_serialize(self, f: BinaryIO) -> None:
+        self.header.stream_serialize(f)
+        f.write(struct.pack(b">Q", self.nonce))
+        stream_serialize_vlq(f, len(self.short_ids))
+        for short in self.short_ids:
+            f.write(short)
+        stream_serialize_list(f, self.prefilled)
+
+    @classmethod
+    def stream_deserialize(cls, f: BinaryIO) -> "CompactBlock":
+        start_position = f.tell()
+        header = BlockHeader.stream_deserialize(f)
+        end_position = f.tell()
+        f.seek(start_position)
+        hash = sha256d(f.read(end_position - start_position))
+
+        (nonce,) = struct.unpack(b">Q", safe_read(f, 8))
+
+        count = stream_deserialize_vlq(f)
+        if count > MAX_COMPACT_TRANSACTIONS:
+            raise DeserializationError(f"Too many short IDs in a compact block ({count})")
+        short_ids = [safe_read(f, SHORT_ID_SIZE) for _ in range(count)]
+
+        prefilled = stream_deserialize_list(f, PrefilledTransaction)
+        total = count + len(prefilled)
+        previous = -1
+        for transaction in prefilled:
+            if transaction.index <= previous or transaction.index >= total:
+                raise DeserializationError("Prefilled transaction indexes must be increasing and inside the block")
+            previous = transaction.index
+
+        return cls(header, nonce, short_ids, prefilled, hash)
+
+
+class PartialBlock:
+
+    # A compact block being turned back into a Block: prefilled slots are
+    # set on construction, fill() matches candidate transactions by short ID
+    # and whatever is still missing is requested from the sender and handed
+    # to fill_missing().
+
+    def __init__(self, compact: CompactBlock):
+        self.compact = compact
+        self.key = compact.key()
+        self.transactions: List[Optional[Transaction]] = [None] * compact.transaction_count
+
+        for prefilled in compact.prefilled:
+            self.transactions[prefilled.index] = prefilled.transaction
+
+        # block position of every short ID; IDs appearing twice in the block
+        # cannot be told apart and are always requested
+        self.slots: Dict[bytes, int] = {}
+        duplicates: Set[bytes] = set()
+        short_ids = iter(compact.short_ids)
+        for index in range(compact.transaction_count):
+            if self.transactions[index] is not None:
+                continue
+            short = next(short_ids)
+            if short in self.slots:
+                duplicates.add(short)
+            self.slots[short] = index
+        for short in duplicates:
+            del self.slots[short]
+
+    def fill(self, candidates: Iterable[Transaction]) -> int:
+        # returns how many slots were filled; a short ID matched by two
+        # different candidates is left empty so the sender's copy is used
+        filled = 0
+        ambiguous: Set[int] = set()
+        for transaction in candidates:
+            index = self.slots.get(short_id(self.key, transaction.hash()))
+            if index is None or index in ambiguous:
+                continue
+
+            current = self.transactions[index]
+            if current is None:
+                self.transactions[index] = transaction
+                filled += 1
+            elif current.hash() != transaction.hash():
+                self.transactions[index] = None
+                ambiguous.add(index)
+                filled -= 1
+        return filled
+
+    def missing(self) -> List[int]:
+        return [index for (index, transaction) in enumerate(self.transactions) if transaction is None]
+
+    def fill_missing(self, indexes: List[int], transactions: List[Transaction]) -> None:
+        if len(indexes) != len(transactions):
+            raise ValueError(f"Asked for {len(indexes)} transactions, got {len(transactions)}")
+        for (index, transaction) in zip(indexes, transactions):
+            self.transactions[index] = transaction
+
+    def to_block(self) -> Optional[Block]:
+        # None while transactions are missing, or when a short ID collision
+        # put the wrong transaction in a slot; either way the caller falls
+        # back to fetching the full block
+        if any(transaction is None for transaction in self.transactions):
+            return None
+
+        block = Block(self.compact.header, self.transactions, self.compact.hash())  # type: ignore
+        if block.merkle_root() != self.compact.header.summary.merkle_root_hash:
+            return None
+        return block
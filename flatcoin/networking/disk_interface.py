@@ -1,9 +1,38 @@
+import json
+import os
+from typing import Any, Dict, List
+
+
 PEERS_JSON_FILE = "peers.json"
 PEERS_JSON_MAX_LENGTH = 100
 
 
-
 class DiskInterface:
-    
-    def __init__(self):
-        pass
\ No newline at end of file
+
+    # Reads and writes the peer table. Writes go to a temporary file that
+    # then replaces peers.json, so a crash leaves either the old or the new
+    # table, never half of one. How often to write is up to the caller, see
+    # PeerManager.
+
+    def __init__(self, path: str = PEERS_JSON_FILE):
+        self.path = path
+
+    def load_peers(self) -> List[Dict[str, Any]]:
+        try:
+            with open(self.path, "r") as f:
+                peers = json.load(f)
+        except FileNotFoundError:
+            return []
+        except ValueError:
+            print(f"Ignoring unreadable peer list {self.path}")
+            return []
+
+        return peers[:PEERS_JSON_MAX_LENGTH] if isinstance(peers, list) else []
+
+    def save_peers(self, peers: List[Dict[str, Any]]) -> None:
+        temporary_path = f"{self.path}.new"
+        with open(temporary_path, "w") as f:
+            json.dump(peers[:PEERS_JSON_MAX_LENGTH], f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.path)
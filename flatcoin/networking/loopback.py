@@ -0,0 +1,139 @@
+import argparse
+import asyncio
+import os
+import tempfile
+from time import perf_counter
+from typing import Dict, List, Optional
+
+import ecdsa
+
+from flatcoin.chain import Chain
+from flatcoin.consensus import target_threshold
+from flatcoin.database import FlatFileBlockStore
+from flatcoin.genesis import create_genesis_block
+from flatcoin.mining import NONCE_SPACE, create_block_template, search_nonces
+from flatcoin.networking.node import Node
+from flatcoin.params import BLOCK_REWARD
+
+
+# low enough that a block takes a few hundred hashes
+LOOPBACK_TARGET = 0xffffff
+
+
+class LoopbackNetwork:
+
+    # Several nodes on 127.0.0.1, each with its own block store under
+    # directory and all sharing one genesis block, for exercising sync
+    # end to end in a single process.
+
+    def __init__(self, directory: str, size: int, workers: int = 1):
+        self.directory = directory
+        self.size = size
+        self.workers = workers
+        self.public_key = ecdsa.SigningKey.generate(curve=ecdsa.SECP256k1).verifying_key.to_string()  # type: ignore
+        self.nodes: List[Node] = []
+
+    async def start(self) -> None:
+        genesis = create_genesis_block(BLOCK_REWARD, self.public_key, LOOPBACK_TARGET)
+
+        for index in range(self.size):
+            path = os.path.join(self.directory, f"node{index}")
+            os.makedirs(os.path.join(path, "blocks"), exist_ok=True)
+
+            chain = Chain.with_genesis(
+                disk=FlatFileBlockStore(os.path.join(path, "chain-cache.db"), os.path.join(path, "blocks")),
+                genesis=genesis,
+                checkpoint_path=os.path.join(path, "coinstate.dat"),
+            )
+            node = Node(chain, port=0, workers=self.workers)
+            await node.start()
+            self.nodes.append(node)
+
+    async def connect(self, a: int, b: int) -> None:
+        await self.nodes[a].connect("127.0.0.1", self.nodes[b].port)
+
+    async def connect_all(self) -> None:
+        for a in range(self.size):
+            for b in range(a + 1, self.size):
+                await self.connect(a, b)
+
+    def mine(self, index: int, count: int, target: int = LOOPBACK_TARGET) -> None:
+        # mined directly on one node's chain, without telling anyone
+        chain = self.nodes[index].chain
+        for _ in range(count):
+            block = create_block_template(chain, self.public_key, target)
+            summary = block.header.summary
+            (nonce, _) = search_nonces(block.header.serialize(), summary.nonce_offset(), target_threshold(target), 0, NONCE_SPACE)
+            if nonce is None:
+                raise ValueError("Nonce space exhausted")
+            summary.nonce = nonce
+            block.invalidate()
+            chain.add_block_with_validation(block)
+
+    async def announce(self, index: int) -> None:
+        # the tip as a compact block, the way freshly mined blocks travel
+        node = self.nodes[index]
+        view = node.chain.disk.get_view(node.chain.tip_hash)  # type: ignore
+        await node.relay_block(view.to_block())  # type: ignore
+
+    async def wait_for_height(self, height: int, timeout: float = 60.0) -> None:
+        async def converged() -> None:
+            while any(node.chain.height - 1 < height for node in self.nodes):
+                await asyncio.sleep(0.01)
+
+        await asyncio.wait_for(converged(), timeout)
+
+    def tips(self) -> List[Optional[bytes]]:
+        return [node.chain.tip_hash for node in self.nodes]
+
+    async def close(self) -> None:
+        for node in self.nodes:
+            await node.close()
+            node.chain.disk.close()
+
+
+async def run_loopback(size: int, blocks: int, directory: str, workers: int = 1) -> Dict[str, float]:
+    # node 0 mines the chain, the others join and sync from everyone at once
+    network = LoopbackNetwork(directory, size, workers)
+    await network.start()
+    try:
+        network.mine(0, blocks)
+        started = perf_counter()
+        await network.connect_all()
+        await network.wait_for_height(blocks)
+        seconds = perf_counter() - started
+
+        if len(set(network.tips())) != 1:
+            raise AssertionError("Nodes synced to different tips")
+
+        # one more block, relayed as a compact block
+        network.mine(0, 1)
+        await network.announce(0)
+        await network.wait_for_height(blocks + 1)
+
+        return {
+            "nodes": size,
+            "blocks": blocks,
+            "sync_seconds": seconds,
+            "blocks_per_second": blocks / seconds if seconds > 0 else 0.0,
+        }
+    finally:
+        await network.close()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="flatcoin-loopback", description="Sync a chain between local nodes")
+    parser.add_argument("--nodes", type=int, default=4)
+    parser.add_argument("--blocks", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=1, help="decode processes per node")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        result = asyncio.run(run_loopback(args.nodes, args.blocks, directory, args.workers))
+
+    for (key, value) in result.items():
+        print(f"{key}: {value:,.2f}" if isinstance(value, float) else f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,571 @@
+import asyncio
+import heapq
+import random
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, time
+from typing import Any, AsyncIterator, Callable, Coroutine, Dict, List, Optional, Set, Tuple
+
+from flatcoin.block import Block, BlockView
+from flatcoin.chain import Chain
+from flatcoin.consensus import validate_block_header
+from flatcoin.headerindex import NO_SLOT
+from flatcoin.networking.compact import CompactBlock, PartialBlock
+from flatcoin.networking.peer import Peer
+from flatcoin.networking.peermanager import PeerManager
+from flatcoin.networking.protocol import (
+    MAX_HEADERS_PER_MESSAGE,
+    PROTOCOL_VERSION,
+    BlockData,
+    BlockTransactions,
+    CompactBlockData,
+    GetBlocks,
+    GetBlockTransactions,
+    GetHeaders,
+    Headers,
+    Inventory,
+    NotFound,
+    ProtocolError,
+    Version,
+)
+from flatcoin.sync import BlockSync, SyncMetrics
+from flatcoin.serialization import SerializationError
+from flatcoin.validator import InvalidBlockError
+
+
+DEFAULT_PORT = 9333
+
+# how far past the next block to connect requests may run ahead
+DEFAULT_DOWNLOAD_WINDOW = 256
+MAX_BLOCKS_IN_FLIGHT_PER_PEER = 16
+
+BLOCK_REQUEST_TIMEOUT = 10.0
+HEADERS_REQUEST_TIMEOUT = 30.0
+
+# peers are dropped once this many of their requests have timed out
+MAX_PEER_TIMEOUTS = 3
+
+# downloaded blocks are handed to BlockSync this many at a time
+CONNECT_BATCH = 64
+
+# what dialling a peer and the handshake can fail with
+CONNECT_ERRORS = (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ProtocolError, OSError)
+
+# how often connected peers are pinged and the peer table saved
+MAINTENANCE_INTERVAL = 30.0
+PING_TIMEOUT = 10.0
+
+
+class Node:
+
+    # Syncs headers first: the best peer's headers are validated and added
+    # to the chain's HeaderIndex, then the blocks on the path from our tip to
+    # the best header are fetched from every peer at once. Requests are
+    # spread over peers with at most MAX_BLOCKS_IN_FLIGHT_PER_PEER each and
+    # never more than window blocks ahead of the next block to connect; a
+    # request that times out or is refused goes back in the queue for
+    # another peer. Blocks extending our tip are connected in order through
+    # BlockSync; a branch forking below it goes block by block through the
+    # chain's block tree, which reorganizes once the branch has more work.
+    # Connecting runs on a thread of its own, so signature checks and store
+    # writes do not hold up pings and block requests. Every block the node
+    # connects goes through that thread; handlers on the event loop read the
+    # chain under chain.lock, so they never see a reorganization or a store
+    # write half done.
+    #
+    # New blocks at the tip are relayed as compact blocks instead: the
+    # receiver rebuilds them from its mempool and asks the sender only for
+    # the transactions it lacks. Anything that does not simply extend our
+    # tip goes through a regular sync.
+
+    def __init__(
+        self,
+        chain: Chain,
+        host: str = "127.0.0.1",
+        port: int = DEFAULT_PORT,
+        workers: Optional[int] = None,
+        window: int = DEFAULT_DOWNLOAD_WINDOW,
+        request_timeout: float = BLOCK_REQUEST_TIMEOUT,
+        peer_manager: Optional[PeerManager] = None,
+    ):
+        self.chain = chain
+        self.host = host
+        self.port = port
+        self.window = window
+        self.request_timeout = request_timeout
+        # where outbound peers' latency and reliability are recorded
+        self.peer_manager = peer_manager
+
+        self.nonce = random.getrandbits(64)
+        self.peers: List[Peer] = []
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.tasks: Set["asyncio.Task[None]"] = set()
+        self.sync_task: Optional["asyncio.Task[None]"] = None
+        # set when something arrives that a sync already under way may
+        # have missed, so it goes around once more
+        self.sync_requested = False
+
+        self.block_sync = BlockSync(chain, workers=workers)
+        # one thread, so blocks are connected strictly in order
+        self.connect_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="flatcoin-connect")
+        self.last_sync: Optional[SyncMetrics] = None
+        self.last_sync_error: Optional[Exception] = None
+
+        # compact blocks being rebuilt, so one arriving from several peers
+        # at once is only worked on once
+        self.blocks_in_transit: Set[bytes] = set()
+        # compact blocks received, rebuilt from the mempool alone, rebuilt
+        # after asking for missing transactions, or fetched in full
+        self.relay_stats: Counter = Counter()
+
+    def __repr__(self) -> str:
+        return f"Node {self.host}:{self.port} at height {self.chain.height - 1} with {len(self.peers)} peers"
+
+    def version(self) -> Version:
+        with self.chain.lock:
+            return Version(PROTOCOL_VERSION, self.chain.height - 1, self.chain.tip_hash or b"\x00" * 32, self.nonce)
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self._accept, self.host, self.port)
+        # port 0 asks the OS for a free one
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.spawn(self._maintain())
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+        for peer in list(self.peers):
+            peer.close()
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+        # a cancelled sync leaves its batch running on the thread; it has to
+        # finish before the pool and store go away
+        self.connect_executor.shutdown(wait=True)
+        self.block_sync.close()
+        if self.peer_manager is not None:
+            self.peer_manager.flush()
+
+    def spawn(self, coroutine: Coroutine) -> "asyncio.Task[None]":
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def connect(self, host: str, port: int) -> Peer:
+        started = perf_counter()
+        try:
+            (reader, writer) = await asyncio.open_connection(host, port)
+            peer = await self._add_peer(reader, writer, outbound=True)
+        except CONNECT_ERRORS:
+            if self.peer_manager is not None:
+                self.peer_manager.record_failure((host, port))
+            raise
+
+        # the handshake is one round trip plus the connection set up
+        peer.observe_latency(perf_counter() - started)
+        peer.address = (host, port)
+        self._record_success(peer)
+        return peer
+
+    async def connect_known_peers(self, count: int) -> List[Peer]:
+        # dials the fastest healthy addresses from the peer table
+        if self.peer_manager is None:
+            return []
+
+        connected = [peer.address for peer in self.peers]
+        peers = []
+        for (host, port) in self.peer_manager.best(count, exclude=connected):
+            try:
+                peers.append(await self.connect(host, port))
+            except CONNECT_ERRORS:
+                continue
+        return peers
+
+    def _record_success(self, peer: Peer) -> None:
+        # inbound peers connect from ephemeral ports nobody can dial back
+        if self.peer_manager is not None and peer.outbound:
+            self.peer_manager.record_success(peer.address, peer.last_latency)
+
+    def _record_failure(self, peer: Peer) -> None:
+        if self.peer_manager is not None and peer.outbound:
+            self.peer_manager.record_failure(peer.address)
+
+    async def _maintain(self) -> None:
+        while True:
+            await asyncio.sleep(MAINTENANCE_INTERVAL)
+            for peer in list(self.peers):
+                try:
+                    await peer.ping(PING_TIMEOUT)
+                    self._record_success(peer)
+                except (asyncio.TimeoutError, ConnectionError, OSError):
+                    self._record_failure(peer)
+                    if peer.timeouts >= MAX_PEER_TIMEOUTS:
+                        peer.close()
+            if self.peer_manager is not None:
+                self.peer_manager.save_if_due()
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            await self._add_peer(reader, writer, outbound=False)
+        except CONNECT_ERRORS:
+            writer.close()
+
+    async def _add_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, outbound: bool) -> Peer:
+        peer = Peer(self, reader, writer, outbound)
+        try:
+            await peer.handshake(self.version())
+        except BaseException:
+            peer.close()
+            raise
+
+        if peer.nonce == self.nonce:
+            peer.close()
+            raise ConnectionError("Connected to ourselves")
+
+        self.peers.append(peer)
+        self.spawn(peer.run())
+
+        if peer.height > self.chain.height - 1:
+            self.request_sync()
+        return peer
+
+    def peer_disconnected(self, peer: Peer) -> None:
+        if peer in self.peers:
+            self.peers.remove(peer)
+
+    async def handle_get_headers(self, peer: Peer, message: GetHeaders) -> None:
+        headers = self.chain.headers
+
+        result = []
+        with self.chain.lock:
+            start = 0
+            for hash in message.locator:
+                if headers.is_on_main_chain(hash):
+                    start = headers.heights[headers.slot_of(hash)] + 1  # type: ignore
+                    break
+
+            for height in range(start, min(start + MAX_HEADERS_PER_MESSAGE, headers.tip_height + 1)):
+                hash = headers.hash_at_height(height)
+                header = self.chain.disk.get_header(hash)  # type: ignore
+                if header is None:
+                    break
+                result.append(header)
+                if hash == message.stop_hash:
+                    break
+
+        await peer.send(Headers(result))
+
+    async def handle_get_blocks(self, peer: Peer, message: GetBlocks) -> None:
+        found = []
+        missing = []
+        with self.chain.lock:
+            for hash in message.hashes:
+                block_bytes = self.chain.disk.get_bytes(hash)
+                if block_bytes is None:
+                    missing.append(hash)
+                else:
+                    found.append(bytes(block_bytes))
+
+        for block_bytes in found:
+            await peer.send(BlockData(block_bytes))
+        if missing:
+            await peer.send(NotFound(missing))
+
+    async def handle_get_block_transactions(self, peer: Peer, message: GetBlockTransactions) -> None:
+        with self.chain.lock:
+            view = self.chain.disk.get_view(message.block_hash)  # type: ignore
+            if view is None or any(index >= len(view) for index in message.indexes):
+                transactions = None
+            else:
+                transactions = [view.transaction(index) for index in message.indexes]
+
+        if transactions is None:
+            await peer.send(NotFound([message.block_hash]))
+            return
+
+        await peer.send(BlockTransactions(message.block_hash, transactions))
+
+    async def handle_compact_block(self, peer: Peer, message: CompactBlockData) -> None:
+        compact = message.compact
+        hash = compact.hash()
+        summary = compact.header.summary
+        peer.height = max(peer.height, summary.height)
+
+        with self.chain.lock:
+            known = hash in self.chain.headers
+            extends_tip = summary.previous_block_hash == self.chain.tip_hash
+        if known or hash in self.blocks_in_transit:
+            return
+        if self.syncing or not extends_tip:
+            self.request_sync()
+            return
+        if not validate_block_header(compact.header, int(time()), self.chain.target):
+            peer.close()
+            return
+
+        self.relay_stats["received"] += 1
+        self.blocks_in_transit.add(hash)
+        try:
+            block = await self._reconstruct(peer, compact)
+        except (asyncio.TimeoutError, ConnectionError, OSError, SerializationError, ValueError):
+            block = None
+        finally:
+            self.blocks_in_transit.discard(hash)
+
+        # the tip may have moved while we waited for the peer
+        if block is None or self.syncing or summary.previous_block_hash != self.chain.tip_hash:
+            self.request_sync()
+            return
+
+        try:
+            await self._connect(self.chain.add_block_with_validation, block)
+        except InvalidBlockError as e:
+            self.last_sync_error = e
+            self._record_failure(peer)
+            peer.close()
+            return
+
+        await self.relay_block(block, exclude=peer)
+
+    async def _reconstruct(self, peer: Peer, compact: CompactBlock) -> Optional[Block]:
+        partial = PartialBlock(compact)
+        with self.chain.lock:
+            partial.fill(self.chain.mempool.transactions())
+
+        missing = partial.missing()
+        if not missing:
+            self.relay_stats["from_mempool"] += 1
+        else:
+            transactions = await peer.get_block_transactions(compact.hash(), missing, self.request_timeout)
+            if transactions is None:
+                return None
+            partial.fill_missing(missing, transactions)
+            self.relay_stats["with_missing"] += 1
+
+        block = partial.to_block()
+        if block is not None:
+            return block
+
+        # a short ID collision put the wrong transaction somewhere
+        block_bytes = await peer.get_block(compact.hash(), self.request_timeout)
+        if block_bytes is None:
+            return None
+        self.relay_stats["full_block"] += 1
+        return BlockView(block_bytes).to_block()
+
+    async def relay_block(self, block: Block, exclude: Optional[Peer] = None) -> None:
+        message = CompactBlockData(CompactBlock.from_block(block, random.getrandbits(64)))
+        for peer in list(self.peers):
+            if peer is exclude:
+                continue
+            try:
+                await peer.send(message)
+            except (ConnectionError, OSError):
+                peer.close()
+
+    def handle_inventory(self, peer: Peer, message: Inventory) -> None:
+        with self.chain.lock:
+            unknown = any(hash not in self.chain.headers for hash in message.hashes)
+        if unknown:
+            self.request_sync()
+
+    async def announce(self, hashes: List[bytes]) -> None:
+        for peer in list(self.peers):
+            try:
+                await peer.send(Inventory(hashes))
+            except (ConnectionError, OSError):
+                peer.close()
+
+    @property
+    def syncing(self) -> bool:
+        return self.sync_task is not None and not self.sync_task.done()
+
+    async def _connect(self, function: Callable[..., Any], *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self.connect_executor, function, *args)
+
+    def request_sync(self) -> None:
+        self.sync_requested = True
+        if not self.syncing:
+            self.sync_task = self.spawn(self.sync())
+
+    async def sync(self) -> None:
+        # keeps going until no peer has a better chain to offer
+        while True:
+            self.sync_requested = False
+            hashes = await self._sync_headers()
+            if not hashes:
+                if self.sync_requested:
+                    continue
+                return
+
+            headers = self.chain.headers
+            with self.chain.lock:
+                forked = headers.parents[headers.slot_of(hashes[0])] != headers.tip  # type: ignore
+
+            self.block_sync.metrics = SyncMetrics()
+            batch: List[bytes] = []
+            sources: Dict[bytes, Peer] = {}
+            try:
+                if forked:
+                    async for block_bytes in self._download(hashes, sources):
+                        await self._connect(self.chain.add_block_with_validation, self._decode(block_bytes))
+                else:
+                    async for block_bytes in self._download(hashes, sources):
+                        batch.append(block_bytes)
+                        if len(batch) >= CONNECT_BATCH:
+                            await self._connect(self.block_sync.run, batch)
+                            batch = []
+                    if batch:
+                        await self._connect(self.block_sync.run, batch)
+            except InvalidBlockError as e:
+                # whatever was connected before the failure stays connected;
+                # the peer that served the bad block is dropped and the sync
+                # goes around again for the best chain left
+                self.last_sync_error = e
+                culprit = self._culprit(hashes, sources)
+                if culprit is None:
+                    return
+                self._record_failure(culprit)
+                culprit.close()
+                continue
+            except ConnectionError as e:
+                self.last_sync_error = e
+                return
+
+            self.last_sync = self.block_sync.metrics
+            await self.announce([self.chain.tip_hash])  # type: ignore
+
+    def _decode(self, block_bytes: bytes) -> Block:
+        try:
+            return BlockView(block_bytes).to_block()
+        except (SerializationError, ValueError) as e:
+            raise InvalidBlockError(f"Block could not be decoded: {e}") from e
+
+    def _culprit(self, hashes: List[bytes], sources: Dict[bytes, Peer]) -> Optional[Peer]:
+        # blocks are connected in order, so the failed one is the first that
+        # did not make it in
+        headers = self.chain.headers
+        with self.chain.lock:
+            for hash in hashes:
+                slot = headers.slot_of(hash)
+                if slot is None or headers.is_invalid(slot) or not headers.has_data(slot):
+                    return sources.get(hash)
+        return None
+
+    async def _sync_headers(self) -> List[bytes]:
+        # returns the hashes of the blocks we lack between the fork point
+        # with our tip and the best header any peer could provide
+        headers = self.chain.headers
+
+        for peer in sorted(self.peers, key=lambda peer: peer.height, reverse=True):
+            try:
+                while True:
+                    with self.chain.lock:
+                        locator = headers.locator(headers.best)
+                    received = await peer.get_headers(locator, HEADERS_REQUEST_TIMEOUT)
+                    current_timestamp = int(time())
+                    with self.chain.lock:
+                        for header in received:
+                            if header.summary.height == 0 and header.hash() not in headers:
+                                raise ProtocolError(f"{peer} is on a chain with a different genesis block")
+                            if not validate_block_header(header, current_timestamp, self.chain.target):
+                                raise ProtocolError(f"{peer} sent an invalid header")
+                            try:
+                                headers.add(header)
+                            except ValueError as e:
+                                raise ProtocolError(f"{peer} sent a header that does not connect: {e}") from e
+
+                    if received:
+                        peer.height = max(peer.height, received[-1].summary.height)
+                    if len(received) < MAX_HEADERS_PER_MESSAGE:
+                        break
+            except (asyncio.TimeoutError, ConnectionError, ProtocolError, OSError):
+                peer.close()
+
+        with self.chain.lock:
+            (best, tip) = (headers.best, headers.tip)
+            if best == NO_SLOT or headers.chainwork[best] <= headers.chainwork[tip]:
+                return []
+
+            # blocks of the branch stored earlier are not fetched again
+            start = headers.heights[headers.fork_point(best, tip)] + 1
+            while start <= headers.heights[best] and headers.has_data(headers.ancestor(best, start)):
+                start += 1
+
+            return [
+                headers.hash_at(headers.ancestor(best, height))
+                for height in range(start, headers.heights[best] + 1)
+            ]
+
+    def _pick_peer(self, hash: bytes, in_flight: Counter, missing: Dict[bytes, Set[Peer]]) -> Optional[Peer]:
+        # the peer expected to answer first: its measured latency times the
+        # requests queued on it; unmeasured peers go first so they get measured
+        candidates = [
+            peer for peer in self.peers
+            if not peer.closed
+            and in_flight[peer] < MAX_BLOCKS_IN_FLIGHT_PER_PEER
+            and peer not in missing.get(hash, ())
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda peer: ((in_flight[peer] + 1) * (peer.latency or 0.0), in_flight[peer]))
+
+    async def _download(self, hashes: List[bytes], sources: Dict[bytes, Peer]) -> AsyncIterator[bytes]:
+        # yields the blocks in order while up to window of them are fetched
+        # out of order from all peers; sources records who sent each one
+        pending = list(range(len(hashes)))
+        results: Dict[int, bytes] = {}
+        requests: Dict["asyncio.Task[Optional[bytes]]", Tuple[int, Peer]] = {}
+        in_flight: Counter = Counter()
+        # peers that answered NotFound, by hash
+        missing: Dict[bytes, Set[Peer]] = {}
+        next_index = 0
+
+        try:
+            while next_index < len(hashes):
+                while next_index in results:
+                    yield results.pop(next_index)
+                    next_index += 1
+                if next_index == len(hashes):
+                    break
+
+                while pending and pending[0] < next_index + self.window:
+                    peer = self._pick_peer(hashes[pending[0]], in_flight, missing)
+                    if peer is None:
+                        break
+                    index = heapq.heappop(pending)
+                    task = asyncio.get_running_loop().create_task(peer.get_block(hashes[index], self.request_timeout))
+                    requests[task] = (index, peer)
+                    in_flight[peer] += 1
+
+                if not requests:
+                    raise ConnectionError(f"No peer left to download block {hashes[next_index].hex()} from")
+
+                (done, _) = await asyncio.wait(requests, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    (index, peer) = requests.pop(task)
+                    in_flight[peer] -= 1
+
+                    try:
+                        block_bytes = task.result()
+                    except (asyncio.TimeoutError, ConnectionError, OSError):
+                        self._record_failure(peer)
+                        if peer.timeouts >= MAX_PEER_TIMEOUTS:
+                            peer.close()
+                        heapq.heappush(pending, index)
+                        continue
+
+                    if block_bytes is None:
+                        missing.setdefault(hashes[index], set()).add(peer)
+                        heapq.heappush(pending, index)
+                    else:
+                        results[index] = block_bytes
+                        sources[hashes[index]] = peer
+                        self._record_success(peer)
+        finally:
+            for task in requests:
+                task.cancel()
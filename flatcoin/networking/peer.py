@@ -0,0 +1,262 @@
+import asyncio
+import random
+from time import perf_counter
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from flatcoin.block import BlockHeader, BlockView
+from flatcoin.networking.protocol import (
+    PROTOCOL_VERSION,
+    BlockData,
+    BlockTransactions,
+    CompactBlockData,
+    GetBlocks,
+    GetBlockTransactions,
+    GetHeaders,
+    Headers,
+    Inventory,
+    Message,
+    NotFound,
+    Ping,
+    Pong,
+    ProtocolError,
+    Version,
+    VersionAck,
+    encode_message,
+    read_message,
+)
+from flatcoin.networking.peermanager import smooth_latency
+from flatcoin.serialization import SerializationError
+from flatcoin.transaction import Transaction
+
+if TYPE_CHECKING:
+    from flatcoin.networking.node import Node
+
+
+HANDSHAKE_TIMEOUT = 10.0
+
+
+class Peer:
+
+    # One connection. run() reads messages until the connection drops and
+    # either resolves the future of a request made through this object or
+    # hands the message to the node.
+
+    def __init__(self, node: "Node", reader: asyncio.StreamReader, writer: asyncio.StreamWriter, outbound: bool):
+        self.node = node
+        self.reader = reader
+        self.writer = writer
+        self.outbound = outbound
+        self.address: Tuple[str, int] = writer.get_extra_info("peername")[:2]
+
+        # from the peer's Version message, bumped by its announcements
+        self.height = 0
+        self.tip_hash: Optional[bytes] = None
+        self.nonce: Optional[int] = None
+
+        self.block_requests: Dict[bytes, "asyncio.Future[Optional[bytes]]"] = {}
+        self.headers_request: Optional["asyncio.Future[List[BlockHeader]]"] = None
+        self.headers_lock = asyncio.Lock()
+        # by block hash, for compact blocks we could not rebuild alone
+        self.transaction_requests: Dict[bytes, "asyncio.Future[Optional[List[Transaction]]]"] = {}
+
+        self.pings: Dict[int, "asyncio.Future[None]"] = {}
+
+        # smoothed seconds from request to answer, for pings and blocks alike
+        self.latency: Optional[float] = None
+        self.last_latency: Optional[float] = None
+        # requests that timed out; the node drops peers that collect too many
+        self.timeouts = 0
+        self.closed = False
+
+    def __repr__(self) -> str:
+        return "Peer %s:%s" % self.address
+
+    async def send(self, message: Message) -> None:
+        self.writer.write(encode_message(message))
+        await self.writer.drain()
+
+    async def handshake(self, version: Version) -> None:
+        await self.send(version)
+
+        async def exchange() -> None:
+            got_version = False
+            got_ack = False
+            while not (got_version and got_ack):
+                message = await read_message(self.reader)
+                if isinstance(message, Version):
+                    if message.version != PROTOCOL_VERSION:
+                        raise ProtocolError(f"Unsupported protocol version {message.version}")
+                    self.height = message.height
+                    self.tip_hash = message.tip_hash
+                    self.nonce = message.nonce
+                    got_version = True
+                    await self.send(VersionAck())
+                elif isinstance(message, VersionAck):
+                    got_ack = True
+                else:
+                    raise ProtocolError(f"Expected a handshake message, got {type(message).__name__}")
+
+        await asyncio.wait_for(exchange(), HANDSHAKE_TIMEOUT)
+
+    async def run(self) -> None:
+        try:
+            while True:
+                self._dispatch(await read_message(self.reader))
+        except (asyncio.IncompleteReadError, ConnectionError, ProtocolError, OSError):
+            pass
+        finally:
+            self.close()
+            self.node.peer_disconnected(self)
+
+    def _dispatch(self, message: Message) -> None:
+        if isinstance(message, BlockData):
+            try:
+                block_hash = BlockView(message.block_bytes).hash()
+            except (SerializationError, ValueError) as e:
+                raise ProtocolError(f"Undecodable block from {self}: {e}") from e
+
+            # a block that arrives after its request timed out is dropped
+            future = self.block_requests.pop(block_hash, None)
+            if future is not None and not future.done():
+                future.set_result(message.block_bytes)
+
+        elif isinstance(message, NotFound):
+            for hash in message.hashes:
+                for future in (self.block_requests.pop(hash, None), self.transaction_requests.pop(hash, None)):
+                    if future is not None and not future.done():
+                        future.set_result(None)
+
+        elif isinstance(message, BlockTransactions):
+            transactions = self.transaction_requests.pop(message.block_hash, None)
+            if transactions is not None and not transactions.done():
+                transactions.set_result(message.transactions)
+
+        elif isinstance(message, CompactBlockData):
+            self._spawn(self.node.handle_compact_block(self, message))
+
+        elif isinstance(message, GetBlockTransactions):
+            self._spawn(self.node.handle_get_block_transactions(self, message))
+
+        elif isinstance(message, Headers):
+            if self.headers_request is None or self.headers_request.done():
+                raise ProtocolError(f"{self} sent headers that were not asked for")
+            self.headers_request.set_result(message.headers)
+
+        elif isinstance(message, Pong):
+            ping = self.pings.pop(message.nonce, None)
+            if ping is not None and not ping.done():
+                ping.set_result(None)
+
+        elif isinstance(message, Ping):
+            self._spawn(self.send(Pong(message.nonce)))
+
+        elif isinstance(message, GetHeaders):
+            self._spawn(self.node.handle_get_headers(self, message))
+
+        elif isinstance(message, GetBlocks):
+            self._spawn(self.node.handle_get_blocks(self, message))
+
+        elif isinstance(message, Inventory):
+            self.node.handle_inventory(self, message)
+
+        else:
+            raise ProtocolError(f"Unexpected {type(message).__name__} from {self}")
+
+    def _spawn(self, coroutine) -> None:
+        self.node.spawn(coroutine)
+
+    async def get_headers(self, locator: List[bytes], timeout: float) -> List[BlockHeader]:
+        # one headers request at a time; replies carry nothing to match on
+        async with self.headers_lock:
+            self.headers_request = asyncio.get_running_loop().create_future()
+            try:
+                await self.send(GetHeaders(locator))
+                return await asyncio.wait_for(self.headers_request, timeout)
+            finally:
+                self.headers_request = None
+
+    def observe_latency(self, seconds: float) -> None:
+        self.last_latency = seconds
+        self.latency = smooth_latency(self.latency, seconds)
+
+    async def ping(self, timeout: float) -> float:
+        nonce = random.getrandbits(64)
+        self.pings[nonce] = asyncio.get_running_loop().create_future()
+
+        started = perf_counter()
+        try:
+            await self.send(Ping(nonce))
+            await asyncio.wait_for(self.pings[nonce], timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self.pings.pop(nonce, None)
+
+        seconds = perf_counter() - started
+        self.observe_latency(seconds)
+        return seconds
+
+    async def get_block(self, hash: bytes, timeout: float) -> Optional[bytes]:
+        # None when the peer says it does not have the block
+        started = perf_counter()
+        future = self.block_requests.get(hash)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.block_requests[hash] = future
+            await self.send(GetBlocks([hash]))
+
+        try:
+            block_bytes = await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            self.block_requests.pop(hash, None)
+            self.timeouts += 1
+            raise
+
+        self.observe_latency(perf_counter() - started)
+        return block_bytes
+
+    async def get_block_transactions(self, hash: bytes, indexes: List[int], timeout: float) -> Optional[List[Transaction]]:
+        # None when the peer no longer has the block
+        if hash in self.transaction_requests:
+            raise ValueError(f"Transactions of block {hash.hex()} already requested from {self}")
+
+        future = asyncio.get_running_loop().create_future()
+        self.transaction_requests[hash] = future
+        try:
+            await self.send(GetBlockTransactions(hash, indexes))
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self.transaction_requests.pop(hash, None)
+
+    @property
+    def blocks_in_flight(self) -> int:
+        return len(self.block_requests)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+
+        for future in self.block_requests.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"{self} disconnected"))
+        self.block_requests.clear()
+
+        for future in self.transaction_requests.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"{self} disconnected"))
+        self.transaction_requests.clear()
+
+        if self.headers_request is not None and not self.headers_request.done():
+            self.headers_request.set_exception(ConnectionError(f"{self} disconnected"))
+
+        for ping in self.pings.values():
+            if not ping.done():
+                ping.set_exception(ConnectionError(f"{self} disconnected"))
+        self.pings.clear()
+
+        self.writer.close()
@@ -0,0 +1,189 @@
+from time import monotonic, time
+from typing import Any, Dict, List, Optional, Tuple
+
+from flatcoin.networking.disk_interface import PEERS_JSON_MAX_LENGTH, DiskInterface
+
+
+Address = Tuple[str, int]
+
+# weight of a new round trip measurement in the moving average
+LATENCY_SMOOTHING = 0.3
+
+# a peer is skipped after this many failures in a row, until it succeeds again
+MAX_CONSECUTIVE_FAILURES = 3
+
+# peers.json is rewritten at most this often however many updates come in
+PEERS_SAVE_INTERVAL = 30.0
+
+# addresses not seen for this long go first when the table is full
+STALE_AFTER_SECONDS = 7 * 24 * 3600
+
+
+def smooth_latency(latency: Optional[float], seconds: float) -> float:
+    return seconds if latency is None else latency + LATENCY_SMOOTHING * (seconds - latency)
+
+
+class PeerRecord:
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        latency: Optional[float] = None,
+        successes: int = 0,
+        failures: int = 0,
+        consecutive_failures: int = 0,
+        last_seen: float = 0.0,
+    ):
+        self.host = host
+        self.port = port
+        # smoothed round trip in seconds, None until measured
+        self.latency = latency
+        self.successes = successes
+        self.failures = failures
+        self.consecutive_failures = consecutive_failures
+        self.last_seen = last_seen
+
+    @property
+    def address(self) -> Address:
+        return (self.host, self.port)
+
+    @property
+    def healthy(self) -> bool:
+        return self.consecutive_failures < MAX_CONSECUTIVE_FAILURES
+
+    def observe_latency(self, seconds: float) -> None:
+        self.latency = smooth_latency(self.latency, seconds)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "host": self.host,
+            "port": self.port,
+            "latency": self.latency,
+            "successes": self.successes,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "last_seen": self.last_seen,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "PeerRecord":
+        return cls(
+            host=str(data["host"]),
+            port=int(data["port"]),
+            latency=float(data["latency"]) if data.get("latency") is not None else None,
+            successes=int(data.get("successes", 0)),
+            failures=int(data.get("failures", 0)),
+            consecutive_failures=int(data.get("consecutive_failures", 0)),
+            last_seen=float(data.get("last_seen", 0.0)),
+        )
+
+
+class PeerManager:
+
+    # Address book of peers we can dial, with measured latency and
+    # success/failure history. Changes only mark the table dirty; it is
+    # written when the last save is older than save_interval, or on flush().
+
+    def __init__(
+        self,
+        disk: Optional[DiskInterface] = None,
+        max_entries: int = PEERS_JSON_MAX_LENGTH,
+        save_interval: float = PEERS_SAVE_INTERVAL,
+    ):
+        self.disk = disk if disk is not None else DiskInterface()
+        self.max_entries = max_entries
+        self.save_interval = save_interval
+        self.records: Dict[Address, PeerRecord] = {}
+        self.dirty = False
+        self.last_save = monotonic()
+
+        for data in self.disk.load_peers():
+            try:
+                record = PeerRecord.from_dict(data)
+            except (KeyError, TypeError, ValueError):
+                continue
+            self.records[record.address] = record
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __contains__(self, address: Address) -> bool:
+        return address in self.records
+
+    def get(self, address: Address) -> Optional[PeerRecord]:
+        return self.records.get(address)
+
+    def add(self, address: Address) -> PeerRecord:
+        record = self.records.get(address)
+        if record is None:
+            record = PeerRecord(address[0], address[1])
+            self.records[address] = record
+            self._evict(keep=address)
+            self._changed()
+        return record
+
+    def record_success(self, address: Address, latency: Optional[float] = None) -> None:
+        record = self.add(address)
+        record.successes += 1
+        record.consecutive_failures = 0
+        record.last_seen = time()
+        if latency is not None:
+            record.observe_latency(latency)
+        self._changed()
+
+    def record_failure(self, address: Address) -> None:
+        record = self.add(address)
+        record.failures += 1
+        record.consecutive_failures += 1
+        self._changed()
+
+    def best(self, count: int, exclude: Optional[List[Address]] = None) -> List[Address]:
+        # healthy peers, measured ones fastest first, then the unmeasured
+        # ones most recently seen first
+        excluded = set(exclude or ())
+        candidates = [
+            record for record in self.records.values()
+            if record.healthy and record.address not in excluded
+        ]
+        candidates.sort(key=lambda record: (
+            record.latency is None,
+            record.latency if record.latency is not None else -record.last_seen,
+        ))
+        return [record.address for record in candidates[:count]]
+
+    def _evict(self, keep: Address) -> None:
+        # unhealthy first, then stale, then the slowest; never the address
+        # that was just added
+        if len(self.records) <= self.max_entries:
+            return
+
+        now = time()
+
+        def badness(record: PeerRecord) -> Tuple[bool, bool, float]:
+            stale = now - record.last_seen > STALE_AFTER_SECONDS
+            return (not record.healthy, stale, record.latency if record.latency is not None else float("inf"))
+
+        ranked = sorted(
+            (record for record in self.records.values() if record.address != keep),
+            key=badness,
+            reverse=True,
+        )
+        for record in ranked[:len(self.records) - self.max_entries]:
+            del self.records[record.address]
+
+    def _changed(self) -> None:
+        self.dirty = True
+        self.save_if_due()
+
+    def save_if_due(self) -> None:
+        if self.dirty and monotonic() - self.last_save >= self.save_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.dirty:
+            return
+
+        self.disk.save_peers([record.to_dict() for record in self.records.values()])
+        self.dirty = False
+        self.last_save = monotonic()
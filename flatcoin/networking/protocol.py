@@ -0,0 +1,297 @@
+import asyncio
+import struct
+from typing import BinaryIO, Dict, List, Type
+
+from flatcoin.block import BlockHeader
+from flatcoin.networking.compact import CompactBlock
+from flatcoin.serialization import (
+    DeserializationError,
+    Serializable,
+    SerializationError,
+    safe_read,
+    stream_deserialize_list,
+    stream_deserialize_vlq,
+    stream_serialize_list,
+    stream_serialize_vlq,
+)
+from flatcoin.transaction import Transaction
+
+
+# Every message is framed as
+#   magic (4 bytes) | command (1 byte) | payload length (uint32) | payload
+# and the payload is the message's Serializable encoding.
+
+MAGIC = b"FLAT"
+FRAME_HEADER = struct.Struct(b">4sBI")
+MAX_PAYLOAD_SIZE = 4 * 1024 * 1024
+
+PROTOCOL_VERSION = 1
+
+MAX_HEADERS_PER_MESSAGE = 2000
+MAX_HASHES_PER_MESSAGE = 50_000
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def stream_serialize_hashes(f: BinaryIO, hashes: List[bytes]) -> None:
+    stream_serialize_vlq(f, len(hashes))
+    for hash in hashes:
+        f.write(hash)
+
+
+def stream_deserialize_hashes(f: BinaryIO) -> List[bytes]:
+    count = stream_deserialize_vlq(f)
+    if count > MAX_HASHES_PER_MESSAGE:
+        raise DeserializationError(f"Too many hashes in one message ({count})")
+    return [safe_read(f, 32) for _ in range(count)]
+
+
+class Message(Serializable):
+
+    command = 0x00
+
+    def stream_serialize(self, f: BinaryIO) -> None:
+        pass
+
+    @classmethod
+    def stream_deserialize(cls, f: BinaryIO) -> "Message":
+        return cls()
+
+
+class Version(Message):
+
+    command = 0x01
+
+    def __init__(self, version: int, height: int, tip_hash: bytes, nonce: int):
+        self.version = version
+        self.height = height
+        self.tip_hash = tip_hash
+        # random per node, so a node notices when it connected to itself
+        self.nonce = nonce
+
+    def stream_serialize(self, f: BinaryIO) -> None:
+        stream_serialize_vlq(f, self.version)
+        stream_serialize_vlq(f, self.height)
+        f.write(self.tip_hash)
+        f.write(struct.pack(b">Q", self.nonce))
+
+    @classmethod
+    def stream_deserialize(cls, f: BinaryIO) -> "Version":
+        version = stream_deserialize_vlq(f)
+        height = stream_deserialize_vlq(f)
+        tip_hash = safe_read(f, 32)
+        (nonce,) = struct.unpack(b">Q", safe_read(f, 8))
+        return cls(version, height, tip_hash, nonce)
+
+
+class VersionAck(Message):
+
+    command = 0x02
+
+
+class Ping(Message):
+
+    command = 0x03
+
+    def __init__(self, nonce: int):
+        self.nonce = nonce
+
+    def stream_serialize(self, f: BinaryIO) -> None:
+        f.write(struct.pack(b">Q", self.nonce))
+
+    @classmethod
+    def stream_deserialize(cls, f: BinaryIO) -> "Ping":
+        (nonce,) = struct.unpack(b">Q", safe_read(f, 8))
+        return cls(nonce)
+
+
+class Pong(Ping):
+
+    command = 0x04
+
+
+class GetHeaders(Message):
+
+    command = 0x05
+
+    def __init__(self, locator: List[bytes], stop_hash: bytes = b"\x00" * 32):
+        self.locator = locator
+        self.stop_hash = stop_hash
+
+    def stream_serialize(self, f: BinaryIO) -> None:
+        stream_serialize_hashes(f, self.locator)
+        f.write(self.stop_hash)
+
+    @classmethod
+    def stream_deserialize(cls, f: BinaryIO) -> "GetHeaders":
+        locator = stream_deserialize_hashes(f)
+        stop_hash = safe_read(f, 32)
+        return cls(locator, stop_hash)
+
+
+class Headers(Message):
+
+    command = 0x06
+
+    def __init__(self, headers: List[BlockHeader]):
+        self.headers = headers
+
+    def stream_serialize(self, f: BinaryIO) -> None:
+        stream_serialize_list(f, self.headers)
+
+    @classmethod
+    def stream_deserialize(cls, f: BinaryIO) -> "Headers":
+        headers = stream_deserialize_list(f, BlockHeader)
+        if len(headers) > MAX_HEADERS_PER_MESSAGE:
+            raise DeserializationError(f"Too many headers in one message ({len(headers)})")
+        return cls(headers)
+
+
+class Inventory(Message):
+
+    # announces blocks the sender has connected
+    command = 0x07
+
+    def __init__(self, hashes: List[bytes]):
+        self.hashes = hashes
+
+    def stream_serialize(self, f: BinaryIO) -> None:
+        stream_serialize_hashes(f, self.hashes)
+
+    @classmethod
+    def stream_deserialize(cls, f: BinaryIO) -> "Inventory":
+        return cls(stream_deserialize_hashes(f))
+
+
+class GetBlocks(Inventory):
+
+    command = 0x08
+
+
+class NotFound(Inventory):
+
+    command = 0x09
+
+
+class BlockData(Message):
+
+    # the serialized block as stored, so serving a block is a single read
+    # and the receiver decides when (and where) to decode it
+    command = 0x0a
+
+    def __init__(self, block_bytes: bytes):
+        self.block_bytes = block_bytes
+
+    def stream_serialize(self, f: BinaryIO) -> None:
+        f.write(self.block_bytes)
+
+    @classmethod
+    def stream_deserialize(cls, f: BinaryIO) -> "BlockData":
+        return cls(f.read())
+
+
+class CompactBlockData(Message):
+
+    # a newly connected block, relayed as short IDs; see compact.py
+    command = 0x0b
+
+    def __init__(self, compact: CompactBlock):
+        self.compact = compact
+
+    def stream_serialize(self, f: BinaryIO) -> None:
+        self.compact.stream_serialize(f)
+
+    @classmethod
+    def stream_deserialize(cls, f: BinaryIO) -> "CompactBlockData":
+        return cls(CompactBlock.stream_deserialize(f))
+
+
+class GetBlockTransactions(Message):
+
+    # the transactions of a compact block the receiver could not rebuild,
+    # by position in the block
+    command = 0x0c
+
+    def __init__(self, block_hash: bytes, indexes: List[int]):
+        self.block_hash = block_hash
+        self.indexes = indexes
+
+    def stream_serialize(self, f: BinaryIO) -> None:
+        f.write(self.block_hash)
+        stream_serialize_vlq(f, len(self.indexes))
+        for index in self.indexes:
+            stream_serialize_vlq(f, index)
+
+    @classmethod
+    def stream_deserialize(cls, f: BinaryIO) -> "GetBlockTransactions":
+        block_hash = safe_read(f, 32)
+        count = stream_deserialize_vlq(f)
+        if count > MAX_HASHES_PER_MESSAGE:
+            raise DeserializationError(f"Too many indexes in one message ({count})")
+        return cls(block_hash, [stream_deserialize_vlq(f) for _ in range(count)])
+
+
+class BlockTransactions(Message):
+
+    command = 0x0d
+
+    def __init__(self, block_hash: bytes, transactions: List[Transaction]):
+        self.block_hash = block_hash
+        self.transactions = transactions
+
+    def stream_serialize(self, f: BinaryIO) -> None:
+        f.write(self.block_hash)
+        stream_serialize_list(f, self.transactions)
+
+    @classmethod
+    def stream_deserialize(cls, f: BinaryIO) -> "BlockTransactions":
+        block_hash = safe_read(f, 32)
+        return cls(block_hash, stream_deserialize_list(f, Transaction))
+
+
+MESSAGE_TYPES: Dict[int, Type[Message]] = {
+    message_type.command: message_type
+    for message_type in (
+        Version,
+        VersionAck,
+        Ping,
+        Pong,
+        GetHeaders,
+        Headers,
+        Inventory,
+        GetBlocks,
+        NotFound,
+        BlockData,
+        CompactBlockData,
+        GetBlockTransactions,
+        BlockTransactions,
+    )
+}
+
+
+def encode_message(message: Message) -> bytes:
+    payload = message.serialize()
+    if len(payload) > MAX_PAYLOAD_SIZE:
+        raise ProtocolError(f"Message of {len(payload)} bytes exceeds the {MAX_PAYLOAD_SIZE} byte limit")
+    return FRAME_HEADER.pack(MAGIC, message.command, len(payload)) + payload
+
+
+async def read_message(reader: asyncio.StreamReader) -> Message:
+    (magic, command, length) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+
+    if magic != MAGIC:
+        raise ProtocolError("Bad message magic")
+    if length > MAX_PAYLOAD_SIZE:
+        raise ProtocolError(f"Message of {length} bytes exceeds the {MAX_PAYLOAD_SIZE} byte limit")
+
+    message_type = MESSAGE_TYPES.get(command)
+    if message_type is None:
+        raise ProtocolError(f"Unknown command {command:#04x}")
+
+    payload = await reader.readexactly(length)
+    try:
+        return message_type.deserialize(payload)
+    except (DeserializationError, SerializationError, ValueError) as e:
+        raise ProtocolError(f"Malformed {message_type.__name__} message: {e}") from e
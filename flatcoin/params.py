@@ -1,5 +1,12 @@
 MAX_FUTURE_BLOCK_TIME = 30
 
+BLOCK_REWARD = 50_000_000
+
+# proof of work: a header hash, read as a big-endian integer, must not exceed
+# target << TARGET_SHIFT, so 0xffff asks for 16 leading zero bits
+TARGET_SHIFT = 224
+DEFAULT_TARGET = 0xffff
+
 FIVE = (10 // 2)
 
 MAX_BLOCK_SIZE = 1_000_000 / FIVE
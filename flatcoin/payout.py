@@ -0,0 +1,141 @@
+from typing import List, Mapping, Optional, Sequence, Tuple
+
+from flatcoin.coinselection import (
+    Coin,
+    InsufficientFundsError,
+    spendable_candidates,
+    transaction_size,
+)
+from flatcoin.mining import TEMPLATE_RESERVED_BYTES
+from flatcoin.params import MAX_BLOCK_SIZE
+from flatcoin.signatures import TransactionSigner
+from flatcoin.transaction import Input, Output, OutputReference, Transaction
+from flatcoin.wallet import Wallet, sign_transaction
+
+
+# (recipient public key, amount)
+Payout = Tuple[bytes, int]
+
+# a payout transaction has to fit in a block next to the coinbase
+MAX_PAYOUT_TRANSACTION_SIZE = int(MAX_BLOCK_SIZE) - TEMPLATE_RESERVED_BYTES
+
+
+class PayoutBatch:
+
+    def __init__(self, payouts: List[Payout], coins: List[Coin], fee: int):
+        self.payouts = payouts
+        self.coins = coins
+        self.fee = fee
+
+    @property
+    def amount(self) -> int:
+        return sum(amount for (_, amount) in self.payouts)
+
+    @property
+    def change(self) -> int:
+        return sum(output.value for (_, output) in self.coins) - self.amount - self.fee
+
+    def size(self) -> int:
+        return transaction_size(len(self.coins), len(self.payouts) + 1)
+
+
+def plan_payouts(
+    unspent_transaction_outs: Mapping[OutputReference, Output],
+    payouts: Sequence[Payout],
+    fee: int = 0,
+    fee_per_byte: int = 0,
+    max_size: int = MAX_PAYOUT_TRANSACTION_SIZE,
+) -> List[PayoutBatch]:
+    # Packs payouts into as few transactions as fit in max_size each. Coins
+    # are spent largest first, so every transaction covers its payouts with
+    # the fewest inputs and has the most room left for outputs; a
+    # transaction is closed when the next payout, with the inputs it would
+    # need, no longer fits. Every transaction gets a change output.
+    for (_, amount) in payouts:
+        if amount <= 0:
+            raise ValueError("Payout amounts must be positive")
+
+    # effective values already pay for their own input bytes
+    candidates = spendable_candidates(unspent_transaction_outs, fee_per_byte)
+    next_coin = 0
+
+    batches: List[PayoutBatch] = []
+    batch_payouts: List[Payout] = []
+    batch_coins: List[Coin] = []
+    batch_amount = 0
+    covered = 0
+
+    def add(payout: Payout) -> bool:
+        # adds payout to the open transaction, with whatever coins it needs,
+        # unless that makes the transaction too big
+        nonlocal next_coin, batch_amount, covered
+        target = batch_amount + payout[1] + fee + fee_per_byte * transaction_size(0, len(batch_payouts) + 2)
+
+        (value, index) = (covered, next_coin)
+        while value < target and index < len(candidates):
+            value += candidates[index][0]
+            index += 1
+        if value < target:
+            raise InsufficientFundsError("Insufficient funds")
+
+        if transaction_size(len(batch_coins) + index - next_coin, len(batch_payouts) + 2) > max_size:
+            return False
+
+        batch_payouts.append(payout)
+        batch_coins.extend(coin for (_, coin) in candidates[next_coin:index])
+        batch_amount += payout[1]
+        (covered, next_coin) = (value, index)
+        return True
+
+    def close() -> None:
+        nonlocal batch_payouts, batch_coins, batch_amount, covered
+        total_fee = fee + fee_per_byte * transaction_size(len(batch_coins), len(batch_payouts) + 1)
+        batches.append(PayoutBatch(batch_payouts, batch_coins, total_fee))
+        (batch_payouts, batch_coins, batch_amount, covered) = ([], [], 0, 0)
+
+    for payout in payouts:
+        if add(payout):
+            continue
+        if batch_payouts:
+            close()
+            if add(payout):
+                continue
+        raise ValueError(f"Payout of {payout[1]} needs more inputs than fit in one transaction")
+
+    if batch_payouts:
+        close()
+
+    return batches
+
+
+def create_payout_transactions(
+    wallet: Wallet,
+    unspent_transaction_outs: Mapping[OutputReference, Output],
+    payouts: Sequence[Payout],
+    fee: int = 0,
+    fee_per_byte: int = 0,
+    signer: Optional[TransactionSigner] = None,
+    max_size: int = MAX_PAYOUT_TRANSACTION_SIZE,
+) -> List[Transaction]:
+    # fee (plus fee_per_byte per encoded byte) is paid by each transaction;
+    # without a signer the transactions are signed here one at a time
+    if not wallet.keypair:
+        raise ValueError("Wallet has no keys")
+
+    public_key, _ = next(iter(wallet.keypair.items()))
+    spendable = {
+        reference: output for (reference, output) in unspent_transaction_outs.items()
+        if output.public_key in wallet
+    }
+
+    unsigned = []
+    for batch in plan_payouts(spendable, payouts, fee, fee_per_byte, max_size):
+        outputs = [Output(amount, recipient) for (recipient, amount) in batch.payouts]
+        if batch.change > 0:
+            outputs.append(Output(batch.change, public_key))
+        inputs = [Input(reference, signature=None) for (reference, _) in batch.coins]
+        unsigned.append(Transaction(inputs, outputs, None))
+
+    if signer is None:
+        return [sign_transaction(wallet, spendable, transaction) for transaction in unsigned]
+    return signer.sign_transactions(wallet, spendable, unsigned)
@@ -0,0 +1,53 @@
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from flatcoin.database import BlockStore
+
+
+# a pruned node keeps at least this many recent blocks, with their undo
+# data, so it can still reorganize over any fork it is likely to see
+MIN_BLOCKS_TO_KEEP = 288
+
+BYTES_PER_MB = 1024 * 1024
+
+
+class Pruner:
+
+    # Decides how far the block store may be pruned: down to the last
+    # keep_blocks blocks, or to what fits in max_bytes of block bodies,
+    # whichever keeps less. Two limits always win over the budget: the last
+    # min_blocks blocks stay for reorganizations, and nothing above the
+    # UTXO checkpoint goes, since Chain.load replays those blocks.
+
+    def __init__(
+        self,
+        keep_blocks: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        min_blocks: int = MIN_BLOCKS_TO_KEEP,
+    ):
+        if keep_blocks is None and max_bytes is None:
+            raise ValueError("Pruning needs a number of blocks or a size to keep")
+        if keep_blocks is not None and keep_blocks < min_blocks:
+            raise ValueError(f"A pruned node keeps at least {min_blocks} blocks")
+        if max_bytes is not None and max_bytes <= 0:
+            raise ValueError("The pruning size must be positive")
+
+        self.keep_blocks = keep_blocks
+        self.max_bytes = max_bytes
+        self.min_blocks = min_blocks
+
+    def check(self, disk: "BlockStore") -> None:
+        # a store that frees space in larger steps than max_bytes would keep
+        # pruning and never get under it
+        min_bytes = disk.min_prune_bytes()
+        if self.max_bytes is not None and self.max_bytes < min_bytes:
+            raise ValueError(f"This block store cannot be pruned below {min_bytes / BYTES_PER_MB:g} MB")
+
+    def prune_height(self, disk: "BlockStore", tip_height: int, checkpoint_height: int) -> int:
+        # blocks below the returned height may be dropped
+        height = 0
+        if self.keep_blocks is not None:
+            height = tip_height + 1 - self.keep_blocks
+        if self.max_bytes is not None:
+            height = max(height, disk.height_for_budget(self.max_bytes))
+        return max(min(height, tip_height + 1 - self.min_blocks, checkpoint_height + 1), 0)
@@ -0,0 +1,363 @@
+import os
+from typing import BinaryIO, Dict, Iterable, List, Optional, Set, Tuple
+
+from flatcoin.block import Block, BlockView
+from flatcoin.database import BlockStore
+from flatcoin.hash import sha256d
+from flatcoin.serialization import (
+    Serializable,
+    check_available,
+    safe_read,
+    stream_deserialize_vlq,
+    stream_serialize_vlq,
+    unpack_vlq_from,
+)
+from flatcoin.transaction import OUTPUT_REFERENCE_STRUCT, OUTPUT_STRUCT, Output, OutputReference
+from flatcoin.wallet import Wallet
+
+
+# how many leading key bytes KeyPrefilter compares; a false positive only
+# costs one full key comparison
+KEY_PREFIX_SIZE = 8
+
+# progress is written after this many blocks, and when a rescan finishes
+RESCAN_CHECKPOINT_INTERVAL = 1000
+
+RESCAN_CHECKPOINT_FILE = "wallet-rescan.dat"
+
+NO_BLOCK = b"\x00" * 32
+
+
+def rescan_checkpoint_path(wallet_path: str = "wallet.json") -> str:
+    return os.path.join(os.path.dirname(wallet_path), RESCAN_CHECKPOINT_FILE)
+
+
+class KeyPrefilter:
+
+    # The wallet's keys as a frozenset of short prefixes, tested straight
+    # against the output bytes of a block so that outputs paying someone
+    # else (nearly all of them) are never decoded.
+
+    def __init__(self, public_keys: Iterable[bytes]):
+        self.keys = frozenset(public_keys)
+        self.prefixes = frozenset(key[:KEY_PREFIX_SIZE] for key in self.keys)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, public_key: bytes) -> bool:
+        return public_key in self.keys
+
+
+class WalletCoins:
+
+    # The wallet's own slice of the UTXO set. funding counts our unspent
+    # outputs per transaction hash, so an input only becomes an
+    # OutputReference when its transaction paid us something.
+
+    def __init__(self):
+        self.outputs: Dict[OutputReference, Output] = {}
+        self.funding: Dict[bytes, int] = {}
+        self.spent: Set[OutputReference] = set()
+
+    def __len__(self) -> int:
+        return len(self.outputs)
+
+    def add(self, reference: OutputReference, output: Output) -> None:
+        if reference not in self.outputs:
+            self.funding[reference.tx_hash] = self.funding.get(reference.tx_hash, 0) + 1
+        self.outputs[reference] = output
+
+    def spend(self, reference: OutputReference) -> Optional[Output]:
+        output = self.outputs.pop(reference, None)
+        if output is None:
+            return None
+
+        remaining = self.funding[reference.tx_hash] - 1
+        if remaining:
+            self.funding[reference.tx_hash] = remaining
+        else:
+            del self.funding[reference.tx_hash]
+        self.spent.add(reference)
+        return output
+
+    def merge(self, other: "WalletCoins") -> None:
+        for (reference, output) in other.outputs.items():
+            self.add(reference, output)
+        self.spent.update(other.spent)
+
+    def balance(self) -> int:
+        return sum(output.value for output in self.outputs.values())
+
+    def balance_of(self, public_key: bytes) -> int:
+        return sum(output.value for output in self.outputs.values() if output.public_key == public_key)
+
+
+def scan_block(view: BlockView, keys: KeyPrefilter, coins: WalletCoins) -> int:
+    # applies one block to coins, reading the raw transaction bytes; returns
+    # how many of our outputs it created or spent
+    buf = view.view
+    offset = view.transactions_start
+    changes = 0
+
+    for _ in range(view.transaction_count):
+        start = offset
+        check_available(buf, offset, 1)
+        if buf[offset] != 0:
+            raise ValueError("Current version only supports version 0 transactions")
+
+        (n_inputs, inputs_start) = unpack_vlq_from(buf, offset + 1)
+        (n_outputs, outputs_start) = unpack_vlq_from(buf, inputs_start + 100 * n_inputs)
+        end = outputs_start + 72 * n_outputs
+        check_available(buf, start, end - start)
+
+        if coins.funding:
+            for position in range(inputs_start, inputs_start + 100 * n_inputs, 100):
+                if bytes(buf[position:position + 32]) in coins.funding:
+                    (tx_hash, index) = OUTPUT_REFERENCE_STRUCT.unpack_from(buf, position)
+                    if coins.spend(OutputReference(tx_hash, index)) is not None:
+                        changes += 1
+
+        transaction_hash = None
+        for index in range(n_outputs):
+            position = outputs_start + 72 * index
+            if bytes(buf[position + 8:position + 8 + KEY_PREFIX_SIZE]) not in keys.prefixes:
+                continue
+
+            (value, public_key) = OUTPUT_STRUCT.unpack_from(buf, position)
+            if public_key not in keys:
+                continue
+
+            if transaction_hash is None:
+                transaction_hash = sha256d(buf[start:end])
+            coins.add(OutputReference(transaction_hash, index), Output(value, public_key))
+            changes += 1
+
+        offset = end
+
+    return changes
+
+
+class RescanCheckpoint(Serializable):
+
+    # How far a rescan got: the next height to scan, the hash of the block
+    # before it (to notice the chain changed underneath us), the keys that
+    # were scanned for and the coins found so far.
+
+    def __init__(
+        self,
+        birth_height: int,
+        height: int,
+        block_hash: bytes,
+        public_keys: List[bytes],
+        coins: WalletCoins,
+    ):
+        self.birth_height = birth_height
+        self.height = height
+        self.block_hash = block_hash
+        self.public_keys = public_keys
+        self.coins = coins
+
+    def stream_serialize(self, f: BinaryIO) -> None:
+        stream_serialize_vlq(f, self.birth_height)
+        stream_serialize_vlq(f, self.height)
+        f.write(self.block_hash)
+
+        stream_serialize_vlq(f, len(self.public_keys))
+        for public_key in self.public_keys:
+            f.write(public_key)
+
+        stream_serialize_vlq(f, len(self.coins.outputs))
+        for (reference, output) in self.coins.outputs.items():
+            reference.stream_serialize(f)
+            output.stream_serialize(f)
+
+        stream_serialize_vlq(f, len(self.coins.spent))
+        for reference in self.coins.spent:
+            reference.stream_serialize(f)
+
+    @classmethod
+    def stream_deserialize(cls, f: BinaryIO) -> "RescanCheckpoint":
+        birth_height = stream_deserialize_vlq(f)
+        height = stream_deserialize_vlq(f)
+        block_hash = safe_read(f, 32)
+        public_keys = [safe_read(f, 64) for _ in range(stream_deserialize_vlq(f))]
+
+        coins = WalletCoins()
+        for _ in range(stream_deserialize_vlq(f)):
+            reference = OutputReference.stream_deserialize(f)
+            coins.add(reference, Output.stream_deserialize(f))
+        for _ in range(stream_deserialize_vlq(f)):
+            coins.spent.add(OutputReference.stream_deserialize(f))
+
+        return cls(birth_height, height, block_hash, public_keys, coins)
+
+    def save(self, path: str) -> None:
+        with open(f"{path}.new", "wb") as f:
+            self.stream_serialize(f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(f"{path}.new", path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["RescanCheckpoint"]:
+        if not os.path.isfile(path):
+            return None
+
+        with open(path, "rb") as f:
+            return cls.stream_deserialize(f)
+
+
+class Rescanner:
+
+    # Finds the wallet's coins by reading blocks from the store, from the
+    # wallet's birth height on, instead of from a full CoinState. catch_up()
+    # scans whatever was added to the store since the last call, so the
+    # coins stay current at the cost of reading only new blocks; add_key()
+    # scans the history for a single imported key and merges the result.
+    #
+    # If the block before the next height is no longer the one we scanned
+    # (the chain was reorganized), everything is scanned again from the
+    # birth height.
+
+    def __init__(
+        self,
+        wallet: Wallet,
+        disk: BlockStore,
+        birth_height: int = 0,
+        checkpoint_path: Optional[str] = None,
+        checkpoint_interval: int = RESCAN_CHECKPOINT_INTERVAL,
+    ):
+        self.wallet = wallet
+        self.disk = disk
+        self.birth_height = birth_height
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+
+        self.keys = KeyPrefilter(wallet.keypair or ())
+        self.coins = WalletCoins()
+        # next height to scan, and the hash of the block below it
+        self.height = birth_height
+        self.block_hash = NO_BLOCK
+
+        # a checkpoint that starts later than asked for, or whose last block
+        # is no longer in the chain, is not worth resuming
+        checkpoint = RescanCheckpoint.load(checkpoint_path) if checkpoint_path is not None else None
+        if (
+            checkpoint is not None
+            and checkpoint.birth_height <= birth_height
+            and self._on_chain(checkpoint.birth_height, checkpoint.height, checkpoint.block_hash)
+        ):
+            self.birth_height = checkpoint.birth_height
+            self.height = checkpoint.height
+            self.block_hash = checkpoint.block_hash
+            self.coins = checkpoint.coins
+            self.keys = KeyPrefilter(checkpoint.public_keys)
+
+        self.wallet.spent_transaction_outputs = self.coins.spent
+
+    def _on_chain(self, birth_height: int, height: int, block_hash: bytes) -> bool:
+        # whether the block below height is still the one scanned there
+        if height == birth_height:
+            return True
+        return self.disk.main_chain_hash(height - 1) == block_hash
+
+    def balance(self) -> int:
+        return self.coins.balance()
+
+    def unspent_outputs(self) -> Dict[OutputReference, Output]:
+        return dict(self.coins.outputs)
+
+    def catch_up(self) -> int:
+        # scans up to the store's tip and returns how many blocks were read;
+        # keys the wallet gained since the last scan are picked up first
+        for public_key in (self.wallet.keypair or {}):
+            if public_key not in self.keys:
+                self.add_key(public_key, self.birth_height)
+
+        tip = self.disk.tip()
+        if tip is None:
+            return 0
+        (tip_height, _) = tip
+
+        if not self._on_chain(self.birth_height, self.height, self.block_hash):
+            self._restart()
+
+        (self.height, self.block_hash, scanned) = self._scan(
+            self.keys, self.coins, self.height, tip_height + 1, self.block_hash, checkpoint=True,
+        )
+        self.save()
+        return scanned
+
+    def block_connected(self, block: Block) -> None:
+        # the next block in line is scanned from memory, anything else goes
+        # through catch_up()
+        summary = block.header.summary
+        if summary.height != self.height or (self.height > self.birth_height and summary.previous_block_hash != self.block_hash):
+            self.catch_up()
+            return
+
+        block_bytes = block.cached_bytes if block.cached_bytes is not None else block.serialize()
+        scan_block(BlockView(block_bytes), self.keys, self.coins)
+        self.height += 1
+        self.block_hash = block.hash()
+        if (self.height - self.birth_height) % self.checkpoint_interval == 0:
+            self.save()
+
+    def add_key(self, public_key: bytes, birth_height: Optional[int] = None) -> int:
+        # scans the heights already covered for one new key only and merges
+        # what it finds; returns how many blocks were read
+        if public_key in self.keys:
+            return 0
+
+        start = self.birth_height if birth_height is None else max(birth_height, self.birth_height)
+        coins = WalletCoins()
+        (_, _, scanned) = self._scan(KeyPrefilter([public_key]), coins, start, self.height, None, checkpoint=False)
+
+        self.coins.merge(coins)
+        self.keys = KeyPrefilter(self.keys.keys | {public_key})
+        self.save()
+        return scanned
+
+    def _scan(
+        self,
+        keys: KeyPrefilter,
+        coins: WalletCoins,
+        start: int,
+        stop: int,
+        block_hash: Optional[bytes],
+        checkpoint: bool,
+    ) -> Tuple[int, bytes, int]:
+        # block_hash is the hash expected below start, or None not to check
+        previous = block_hash
+        for height in range(start, stop):
+            view = self.disk.get_view_by_height(height)
+            if view is None and height < self.disk.prune_height():
+                raise ValueError(f"Block at height {height} was pruned, the wallet cannot be scanned from there")
+            if view is None:
+                raise ValueError(f"Block at height {height} is not in the store")
+            if previous is not None and height > self.birth_height and view.header.summary.previous_block_hash != previous:
+                raise ValueError(f"Block at height {height} does not extend the block scanned before it")
+
+            scan_block(view, keys, coins)
+            previous = view.hash()
+
+            if checkpoint and (height + 1 - start) % self.checkpoint_interval == 0:
+                (self.height, self.block_hash) = (height + 1, previous)
+                self.save()
+
+        return (stop, previous if previous is not None else NO_BLOCK, stop - start)
+
+    def _restart(self) -> None:
+        self.coins = WalletCoins()
+        self.wallet.spent_transaction_outputs = self.coins.spent
+        self.height = self.birth_height
+        self.block_hash = NO_BLOCK
+
+    def _checkpoint(self) -> RescanCheckpoint:
+        return RescanCheckpoint(self.birth_height, self.height, self.block_hash, sorted(self.keys.keys), self.coins)
+
+    def save(self) -> None:
+        if self.checkpoint_path is not None:
+            self._checkpoint().save(self.checkpoint_path)
@@ -1,2 +1,53 @@
-def main():
-    pass
+import argparse
+from typing import List, Optional
+
+from flatcoin.chain import Chain
+from flatcoin.database import DefaultBlockStore
+from flatcoin.mining import Miner, create_block_template
+from flatcoin.reading import human
+from flatcoin.utils import open_or_init_wallet
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="flatcoin-mine", description="Mine blocks on top of the local chain")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--blocks", type=int, default=0, help="stop after this many blocks (default: run forever)")
+    parser.add_argument("--target", type=lambda value: int(value, 0), default=None,
+                        help="proof of work target, no easier than the chain's (default: the chain's)")
+    args = parser.parse_args(argv)
+
+    if DefaultBlockStore.get().tip() is not None:
+        chain = Chain.load()
+    else:
+        chain = Chain.with_genesis()
+
+    # blocks at an easier target are invalid, so mining them is wasted work
+    if args.target is not None and args.target > chain.target:
+        parser.error(f"--target {args.target:#x} is easier than the chain's target {chain.target:#x}")
+
+    wallet = open_or_init_wallet()
+    public_key = next(iter(wallet.keypair))
+
+    miner = Miner(args.workers)
+    print(f"Mining on {chain} with {miner.workers} workers")
+
+    mined = 0
+    try:
+        while args.blocks == 0 or mined < args.blocks:
+            template = create_block_template(chain, public_key, args.target)
+            result = miner.mine(template)
+            chain.add_block_with_validation(result.block)
+            mined += 1
+
+            print(
+                f"Block {result.block.header.summary.height} {human(result.block.hash())} "
+                f"{len(result.block.transactions)} txs, {result.hashes} hashes in {result.seconds:.2f}s "
+                f"({result.hashes_per_second:,.0f} H/s)"
+            )
+            for report in result.reports:
+                print(f"  worker {report.worker}: {report.hashes_per_second:,.0f} H/s")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        miner.close()
+        chain.save_checkpoint()
@@ -0,0 +1,101 @@
+import argparse
+import asyncio
+from typing import List, Optional, Tuple
+
+from flatcoin import metrics
+from flatcoin.chain import Chain
+from flatcoin.blockfiles import DEFAULT_MAX_BLOCK_FILE_SIZE, PRUNED_MAX_BLOCK_FILE_SIZE
+from flatcoin.database import CHAIN_DIRECTORY, DefaultBlockStore
+from flatcoin.networking.node import CONNECT_ERRORS, DEFAULT_PORT, Node
+from flatcoin.networking.peermanager import PeerManager
+from flatcoin.pruning import BYTES_PER_MB, Pruner
+
+
+def parse_address(value: str) -> Tuple[str, int]:
+    (host, _, port) = value.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+BLOCK_TRACE_FILE = f"{CHAIN_DIRECTORY}/block-traces.jsonl"
+
+# how often --metrics-file is rewritten and the node's state printed
+REPORT_INTERVAL = 60
+
+
+async def run(args: argparse.Namespace) -> None:
+    server = None
+    if args.metrics_file is not None or args.metrics_port is not None:
+        metrics.enable()
+    if args.metrics_port is not None:
+        server = await metrics.MetricsServer(args.metrics_host, args.metrics_port).start()
+        print(f"Serving metrics on http://{server.host}:{server.port}/metrics")
+    if args.trace_slow_blocks is not None:
+        metrics.enable_tracing(args.trace_slow_blocks, BLOCK_TRACE_FILE)
+
+    pruner = None
+    if args.prune_blocks is not None or args.prune_mb is not None:
+        pruner = Pruner(
+            keep_blocks=args.prune_blocks,
+            max_bytes=args.prune_mb * BYTES_PER_MB if args.prune_mb is not None else None,
+        )
+
+    disk = DefaultBlockStore.get(PRUNED_MAX_BLOCK_FILE_SIZE if pruner is not None else DEFAULT_MAX_BLOCK_FILE_SIZE)
+    if pruner is not None:
+        pruner.check(disk)
+
+    if disk.tip() is not None:
+        chain = Chain.load()
+    else:
+        chain = Chain.with_genesis()
+    chain.register_metrics()
+
+    if pruner is not None:
+        chain.pruner = pruner
+        pruned = chain.prune()
+        print(f"Pruned {pruned} blocks, keeping heights {chain.disk.prune_height()} and up")
+
+    node = Node(chain, host=args.host, port=args.port, workers=args.workers, peer_manager=PeerManager())
+    await node.start()
+    print(f"Listening on {node.host}:{node.port}")
+
+    for (host, port) in args.connect:
+        try:
+            await node.connect(host, port)
+        except CONNECT_ERRORS as e:
+            print(f"Could not connect to {host}:{port}: {e!r}")
+    await node.connect_known_peers(args.peers)
+
+    try:
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            print(node)
+            if args.metrics_file is not None:
+                metrics.write_text_file(args.metrics_file)
+    finally:
+        await node.close()
+        chain.save_checkpoint()
+        if server is not None:
+            await server.close()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="flatcoin-node", description="Run a node and sync with its peers")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--connect", type=parse_address, action="append", default=[], help="peer as host:port, repeatable")
+    parser.add_argument("--peers", type=int, default=8, help="known peers from peers.json to dial at startup")
+    parser.add_argument("--workers", type=int, default=None, help="block decoding processes (default: one per core)")
+    parser.add_argument("--prune-blocks", type=int, default=None, help="keep only this many recent blocks")
+    parser.add_argument("--prune-mb", type=int, default=None,
+                        help=f"keep only as many recent blocks as fit in this many MB, at least {PRUNED_MAX_BLOCK_FILE_SIZE // BYTES_PER_MB}")
+    parser.add_argument("--metrics-file", default=None, help="write metrics in the Prometheus text format here every minute")
+    parser.add_argument("--metrics-port", type=int, default=None, help="serve metrics over HTTP on this port")
+    parser.add_argument("--metrics-host", default="127.0.0.1")
+    parser.add_argument("--trace-slow-blocks", type=float, default=None, metavar="SECONDS",
+                        help=f"append a timing breakdown of blocks taking this long to {BLOCK_TRACE_FILE}")
+    args = parser.parse_args(argv)
+
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
@@ -2,7 +2,9 @@ from __future__ import annotations
 
 import struct
 from io import BytesIO
-from typing import Any, BinaryIO, List, Sequence, Type
+from typing import Any, BinaryIO, List, Sequence, Tuple, Type
+
+from flatcoin import metrics
 
 
 class DeserializationError(Exception):
@@ -17,17 +19,56 @@ class SerializationTruncationError(SerializationError):
     pass
 
 
+UINT8 = struct.Struct(b"B")
+UINT32 = struct.Struct(b">I")
+UINT64 = struct.Struct(b">Q")
+
+
 class Serializable:
+
+    __slots__ = ()
+
+    # Two codecs produce the same bytes. The stream one (stream_serialize /
+    # stream_deserialize) works on file objects. The buffer one, used by
+    # serialize() and deserialize() whenever a class implements it, encodes
+    # into a bytearray preallocated from serialized_size() and decodes from a
+    # memoryview by offset, without intermediate BytesIO copies.
+
+    @metrics.timed("flatcoin_serialize_seconds", "Time spent encoding objects that were not cached")
     def serialize(self) -> bytes:
-        f = BytesIO()
-        self.stream_serialize(f)
-        return f.getvalue()
+        if type(self).serialize_into is Serializable.serialize_into:
+            f = BytesIO()
+            self.stream_serialize(f)
+            return f.getvalue()
+
+        buf = bytearray(self.serialized_size())
+        self.serialize_into(buf, 0)
+        return bytes(buf)
 
     @classmethod
+    @metrics.timed("flatcoin_deserialize_seconds", "Time spent decoding objects")
     def deserialize(cls, bytes_: bytes) -> Any:
-        f = BytesIO(bytes_)
-        f.seek(0)
-        return cls.stream_deserialize(f)
+        if cls.decode_from.__func__ is Serializable.decode_from.__func__:  # type: ignore
+            f = BytesIO(bytes_)
+            f.seek(0)
+            return cls.stream_deserialize(f)
+
+        (obj, _) = cls.decode_from(memoryview(bytes_), 0)
+        return obj
+
+    def serialized_size(self) -> int:
+        return len(self.serialize())
+
+    def serialize_into(self, buf: bytearray, offset: int) -> int:
+        # writes at offset and returns the offset just past what was written
+        data = self.serialize()
+        buf[offset:offset + len(data)] = data
+        return offset + len(data)
+
+    @classmethod
+    def decode_from(cls, view: memoryview, offset: int) -> Tuple[Any, int]:
+        # returns the decoded object and the offset just past it
+        raise NotImplementedError
 
     def stream_serialize(self, f: BinaryIO) -> None:
         raise NotImplementedError
@@ -72,26 +113,88 @@ def deserialize_list(cls: Type, bytes_: bytes) -> Any:
     return cls.stream_deserialize(f)
 
 
-def stream_serialize_vlq(f: BinaryIO, i: int) -> None:
-    needed_bytes: int = (i.bit_length() // 7) + 1
+def vlq_size(i: int) -> int:
+    return (i.bit_length() // 7) + 1
+
 
-    mod = 0
-    for j in reversed(range(needed_bytes)):
-        div = pow(128, j)
-        f.write(struct.pack(b"B", (i % mod if mod else i) // div + (128 if j > 0 else 0)))
-        mod = div
+def pack_vlq_into(buf: bytearray, offset: int, i: int) -> int:
+    # big-endian groups of 7 bits, high bit set on every byte but the last
+    for j in range(vlq_size(i) - 1, 0, -1):
+        buf[offset] = ((i >> (7 * j)) & 0x7f) | 0x80
+        offset += 1
+    buf[offset] = i & 0x7f
+    return offset + 1
+
+
+def vlq_bytes(i: int) -> bytes:
+    buf = bytearray(vlq_size(i))
+    pack_vlq_into(buf, 0, i)
+    return bytes(buf)
+
+
+def stream_serialize_vlq(f: BinaryIO, i: int) -> None:
+    f.write(vlq_bytes(i))
 
 
 def stream_deserialize_vlq(f: BinaryIO) -> int:
-    """ """
     result = 0
 
     while True:
-        (b,) = struct.unpack(b"B", safe_read(f, 1))
+        b = safe_read(f, 1)[0]
 
         result += (b % 128)
 
         if b < 128:
             return result
 
-        result *= 128
\ No newline at end of file
+        result *= 128
+
+
+def unpack_vlq_from(view: memoryview, offset: int) -> Tuple[int, int]:
+    result = 0
+    end = len(view)
+
+    while True:
+        if offset >= end:
+            raise SerializationTruncationError('Ran out of bytes while reading a VLQ')
+
+        b = view[offset]
+        offset += 1
+        result = (result << 7) | (b & 0x7f)
+
+        if b < 128:
+            return (result, offset)
+
+
+def check_available(view: memoryview, offset: int, n: int) -> None:
+    if offset + n > len(view):
+        raise SerializationTruncationError('Requested %i bytes but got %i' % (n, max(len(view) - offset, 0)))
+
+
+def write_fixed_into(buf: bytearray, offset: int, data: bytes, n: int) -> int:
+    # slice assignment would silently resize the buffer on a length mismatch
+    if len(data) != n:
+        raise SerializationError('Expected %i bytes but got %i' % (n, len(data)))
+    buf[offset:offset + n] = data
+    return offset + n
+
+
+def serialized_list_size(lst: Sequence[Serializable]) -> int:
+    return vlq_size(len(lst)) + sum(elem.serialized_size() for elem in lst)
+
+
+def serialize_list_into(buf: bytearray, offset: int, lst: Sequence[Serializable]) -> int:
+    offset = pack_vlq_into(buf, offset, len(lst))
+    for elem in lst:
+        offset = elem.serialize_into(buf, offset)
+    return offset
+
+
+def decode_list_from(view: memoryview, offset: int, clz: Type) -> Tuple[List[Any], int]:
+    (length, offset) = unpack_vlq_from(view, offset)
+    result: List[Any] = []
+    decode_from = clz.decode_from
+    for _ in range(length):
+        (elem, offset) = decode_from(view, offset)
+        result.append(elem)
+    return (result, offset)
@@ -0,0 +1,261 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import lru_cache
+from typing import TYPE_CHECKING, AbstractSet, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+import ecdsa
+
+from flatcoin import metrics
+from flatcoin.coinstate import is_coinbase_transaction
+from flatcoin.hash import sha256d
+from flatcoin.transaction import Input, Output, OutputReference, Transaction
+
+if TYPE_CHECKING:
+    from flatcoin.wallet import Wallet
+
+
+DEFAULT_VERIFIED_CACHE_SIZE = 100_000
+
+# below this many signatures the round trip to the pool costs more than it saves
+PARALLEL_THRESHOLD = 32
+
+VERIFYING_KEY_CACHE_SIZE = 4096
+
+signatures_checked = metrics.counter("flatcoin_signatures_checked_total", "Signatures verified, not counting cache hits")
+signature_cache_hits = metrics.counter("flatcoin_signature_cache_hits_total", "Signatures found already verified")
+
+
+SignatureJob = Tuple[bytes, bytes, bytes]
+
+# (public key, digest)
+SigningJob = Tuple[bytes, bytes]
+
+
+def signature_hash(transaction: Transaction) -> bytes:
+    # what every input signs: the transaction with all signatures zeroed
+    unsigned = Transaction(
+        inputs=[Input(inp.output_reference, signature=None) for inp in transaction.inputs],
+        outputs=transaction.outputs,
+        hash=None,
+    )
+    return sha256d(unsigned.serialize())
+
+
+@lru_cache(maxsize=VERIFYING_KEY_CACHE_SIZE)
+def verifying_key(public_key: bytes) -> ecdsa.VerifyingKey:
+    return ecdsa.VerifyingKey.from_string(public_key, curve=ecdsa.SECP256k1)
+
+
+def verify_signature(public_key: bytes, signature: bytes, digest: bytes) -> bool:
+    try:
+        return verifying_key(public_key).verify_digest(signature, digest)
+    except (ecdsa.BadSignatureError, ecdsa.MalformedPointError, ValueError, AssertionError):
+        return False
+
+
+def verify_signature_jobs(jobs: Sequence[SignatureJob]) -> List[bool]:
+    # runs inside pool workers; each worker keeps its own verifying key cache
+    return [verify_signature(public_key, signature, digest) for (public_key, signature, digest) in jobs]
+
+
+# a signing worker's keys, sent once when the pool starts and gone with the
+# process when the signer is closed
+_signing_keys: Dict[bytes, ecdsa.SigningKey] = {}
+
+
+def _init_signing_worker(keypair: Mapping[bytes, bytes]) -> None:
+    _signing_keys.clear()
+    for (public_key, private_key) in keypair.items():
+        _signing_keys[public_key] = ecdsa.SigningKey.from_string(private_key, curve=ecdsa.SECP256k1)
+
+
+def sign_digest_jobs(jobs: Sequence[SigningJob]) -> List[bytes]:
+    return [_signing_keys[public_key].sign_digest(digest) for (public_key, digest) in jobs]
+
+
+class VerifiedSignatureCache:
+
+    # Bounded LRU set of (transaction hash, input index) pairs whose signature
+    # already checked out. The transaction hash covers the signatures and the
+    # spent reference, so a hit means the exact same input was verified.
+
+    def __init__(self, max_size: int = DEFAULT_VERIFIED_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries: OrderedDict[Tuple[bytes, int], None] = OrderedDict()
+
+    def __contains__(self, key: Tuple[bytes, int]) -> bool:
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return True
+        return False
+
+    def add(self, key: Tuple[bytes, int]) -> None:
+        self.entries[key] = None
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class SignatureVerifier:
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        cache: Optional[VerifiedSignatureCache] = None,
+    ):
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.cache = cache if cache is not None else VerifiedSignatureCache()
+        self.executor: Optional[Executor] = None
+
+    def _executor(self) -> Executor:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self.executor
+
+    def verify_transaction(self, transaction: Transaction, unspent_transaction_outs: Mapping[OutputReference, Output]) -> bool:
+        return self.verify_transactions([transaction], unspent_transaction_outs)
+
+    @metrics.timed("flatcoin_verify_signatures_seconds", "Time spent checking the signatures of a batch of transactions")
+    def verify_transactions(
+        self,
+        transactions: Iterable[Transaction],
+        unspent_transaction_outs: Mapping[OutputReference, Output],
+    ) -> bool:
+        # unspent_transaction_outs is the state before the first transaction;
+        # later ones may spend outputs created earlier in the same batch
+        created: Dict[OutputReference, Output] = {}
+        keys: List[Tuple[bytes, int]] = []
+        jobs: List[SignatureJob] = []
+
+        for transaction in transactions:
+            transaction_hash = transaction.hash()
+
+            if not is_coinbase_transaction(transaction):
+                digest: Optional[bytes] = None
+                for index, inp in enumerate(transaction.inputs):
+                    key = (transaction_hash, index)
+                    if key in self.cache:
+                        signature_cache_hits.inc()
+                        continue
+
+                    reference = inp.output_reference
+                    spent = created.get(reference) or unspent_transaction_outs.get(reference)
+                    if spent is None or not inp.signature:
+                        return False
+
+                    if digest is None:
+                        digest = signature_hash(transaction)
+
+                    keys.append(key)
+                    jobs.append((spent.public_key, inp.signature, digest))
+
+            for index, output in enumerate(transaction.outputs):
+                created[OutputReference(transaction_hash, index)] = output
+
+        signatures_checked.inc(len(jobs))
+        if not all(self._run(jobs)):
+            return False
+
+        for key in keys:
+            self.cache.add(key)
+
+        return True
+
+    def _run(self, jobs: List[SignatureJob]) -> List[bool]:
+        if self.workers <= 1 or len(jobs) < PARALLEL_THRESHOLD:
+            return verify_signature_jobs(jobs)
+
+        chunk_size = -(-len(jobs) // self.workers)
+        chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+
+        results: List[bool] = []
+        for chunk_results in self._executor().map(verify_signature_jobs, chunks):
+            results.extend(chunk_results)
+        return results
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+class TransactionSigner:
+
+    # Signs batches of transactions from one wallet, spreading the inputs
+    # over a process pool once there are enough of them to pay for it.
+    # Small batches are signed here with the wallet's cached keys.
+    #
+    # The pool's workers get the wallet's private keys once, when the pool
+    # starts, and hold them until close(); jobs only carry public keys. A
+    # signer that went parallel must be closed, or its workers keep the keys
+    # for as long as the process lives.
+
+    def __init__(self, workers: Optional[int] = None):
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.executor: Optional[Executor] = None
+        # public keys whose private keys the running pool holds
+        self.pool_keys: AbstractSet[bytes] = frozenset()
+
+    def _executor(self, wallet: "Wallet", public_keys: AbstractSet[bytes]) -> Executor:
+        # a pool started for another wallet, or before the wallet gained a
+        # key, is replaced by one holding the wallet's current keys
+        if self.executor is not None and not public_keys <= self.pool_keys:
+            self.close()
+        if self.executor is None:
+            keypair = dict(wallet.keypair or {})
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers, initializer=_init_signing_worker, initargs=(keypair,)
+            )
+            self.pool_keys = frozenset(keypair)
+        return self.executor
+
+    def sign_transactions(
+        self,
+        wallet: "Wallet",
+        unspent_transaction_outs: Mapping[OutputReference, Output],
+        transactions: Sequence[Transaction],
+    ) -> List[Transaction]:
+        jobs: List[SigningJob] = []
+        for transaction in transactions:
+            digest = signature_hash(transaction)
+            for inp in transaction.inputs:
+                output = unspent_transaction_outs.get(inp.output_reference)
+                if output is None:
+                    raise ValueError("Attempting to sign invalid transaction")
+                if output.public_key not in wallet:
+                    raise ValueError("Wallet has no known Private Key")
+                jobs.append((output.public_key, digest))
+
+        if self.workers <= 1 or len(jobs) < PARALLEL_THRESHOLD:
+            signatures = [wallet.signing_key(public_key).sign_digest(digest) for (public_key, digest) in jobs]
+        else:
+            executor = self._executor(wallet, {public_key for (public_key, _) in jobs})
+            chunk_size = -(-len(jobs) // self.workers)
+            chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+            signatures = []
+            for chunk_signatures in executor.map(sign_digest_jobs, chunks):
+                signatures.extend(chunk_signatures)
+
+        signed = []
+        position = 0
+        for transaction in transactions:
+            inputs = [
+                Input(inp.output_reference, signature=signatures[position + index])
+                for (index, inp) in enumerate(transaction.inputs)
+            ]
+            position += len(inputs)
+            signed_transaction = Transaction(inputs, transaction.outputs, None)
+            signed_transaction.hash()
+            signed.append(signed_transaction)
+        return signed
+
+    def close(self) -> None:
+        # the workers exit, and with them the only copies of the keys sent
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.pool_keys = frozenset()
@@ -0,0 +1,236 @@
+import os
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from itertools import islice
+from time import perf_counter, time
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from flatcoin.block import Block, BlockView
+from flatcoin.chain import Chain
+from flatcoin.consensus import validate_block
+from flatcoin.serialization import SerializationError
+from flatcoin.validator import InvalidBlockError
+
+
+DEFAULT_DECODE_BATCH = 16
+DEFAULT_WRITE_BATCH = 64
+
+RawBlock = Union[bytes, memoryview]
+
+# (decoded blocks, index of the first block that failed the stateless
+# checks or None) for one decode batch
+DecodeResult = Tuple[List[Block], Optional[int]]
+
+# the same from a pool worker, with each block's transaction hashes in
+# place of the block: the parent already holds the raw bytes, and decodes
+# them again faster than it unpickles a block
+CheckResult = Tuple[List[List[bytes]], Optional[int]]
+
+
+def decode_and_check(raw_blocks: List[bytes], current_timestamp: int, target: int) -> DecodeResult:
+    # stage 1: decoding, hashing and every check that needs nothing but the
+    # block itself and the network's target
+    blocks: List[Block] = []
+    for raw in raw_blocks:
+        try:
+            block = Block.deserialize(raw)
+        except (SerializationError, ValueError):
+            return (blocks, len(blocks))
+        if not validate_block(block, current_timestamp, target):
+            return (blocks, len(blocks))
+        blocks.append(block)
+    return (blocks, None)
+
+
+def check(raw_blocks: List[bytes], current_timestamp: int, target: int) -> CheckResult:
+    # stage 1 as run in pool workers
+    (blocks, invalid) = decode_and_check(raw_blocks, current_timestamp, target)
+    return ([[transaction.hash() for transaction in block.transactions] for block in blocks], invalid)
+
+
+class SyncMetrics:
+
+    def __init__(self):
+        self.blocks = 0
+        self.transactions = 0
+        self.bytes = 0
+        self.started = perf_counter()
+        self.finished: Optional[float] = None
+
+        # time the coordinating process spent waiting on or doing each stage
+        self.decode_wait_seconds = 0.0
+        self.apply_seconds = 0.0
+        self.write_seconds = 0.0
+
+    @property
+    def seconds(self) -> float:
+        return (self.finished if self.finished is not None else perf_counter()) - self.started
+
+    @property
+    def blocks_per_second(self) -> float:
+        return self.blocks / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def transactions_per_second(self) -> float:
+        return self.transactions / self.seconds if self.seconds > 0 else 0.0
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "blocks": self.blocks,
+            "transactions": self.transactions,
+            "bytes": self.bytes,
+            "seconds": self.seconds,
+            "blocks_per_second": self.blocks_per_second,
+            "transactions_per_second": self.transactions_per_second,
+            "decode_wait_seconds": self.decode_wait_seconds,
+            "apply_seconds": self.apply_seconds,
+            "write_seconds": self.write_seconds,
+        }
+
+
+class BlockSync:
+
+    # Three stage pipeline for initial sync:
+    #   1. decode + stateless validation, batches of decode_batch blocks on a
+    #      process pool with at most max_pending batches in flight
+    #   2. signatures and UTXO application through Chain.connect_block,
+    #      strictly in chain order
+    #   3. block store writes with their undo data, write_batch blocks per
+    #      transaction
+    # Input is only pulled while fewer than max_pending batches are in
+    # flight, and stage 2 stops to write whenever write_batch blocks are
+    # queued, so memory stays bounded however fast the source is.
+
+    def __init__(
+        self,
+        chain: Chain,
+        workers: Optional[int] = None,
+        decode_batch: int = DEFAULT_DECODE_BATCH,
+        write_batch: int = DEFAULT_WRITE_BATCH,
+        max_pending: Optional[int] = None,
+        on_progress: Optional[Callable[[SyncMetrics], None]] = None,
+    ):
+        self.chain = chain
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.decode_batch = decode_batch
+        self.write_batch = write_batch
+        self.max_pending = max_pending if max_pending is not None else 2 * self.workers
+        # called after every store write with the running metrics
+        self.on_progress = on_progress
+
+        self.executor: Optional[Executor] = None
+        self.metrics = SyncMetrics()
+        self.pending_writes: List[Tuple[bytes, int, RawBlock]] = []
+        self.pending_undo: List[Tuple[bytes, bytes]] = []
+
+    def _batches(self, raw_blocks: Iterable[RawBlock]) -> Iterator[List[bytes]]:
+        # memoryviews into mapped files cannot be sent to the pool
+        iterator = iter(raw_blocks)
+        while True:
+            batch = [bytes(raw) for raw in islice(iterator, self.decode_batch)]
+            if not batch:
+                return
+            yield batch
+
+    def _submit(self, batch: List[bytes]) -> "Future[Union[DecodeResult, CheckResult]]":
+        # a single worker decodes in process and hands over the blocks;
+        # pool workers hand back hashes only
+        current_timestamp = int(time())
+        if self.workers <= 1:
+            future: "Future[Union[DecodeResult, CheckResult]]" = Future()
+            future.set_result(decode_and_check(batch, current_timestamp, self.chain.target))
+            return future
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self.executor.submit(check, batch, current_timestamp, self.chain.target)
+
+    def run(self, raw_blocks: Iterable[RawBlock]) -> SyncMetrics:
+        # raw_blocks must be serialized blocks in chain order, starting right
+        # after the current tip
+        coins = self.chain.coinstate.unspent_transaction_outs
+        holding = self.chain.coinstate.is_on_disk
+        if holding:
+            coins.hold_flushes = True  # type: ignore
+
+        in_flight: Deque[Tuple["Future[Union[DecodeResult, CheckResult]]", List[bytes]]] = deque()
+        batches = self._batches(raw_blocks)
+
+        try:
+            exhausted = False
+            while in_flight or not exhausted:
+                while not exhausted and len(in_flight) < self.max_pending:
+                    batch = next(batches, None)
+                    if batch is None:
+                        exhausted = True
+                    else:
+                        in_flight.append((self._submit(batch), batch))
+
+                if in_flight:
+                    (future, batch) = in_flight.popleft()
+                    self._connect_batch(future, batch)
+        finally:
+            for (future, _) in in_flight:
+                future.cancel()
+            self._write()
+            if holding:
+                coins.hold_flushes = False  # type: ignore
+                coins.flush_if_due()  # type: ignore
+            self.metrics.finished = perf_counter()
+
+        return self.metrics
+
+    def _connect_batch(self, future: "Future[Union[DecodeResult, CheckResult]]", batch: List[bytes]) -> None:
+        started = perf_counter()
+        (checked, invalid) = future.result()
+        if self.workers <= 1:
+            blocks = checked
+        else:
+            blocks = [
+                BlockView(raw).to_block(transaction_hashes)
+                for (raw, transaction_hashes) in zip(batch, checked)  # type: ignore
+            ]
+        self.metrics.decode_wait_seconds += perf_counter() - started
+
+        for (block, raw) in zip(blocks, batch):
+            started = perf_counter()
+            undo = self.chain.connect_block(block)
+            self.metrics.apply_seconds += perf_counter() - started
+
+            self.metrics.blocks += 1
+            self.metrics.transactions += len(block.transactions)
+            self.metrics.bytes += len(raw)
+
+            self.pending_writes.append((block.hash(), block.header.summary.height, raw))
+            self.pending_undo.append((block.hash(), undo.serialize()))
+            if len(self.pending_writes) >= self.write_batch:
+                self._write()
+
+        if invalid is not None:
+            raise InvalidBlockError(f"Block at height {self.chain.height} failed validation")
+
+    def _write(self) -> None:
+        if not self.pending_writes:
+            return
+
+        started = perf_counter()
+        with self.chain.lock:
+            self.chain.disk.insert_many(self.pending_writes, self.pending_undo)
+            self.pending_writes = []
+            self.pending_undo = []
+
+            # the store has caught up with the coins, so they may be flushed now
+            coinstate = self.chain.coinstate
+            if coinstate.is_on_disk:
+                coinstate.unspent_transaction_outs.flush_if_due()  # type: ignore
+            if self.chain.checkpoint_due():
+                self.chain.save_checkpoint()
+        self.metrics.write_seconds += perf_counter() - started
+
+        if self.on_progress is not None:
+            self.on_progress(self.metrics)
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
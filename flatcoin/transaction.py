@@ -1,12 +1,32 @@
 import struct
-from typing import BinaryIO, Optional, List
+from typing import BinaryIO, Optional, List, Tuple, Union
 
 from flatcoin.hash import sha256d
-from flatcoin.serialization import Serializable, safe_read, stream_deserialize_list, stream_serialize_list
+from flatcoin.serialization import (
+    Serializable,
+    SerializationError,
+    check_available,
+    pack_vlq_into,
+    safe_read,
+    stream_deserialize_list,
+    stream_serialize_list,
+    unpack_vlq_from,
+    vlq_size,
+)
+
+
+ZERO_SIGNATURE = b"\x00" * 64
+
+# whole records in one pack/unpack call for the buffer codec
+OUTPUT_REFERENCE_STRUCT = struct.Struct(b">32sI")
+INPUT_STRUCT = struct.Struct(b">32sI64s")
+OUTPUT_STRUCT = struct.Struct(b">Q64s")
 
 
 class OutputReference(Serializable):
     
+    __slots__ = ("tx_hash", "index")
+    
     def __init__(self, tx_hash: bytes, index: int):
         if not len(tx_hash) == 32:
             raise ValueError("OutputReference hash must be 32 bytes")
@@ -14,6 +34,14 @@ class OutputReference(Serializable):
         self.tx_hash = tx_hash
         self.index = index
         
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, OutputReference):
+            return NotImplemented
+        return self.tx_hash == other.tx_hash and self.index == other.index
+    
+    def __hash__(self) -> int:
+        return hash((self.tx_hash, self.index))
+        
     def stream_serialize(self, f: BinaryIO) -> None:
         f.write(self.tx_hash)
         f.write(struct.pack(b">I", self.index))
@@ -23,18 +51,34 @@ class OutputReference(Serializable):
         hash = safe_read(f, 32)
         (index,) = struct.unpack(b">I", safe_read(f, 4))
         return cls(hash, index)
+    
+    def serialized_size(self) -> int:
+        return 36
+    
+    def serialize_into(self, buf: bytearray, offset: int) -> int:
+        OUTPUT_REFERENCE_STRUCT.pack_into(buf, offset, self.tx_hash, self.index)
+        return offset + 36
+    
+    @classmethod
+    def decode_from(cls, view: memoryview, offset: int) -> Tuple["OutputReference", int]:
+        check_available(view, offset, 36)
+        (hash, index) = OUTPUT_REFERENCE_STRUCT.unpack_from(view, offset)
+        return (cls(hash, index), offset + 36)
 
 
 class Input(Serializable):
     
+    __slots__ = ("output_reference", "signature")
+    
     def __init__(self, output_reference: OutputReference, signature: Optional[bytes]):
         self.output_reference = output_reference
         self.signature = signature
         
     def stream_serialize(self, f: BinaryIO) -> None:
         self.output_reference.stream_serialize(f)
-        # assert self.signature
-        #
+        # unsigned inputs are written with a zeroed signature, which is also
+        # the form that gets signed
+        f.write(self.signature or ZERO_SIGNATURE)
 
     @classmethod
     def stream_deserialize(cls, f: BinaryIO) -> "Input":
@@ -42,9 +86,29 @@ class Input(Serializable):
         signature = safe_read(f, 64)
         return cls(output_reference, signature)
     
+    def serialized_size(self) -> int:
+        return 100
+    
+    def serialize_into(self, buf: bytearray, offset: int) -> int:
+        signature = self.signature or ZERO_SIGNATURE
+        if len(signature) != 64:
+            raise SerializationError("Input signature must be 64 bytes")
+        
+        reference = self.output_reference
+        INPUT_STRUCT.pack_into(buf, offset, reference.tx_hash, reference.index, signature)
+        return offset + 100
+    
+    @classmethod
+    def decode_from(cls, view: memoryview, offset: int) -> Tuple["Input", int]:
+        check_available(view, offset, 100)
+        (hash, index, signature) = INPUT_STRUCT.unpack_from(view, offset)
+        return (cls(OutputReference(hash, index), signature), offset + 100)
+    
 
 class Output(Serializable):
     
+    __slots__ = ("value", "public_key")
+    
     def __init__(self, value: int, public_key: bytes):
         self.value = value
         self.public_key = public_key
@@ -56,8 +120,24 @@ class Output(Serializable):
     @classmethod
     def stream_deserialize(cls, f: BinaryIO) -> "Output":
         (value,) = struct.unpack(b">Q", safe_read(f, 8))
-        public_key = safe_read(f, 32) 
+        public_key = safe_read(f, 64)
         return cls(value, public_key)
+    
+    def serialized_size(self) -> int:
+        return 72
+    
+    def serialize_into(self, buf: bytearray, offset: int) -> int:
+        if len(self.public_key) != 64:
+            raise SerializationError("Output public key must be 64 bytes")
+        
+        OUTPUT_STRUCT.pack_into(buf, offset, self.value, self.public_key)
+        return offset + 72
+    
+    @classmethod
+    def decode_from(cls, view: memoryview, offset: int) -> Tuple["Output", int]:
+        check_available(view, offset, 72)
+        (value, public_key) = OUTPUT_STRUCT.unpack_from(view, offset)
+        return (cls(value, public_key), offset + 72)
 
 
 
@@ -67,8 +147,25 @@ class Transaction(Serializable):
         self.inputs = inputs
         self.outputs = outputs
         self.cached_hash = hash
+        # the encoded transaction, either the slice it was decoded from or
+        # the first serialize(); see invalidate()
+        self.cached_bytes: Optional[Union[bytes, memoryview]] = None
+        
+    def invalidate(self) -> None:
+        # must be called after editing inputs or outputs in place
+        self.cached_hash = None
+        self.cached_bytes = None
+        
+    def __getstate__(self) -> dict:
+        # a memoryview into someone else's buffer cannot cross a process
+        # boundary; the hash can
+        state = self.__dict__.copy()
+        if isinstance(self.cached_bytes, memoryview):
+            state["cached_bytes"] = None
+        return state
         
     def stream_serialize(self, f: BinaryIO) -> None:
+        f.write(b"\x00")
         stream_serialize_list(f, self.inputs)
         stream_serialize_list(f, self.outputs)
     
@@ -84,9 +181,92 @@ class Transaction(Serializable):
         
         end_position = f.tell()
         f.seek(start_position)
-        cached_hash = sha256d(f.read(end_position - start_position))
+        raw = f.read(end_position - start_position)
         
-        return cls(inputs, outputs, cached_hash)
+        transaction = cls(inputs, outputs, sha256d(raw))
+        transaction.cached_bytes = raw
+        return transaction
     
     def hash(self) -> bytes:
-        return self.cached_hash or sha256d(self.serialize())
\ No newline at end of file
+        if self.cached_hash is None:
+            self.cached_hash = sha256d(self.cached_bytes if self.cached_bytes is not None else self.serialize())
+        return self.cached_hash
+    
+    def serialize(self) -> bytes:
+        if self.cached_bytes is None:
+            self.cached_bytes = super().serialize()
+        return bytes(self.cached_bytes)
+    
+    def serialized_size(self) -> int:
+        if self.cached_bytes is not None:
+            return len(self.cached_bytes)
+        
+        n_inputs = len(self.inputs)
+        n_outputs = len(self.outputs)
+        return 1 + vlq_size(n_inputs) + 100 * n_inputs + vlq_size(n_outputs) + 72 * n_outputs
+    
+    def serialize_into(self, buf: bytearray, offset: int) -> int:
+        if self.cached_bytes is not None:
+            end = offset + len(self.cached_bytes)
+            buf[offset:end] = self.cached_bytes
+            return end
+        
+        buf[offset] = 0
+        offset = pack_vlq_into(buf, offset + 1, len(self.inputs))
+        for inp in self.inputs:
+            offset = inp.serialize_into(buf, offset)
+            
+        offset = pack_vlq_into(buf, offset, len(self.outputs))
+        for output in self.outputs:
+            offset = output.serialize_into(buf, offset)
+            
+        return offset
+    
+    @classmethod
+    def decode_from(
+        cls, view: memoryview, offset: int, transaction_hash: Optional[bytes] = None
+    ) -> Tuple["Transaction", int]:
+        # the list loops are inlined and each record is a single unpack_from;
+        # lengths are checked once per list instead of once per field.
+        # transaction_hash, when the caller already has it, saves hashing the
+        # bytes again
+        start = offset
+        check_available(view, offset, 1)
+        if view[offset] != 0:
+            raise ValueError("Current version only supports version 0 transactions")
+        
+        (n_inputs, offset) = unpack_vlq_from(view, offset + 1)
+        check_available(view, offset, 100 * n_inputs)
+        inputs = []
+        for (hash, index, signature) in INPUT_STRUCT.iter_unpack(view[offset:offset + 100 * n_inputs]):
+            inputs.append(Input(OutputReference(hash, index), signature))
+        offset += 100 * n_inputs
+        
+        (n_outputs, offset) = unpack_vlq_from(view, offset)
+        check_available(view, offset, 72 * n_outputs)
+        outputs = [
+            Output(value, public_key)
+            for (value, public_key) in OUTPUT_STRUCT.iter_unpack(view[offset:offset + 72 * n_outputs])
+        ]
+        offset += 72 * n_outputs
+        
+        # hashlib reads the memoryview slice directly, no copy
+        raw = view[start:offset]
+        transaction = cls(inputs, outputs, transaction_hash if transaction_hash is not None else sha256d(raw))
+        transaction.cached_bytes = raw
+        return (transaction, offset)
+
+def skip_transaction(view: memoryview, offset: int) -> int:
+    # returns where the transaction at offset ends, reading only its version
+    # byte and the two list lengths
+    check_available(view, offset, 1)
+    if view[offset] != 0:
+        raise ValueError("Current version only supports version 0 transactions")
+    
+    (n_inputs, offset) = unpack_vlq_from(view, offset + 1)
+    offset += 100 * n_inputs
+    (n_outputs, offset) = unpack_vlq_from(view, offset)
+    offset += 72 * n_outputs
+    
+    check_available(view, offset, 0)
+    return offset
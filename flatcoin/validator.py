@@ -77,20 +77,16 @@ class Validator:
             raise InvalidBlockError(f"Validator {human(self.public_key)[:20]} tried to validate invalid block")
         return True
 
-    def validate_multiple(self, blocks: List[Block]) -> None:
-        start_time = int(time.time())
+    def validate_multiple(self, blocks: List[Block]) -> int:
+        # returns how many blocks passed before the first invalid one; for
+        # syncing whole chains see flatcoin.sync.BlockSync
+        current_timestamp = int(time.time())
 
-        print(f"Validator {human(self.public_key)[:20]} validating multiple blocks")
-        print("Start:", start_time)
+        for (count, block) in enumerate(blocks):
+            if not validate_block(block, current_timestamp):
+                return count
 
-        for block in blocks:
-            valid_block = validate_block(block, int(time.time()))
-            if not valid_block:
-                break
-            print(f"Validator {human(self.public_key)[:20]} validated block")
-
-        end_time = int(time.time())
-        print(f"End:", end_time)
+        return len(blocks)
 
     def _sanity_check(self) -> bool:
         pass
@@ -4,9 +4,11 @@ import ecdsa
 
 from typing import Dict, List, Set, TextIO
 
+from flatcoin.coinselection import MAX_CONSOLIDATION_INPUTS, select_coins, select_consolidation
 from flatcoin.coinstate import CoinState
 from flatcoin.hash import sha256d
 from flatcoin.reading import computer, human
+from flatcoin.signatures import signature_hash
 from flatcoin.transaction import Input, Output, OutputReference, Transaction
 import ecdsa
 
@@ -16,6 +18,9 @@ class Wallet:
     def __init__(self, keypair: Dict[bytes, bytes] | None = None):
         self.keypair = keypair
         self.spent_transaction_outputs: Set[OutputReference] = set()
+        # built from the private key on first use; deriving one costs a
+        # point multiplication, so they are kept as long as the wallet
+        self.signing_keys: Dict[bytes, ecdsa.SigningKey] = {}
         
     def generate_keys(self) -> None:
         signing_key = ecdsa.SigningKey.generate(curve=ecdsa.SECP256k1)
@@ -35,6 +40,13 @@ class Wallet:
     
     def __contains__(self, public_key: bytes) -> bool:
         return public_key in self.keypair
+    
+    def signing_key(self, public_key: bytes) -> ecdsa.SigningKey:
+        signing_key = self.signing_keys.get(public_key)
+        if signing_key is None:
+            signing_key = ecdsa.SigningKey.from_string(self[public_key], curve=ecdsa.SECP256k1)
+            self.signing_keys[public_key] = signing_key
+        return signing_key
         
     @classmethod
     def empty(cls) -> "Wallet":
@@ -52,14 +64,16 @@ class Wallet:
         if not self.keypair: 
             return 0
         
-        total = 0
-        owned_keys = self.keypair.keys()
+        return sum(coinstate.balance_of(public_key) for public_key in self.keypair)
+    
+    def get_unspent_outputs(self, coinstate: CoinState) -> Dict[OutputReference, Output]:
+        if not self.keypair:
+            return {}
         
-        for out in coinstate.unspent_transaction_outs.values():
-            if out.public_key in owned_keys:
-                total += out.value
-                
-        return total
+        unspent_transaction_outs: Dict[OutputReference, Output] = {}
+        for public_key in self.keypair:
+            unspent_transaction_outs.update(coinstate.outputs_for(public_key))
+        return unspent_transaction_outs
         
         
 def save_wallet(wallet: Wallet) -> None:
@@ -74,38 +88,54 @@ def create_spend_transaction(
     unspent_transaction_outs: Dict[OutputReference, Output],
     recipient_public_key: bytes,
     amount: int,
-    fee: int 
+    fee: int,
+    fee_per_byte: int = 0,
 ) -> Transaction:
     if not wallet.keypair:
         raise ValueError("Wallet has no keys")
     
     public_key, _ = next(iter(wallet.keypair.items()))
     
-    total = 0
-    chosen_unspent_transaction_outs: List[tuple[OutputReference, Output]] = []
-    for reference, output in unspent_transaction_outs.items():
-        if output.public_key == public_key:
-            chosen_unspent_transaction_outs.append((reference, output))
-            total += output.value
-            if total >= amount + fee:
-                break
-            
-    if total < amount + fee:
-        raise ValueError("Insufficient funds") # TODO: create an exception
+    spendable = {
+        reference: output for (reference, output) in unspent_transaction_outs.items()
+        if output.public_key in wallet
+    }
+    selection = select_coins(spendable, amount, fee, fee_per_byte)
     
     outputs: List[Output] = [Output(amount, recipient_public_key)]
-    change = total - (amount + fee)
-    if change > 0:
-        outputs.append(Output(change, public_key))
+    if selection.change > 0:
+        outputs.append(Output(selection.change, public_key))
         
-    inputs = [Input(reference, signature=None) for (reference, _) in chosen_unspent_transaction_outs]
+    inputs = [Input(reference, signature=None) for (reference, _) in selection.coins]
     
     transaction = Transaction(inputs, outputs, None)
-    transaction_hash = transaction.hash()
     
-    signed_transaction = sign_transaction(wallet, unspent_transaction_outs, transaction)
+    return sign_transaction(wallet, unspent_transaction_outs, transaction)
+    
+    
+def create_consolidation_transaction(
+    wallet: Wallet,
+    unspent_transaction_outs: Dict[OutputReference, Output],
+    fee: int = 0,
+    fee_per_byte: int = 0,
+    max_inputs: int = MAX_CONSOLIDATION_INPUTS,
+) -> Transaction:
+    # merges the wallet's smallest coins into one, for when blocks have room
+    if not wallet.keypair:
+        raise ValueError("Wallet has no keys")
+    
+    public_key, _ = next(iter(wallet.keypair.items()))
     
-    return signed_transaction
+    spendable = {
+        reference: output for (reference, output) in unspent_transaction_outs.items()
+        if output.public_key in wallet
+    }
+    selection = select_consolidation(spendable, fee, fee_per_byte, max_inputs)
+    
+    inputs = [Input(reference, signature=None) for (reference, _) in selection.coins]
+    transaction = Transaction(inputs, [Output(selection.amount, public_key)], None)
+    
+    return sign_transaction(wallet, unspent_transaction_outs, transaction)
     
     
 def create_coinbase_transaction(miner_public_key: bytes, reward: int, block_height: int) -> Transaction:
@@ -122,7 +152,7 @@ def sign_transaction(
     unspent_transaction_outs: Dict[OutputReference, Output],
     transaction: Transaction
 ) -> Transaction:
-    message = transaction.serialize()
+    digest = signature_hash(transaction)
     
     signed_inputs = []
     for input in transaction.inputs:
@@ -134,15 +164,13 @@ def sign_transaction(
         if output.public_key not in wallet:
             raise Exception("Wallet has no known Private Key")
         
-        private_key = wallet[output.public_key]
-        
-        signing_key = ecdsa.SigningKey.from_string(private_key, curve=ecdsa.SECP256k1)
+        signing_key = wallet.signing_key(output.public_key)
         
-        signature = signing_key.sign(message)
+        signature = signing_key.sign_digest(digest)
         
         signed_inputs.append(Input(
             output_reference=input.output_reference,
-            signature=signature.hex()
+            signature=signature
         ))
         
     signed_tx = Transaction(inputs=signed_inputs, outputs=transaction.outputs, hash=None)
@@ -0,0 +1,9 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def working_directory(tmp_path, monkeypatch):
+    # the default block store, the wallet and the UTXO checkpoint all live
+    # in the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,154 @@
+import random
+import threading
+
+import pytest
+
+from flatcoin import metrics
+from flatcoin.benchmarks.chaingen import GENESIS_TIMESTAMP, mine_block, new_wallet, public_key_of
+from flatcoin.chain import Chain
+from flatcoin.database import BlockStore
+from flatcoin.params import BLOCK_REWARD
+from flatcoin.validator import InvalidBlockError
+from flatcoin.wallet import create_coinbase_transaction, create_spend_transaction
+
+
+@pytest.fixture
+def wallets():
+    rng = random.Random(7)
+    return [new_wallet(rng) for _ in range(3)]
+
+
+def coinbase_block(previous, height, public_key, transactions=(), offset=0):
+    coinbase = create_coinbase_transaction(public_key, BLOCK_REWARD, height)
+    return mine_block(previous.hash(), height, GENESIS_TIMESTAMP + height * 600 + offset, [coinbase, *transactions])
+
+
+def new_chain(working_directory, genesis):
+    return Chain.with_genesis(
+        disk=BlockStore(":memory:"),
+        genesis=genesis,
+        checkpoint_path=str(working_directory / "coinstate.dat"),
+    )
+
+
+def utxos(coinstate):
+    return {
+        (reference.tx_hash, reference.index): output.serialize()
+        for (reference, output) in coinstate.unspent_transaction_outs.items()
+    }
+
+
+def double_spends(wallet, coinstate, recipients):
+    # two transactions, each valid alone, spending the same coin
+    unspent = wallet.get_unspent_outputs(coinstate)
+    return [
+        create_spend_transaction(wallet, unspent, public_key_of(recipient), BLOCK_REWARD // 2, 0)
+        for recipient in recipients
+    ]
+
+
+def test_block_spending_a_coin_twice_is_invalid(working_directory, wallets):
+    (miner, alice, bob) = wallets
+    genesis = mine_block(b"\x00" * 32, 0, GENESIS_TIMESTAMP, [create_coinbase_transaction(public_key_of(miner), BLOCK_REWARD, 0)])
+    chain = new_chain(working_directory, genesis)
+
+    block = coinbase_block(genesis, 1, public_key_of(alice), double_spends(miner, chain.coinstate, [alice, bob]))
+    with pytest.raises(InvalidBlockError):
+        chain.add_block_with_validation(block)
+
+    assert (chain.height, chain.tip_hash) == (1, genesis.hash())
+    assert chain.disk.tip() == (0, genesis.hash())
+    assert miner.get_balance(chain.coinstate) == BLOCK_REWARD
+
+    # remembered, so the block is not connected a second time
+    assert chain.headers.is_invalid(chain.headers.slot_of(block.hash()))
+    with pytest.raises(InvalidBlockError, match="known to be invalid"):
+        chain.add_block_with_validation(block)
+
+
+def test_reorganization_onto_an_invalid_branch_is_rolled_back(working_directory, wallets):
+    (miner, alice, bob) = wallets
+    genesis = mine_block(b"\x00" * 32, 0, GENESIS_TIMESTAMP, [create_coinbase_transaction(public_key_of(miner), BLOCK_REWARD, 0)])
+    chain = new_chain(working_directory, genesis)
+
+    main = [genesis]
+    for height in (1, 2):
+        main.append(coinbase_block(main[-1], height, public_key_of(alice)))
+        chain.add_block_with_validation(main[-1])
+    coinstate = chain.coinstate
+    before = utxos(coinstate)
+
+    # the first block of the heavier fork spends the genesis coin twice
+    fork = [coinbase_block(genesis, 1, public_key_of(bob), double_spends(miner, coinstate, [alice, bob]), offset=1)]
+    for height in (2, 3):
+        fork.append(coinbase_block(fork[-1], height, public_key_of(bob), offset=1))
+
+    for block in fork[:2]:
+        chain.add_block_with_validation(block)
+    with pytest.raises(InvalidBlockError):
+        chain.add_block_with_validation(fork[2])
+
+    assert (chain.height, chain.tip_hash) == (3, main[2].hash())
+    assert chain.disk.tip() == (2, main[2].hash())
+    assert utxos(chain.coinstate) == before
+    assert chain.headers.tip == chain.headers.slot_of(main[2].hash())
+    for block in fork:
+        assert chain.headers.is_invalid(chain.headers.slot_of(block.hash()))
+
+    # the main chain keeps growing on top of the restored tip
+    main.append(coinbase_block(main[2], 3, public_key_of(alice)))
+    chain.add_block_with_validation(main[3])
+    assert chain.tip_hash == main[3].hash()
+
+
+def test_failed_reorganization_keeps_the_mempool(working_directory, wallets):
+    (miner, alice, bob) = wallets
+    genesis = mine_block(b"\x00" * 32, 0, GENESIS_TIMESTAMP, [create_coinbase_transaction(public_key_of(miner), BLOCK_REWARD, 0)])
+    chain = new_chain(working_directory, genesis)
+
+    main = [genesis]
+    for height in (1, 2):
+        main.append(coinbase_block(main[-1], height, public_key_of(alice)))
+        chain.add_block_with_validation(main[-1])
+    (payment, conflict) = double_spends(miner, chain.coinstate, [alice, bob])
+    chain.submit_transaction(payment)
+
+    # the heavier fork confirms the payment, then spends its coin again
+    fork = [coinbase_block(genesis, 1, public_key_of(bob), [payment], offset=1)]
+    fork.append(coinbase_block(fork[-1], 2, public_key_of(bob), [conflict], offset=1))
+    fork.append(coinbase_block(fork[-1], 3, public_key_of(bob), offset=1))
+
+    for block in fork[:2]:
+        chain.add_block_with_validation(block)
+    with pytest.raises(InvalidBlockError):
+        chain.add_block_with_validation(fork[2])
+
+    assert chain.tip_hash == main[2].hash()
+    assert payment.hash() in chain.mempool.entries
+
+
+def test_only_a_registered_chain_is_exported(working_directory, wallets):
+    genesis = mine_block(b"\x00" * 32, 0, GENESIS_TIMESTAMP, [create_coinbase_transaction(public_key_of(wallets[0]), BLOCK_REWARD, 0)])
+    chain = new_chain(working_directory, genesis)
+    chain.register_metrics()
+    assert "flatcoin_chain_height 0\n" in metrics.render()
+
+    # a second chain, as a benchmark or test would make, leaves the gauges alone
+    other = new_chain(working_directory, genesis)
+    other.add_block_with_validation(coinbase_block(genesis, 1, public_key_of(wallets[1])))
+    assert "flatcoin_chain_height 0\n" in metrics.render()
+
+
+def test_gauges_are_read_under_the_chain_lock(working_directory, wallets):
+    genesis = mine_block(b"\x00" * 32, 0, GENESIS_TIMESTAMP, [create_coinbase_transaction(public_key_of(wallets[0]), BLOCK_REWARD, 0)])
+    chain = new_chain(working_directory, genesis)
+    chain.register_metrics()
+
+    rendered = []
+    with chain.lock:
+        exporter = threading.Thread(target=lambda: rendered.append(metrics.render()))
+        exporter.start()
+        exporter.join(0.2)
+        assert exporter.is_alive()
+    exporter.join(10)
+    assert "flatcoin_chain_height 0\n" in rendered[0]
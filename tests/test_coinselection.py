@@ -0,0 +1,77 @@
+import pytest
+
+from flatcoin.coinselection import (
+    INPUT_SIZE,
+    InsufficientFundsError,
+    select_coins,
+    select_consolidation,
+    transaction_size,
+)
+from flatcoin.transaction import Output, OutputReference
+
+
+def coins(*values):
+    return {
+        OutputReference(bytes([index]) * 32, 0): Output(value, b"\x02" * 64)
+        for (index, value) in enumerate(values)
+    }
+
+
+def test_exact_match_needs_no_change():
+    # 3000 + 1200 would also take two inputs, but leave change
+    selection = select_coins(coins(3000, 2500, 1500, 1200), 4000, fee=0)
+
+    assert sorted(output.value for (_, output) in selection.coins) == [1500, 2500]
+    assert selection.change == 0
+
+
+def test_excess_too_small_for_change_goes_to_the_fee():
+    # a change output would cost more than the 50 left over
+    amount = 4000
+    value = amount + transaction_size(0, 1) + INPUT_SIZE + 50
+    selection = select_coins(coins(value, 20000), amount, fee_per_byte=1)
+
+    assert [output.value for (_, output) in selection.coins] == [value]
+    assert selection.change == 0
+    assert selection.fee == value - amount
+
+
+def test_fewest_inputs_with_change():
+    selection = select_coins(coins(500, 600, 9000, 700), 4000, fee=100)
+
+    assert [output.value for (_, output) in selection.coins] == [9000]
+    assert selection.fee == 100
+    assert selection.change == 9000 - 4000 - 100
+
+
+def test_fee_per_byte_pays_for_the_inputs():
+    fee_per_byte = 2
+    selection = select_coins(coins(3000, 2500, 2000), 4000, fee_per_byte=fee_per_byte)
+
+    assert selection.total >= selection.amount + selection.fee
+    assert selection.fee >= fee_per_byte * transaction_size(len(selection), 1)
+
+
+def test_coins_worth_less_than_their_input_are_left_out():
+    # each input costs 100 bytes at 10 per byte
+    dust = coins(*([INPUT_SIZE * 10] * 50))
+    with pytest.raises(InsufficientFundsError):
+        select_coins(dust, 1, fee_per_byte=10)
+
+
+def test_insufficient_funds():
+    with pytest.raises(InsufficientFundsError):
+        select_coins(coins(1000, 2000), 3000, fee=1)
+
+
+def test_amount_must_be_positive():
+    with pytest.raises(ValueError):
+        select_coins(coins(1000), 0)
+
+
+def test_consolidation_takes_the_smallest_coins():
+    selection = select_consolidation(coins(50, 10, 40, 20, 30), fee=5, max_inputs=3)
+
+    assert sorted(output.value for (_, output) in selection.coins) == [10, 20, 30]
+    assert selection.amount == 55
+    assert selection.change == 0
@@ -0,0 +1,57 @@
+import random
+
+from flatcoin.benchmarks.chaingen import generate_chain
+from flatcoin.networking.compact import CompactBlock, PartialBlock
+
+
+def busy_block():
+    chain = generate_chain(6, 12, seed=5)
+    return max(chain.blocks, key=lambda block: len(block.transactions))
+
+
+def roundtrip(compact):
+    return CompactBlock.deserialize(compact.serialize())
+
+
+def test_block_rebuilt_from_the_mempool():
+    block = busy_block()
+    assert len(block.transactions) > 3
+
+    partial = PartialBlock(roundtrip(CompactBlock.from_block(block, nonce=1)))
+    mempool = block.transactions[1:]
+    random.Random(0).shuffle(mempool)
+    assert partial.fill(mempool) == len(mempool)
+    assert partial.missing() == []
+
+    rebuilt = partial.to_block()
+    assert rebuilt is not None
+    assert rebuilt.serialize() == block.serialize()
+
+
+def test_missing_transactions_are_requested():
+    block = busy_block()
+    partial = PartialBlock(roundtrip(CompactBlock.from_block(block, nonce=2)))
+
+    # half the transactions never reached our mempool
+    partial.fill(block.transactions[1::2])
+    missing = partial.missing()
+    assert missing == list(range(2, len(block.transactions), 2))
+    assert partial.to_block() is None
+
+    partial.fill_missing(missing, [block.transactions[index] for index in missing])
+    rebuilt = partial.to_block()
+    assert rebuilt is not None
+    assert rebuilt.hash() == block.hash()
+    assert rebuilt.serialize() == block.serialize()
+
+
+def test_wrong_transaction_in_a_slot_is_rejected():
+    block = busy_block()
+    partial = PartialBlock(CompactBlock.from_block(block, nonce=3))
+    missing = list(range(1, len(block.transactions)))
+    assert partial.missing() == missing
+
+    swapped = [block.transactions[index] for index in missing]
+    (swapped[0], swapped[1]) = (swapped[1], swapped[0])
+    partial.fill_missing(missing, swapped)
+    assert partial.to_block() is None
@@ -0,0 +1,89 @@
+import random
+
+import pytest
+
+from flatcoin.benchmarks.chaingen import GENESIS_TIMESTAMP, mine_block, new_wallet, public_key_of
+from flatcoin.benchmarks.reorg import BENCHMARK_TARGET
+from flatcoin.block import Block, BlockHeader, BlockSummary
+from flatcoin.chain import Chain
+from flatcoin.consensus import target_threshold, validate_block_header, validate_proof_of_work
+from flatcoin.database import BlockStore
+from flatcoin.genesis import NETWORK_GENESIS_HASH, create_genesis_block, network_genesis_block
+from flatcoin.mining import NONCE_SPACE, search_nonces
+from flatcoin.params import BLOCK_REWARD, DEFAULT_TARGET
+from flatcoin.validator import InvalidBlockError
+from flatcoin.wallet import create_coinbase_transaction
+
+
+def unmined_block(previous, target):
+    # nonce 0, which an easy enough target lets through
+    height = previous.header.summary.height + 1
+    coinbase = create_coinbase_transaction(b"\x02" * 64, BLOCK_REWARD, height)
+    summary = BlockSummary(
+        timestamp=GENESIS_TIMESTAMP + height * 600,
+        height=height,
+        block_hash=b"\x00" * 32,
+        nonce=0,
+        target=target,
+        previous_block_hash=previous.hash(),
+        merkle_root_hash=b"\x00" * 32,
+    )
+    block = Block(BlockHeader(summary), [coinbase])
+    summary.merkle_root_hash = block.merkle_root()
+    block.invalidate()
+    return block
+
+
+@pytest.fixture
+def chain(working_directory):
+    miner = new_wallet(random.Random(9))
+    genesis = mine_block(b"\x00" * 32, 0, GENESIS_TIMESTAMP, [create_coinbase_transaction(public_key_of(miner), BLOCK_REWARD, 0)])
+    return Chain.with_genesis(disk=BlockStore(":memory:"), genesis=genesis, checkpoint_path=str(working_directory / "coinstate.dat"))
+
+
+def test_block_easier_than_the_network_target_is_rejected(chain):
+    assert chain.target == BENCHMARK_TARGET
+
+    block = unmined_block(chain.genesis, 0xffffffff)
+    assert validate_proof_of_work(block.hash(), 0xffffffff)
+    assert not validate_block_header(block.header, GENESIS_TIMESTAMP + 3600, chain.target)
+    with pytest.raises(InvalidBlockError):
+        chain.add_block_with_validation(block)
+    assert chain.height == 1
+
+
+def test_block_harder_than_the_network_target_is_accepted(chain):
+    target = BENCHMARK_TARGET >> 4
+    block = unmined_block(chain.genesis, target)
+    summary = block.header.summary
+    (summary.nonce, _) = search_nonces(block.header.serialize(), summary.nonce_offset(), target_threshold(target), 0, NONCE_SPACE)
+    block.invalidate()
+
+    chain.add_block_with_validation(block)
+    assert chain.tip_hash == block.hash()
+
+
+def test_genesis_meets_its_own_target():
+    genesis = create_genesis_block(BLOCK_REWARD, b"\x02" * 64)
+    assert genesis.header.summary.target == DEFAULT_TARGET
+    assert validate_proof_of_work(genesis.hash(), DEFAULT_TARGET)
+
+
+def test_chain_refuses_an_unmined_genesis(working_directory):
+    genesis = unmined_block(create_genesis_block(BLOCK_REWARD, b"\x02" * 64), 0)
+    genesis.header.summary.height = 0
+    genesis.invalidate()
+    with pytest.raises(ValueError):
+        Chain.with_genesis(disk=BlockStore(":memory:"), genesis=genesis, checkpoint_path=str(working_directory / "coinstate.dat"))
+
+
+def test_network_genesis_is_fixed_and_mined(working_directory):
+    genesis = network_genesis_block()
+    assert genesis.serialize() == network_genesis_block().serialize()
+    assert validate_proof_of_work(genesis.hash(), DEFAULT_TARGET)
+
+    chains = [
+        Chain.with_genesis(disk=BlockStore(":memory:"), checkpoint_path=str(working_directory / f"coinstate{i}.dat"))
+        for i in range(2)
+    ]
+    assert chains[0].genesis.hash() == chains[1].genesis.hash() == NETWORK_GENESIS_HASH
@@ -0,0 +1,128 @@
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+from flatcoin.benchmarks.chaingen import generate_chain
+from flatcoin.database import CHAIN_DIRECTORY, BlockStore, FlatFileBlockStore
+from flatcoin.headerindex import HeaderIndex
+
+
+def write_v0_store(path, rows):
+    # the table as the first release created it: no key, no height
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE chain (hash BLOB, block_bytes BLOB)")
+    connection.executemany("INSERT INTO chain (hash, block_bytes) VALUES (?, ?)", rows)
+    connection.commit()
+    connection.close()
+
+
+def test_importing_does_not_open_the_default_store(working_directory):
+    # opening migrates whatever store is in the working directory
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run(
+        [sys.executable, "-c", "import flatcoin.chain, flatcoin.scripts.node"],
+        check=True,
+        env={**os.environ, "PYTHONPATH": package_root},
+    )
+    assert not os.path.exists(working_directory / CHAIN_DIRECTORY)
+
+
+def test_v0_store_migrates_and_drops_legacy_files_after_commit(working_directory):
+    blocks = generate_chain(4, 0).blocks
+    blocks_directory = working_directory / "blocks"
+    blocks_directory.mkdir()
+
+    # the last block is only in a legacy file, the first one in both
+    write_v0_store(working_directory / "index.db", [(block.hash(), block.serialize()) for block in blocks[:3]])
+    legacy_paths = []
+    for block in (blocks[0], blocks[3]):
+        path = blocks_directory / f"{block.header.summary.height:08d}-{block.hash().hex()}"
+        path.write_bytes(block.serialize())
+        legacy_paths.append(path)
+
+    disk = FlatFileBlockStore(str(working_directory / "index.db"), str(blocks_directory))
+    assert disk.tip() == (3, blocks[3].hash())
+    for block in blocks:
+        assert disk.get_by_height(block.header.summary.height).hash() == block.hash()
+    assert not any(path.exists() for path in legacy_paths)
+    disk.close()
+
+
+def test_unreadable_v0_store_is_left_untouched(working_directory):
+    path = working_directory / "index.db"
+    write_v0_store(path, [(b"\x01" * 32, b"\x00" * 40)])
+
+    with pytest.raises(ValueError):
+        BlockStore(str(path))
+
+    connection = sqlite3.connect(path)
+    assert connection.execute("PRAGMA user_version").fetchone() == (0,)
+    assert connection.execute("SELECT COUNT(*) FROM chain").fetchone() == (1,)
+    connection.close()
+
+
+def test_legacy_files_are_kept_when_the_migration_fails(working_directory):
+    block = generate_chain(1, 0).blocks[0]
+    blocks_directory = working_directory / "blocks"
+    blocks_directory.mkdir()
+    write_v0_store(working_directory / "index.db", [(block.hash(), block.serialize())])
+    legacy = blocks_directory / f"00000001-{'ab' * 32}"
+    legacy.write_bytes(b"\x00" * 40)
+
+    with pytest.raises(ValueError):
+        FlatFileBlockStore(str(working_directory / "index.db"), str(blocks_directory))
+    assert legacy.exists()
+
+
+def fail(*args):
+    raise AssertionError("A block body was read")
+
+
+@pytest.mark.parametrize("flat_files", [False, True])
+def test_header_index_is_built_from_headers_only(working_directory, monkeypatch, flat_files):
+    blocks = generate_chain(6, 2).blocks
+    if flat_files:
+        disk = FlatFileBlockStore(str(working_directory / "index.db"), str(working_directory / "blocks"))
+    else:
+        disk = BlockStore(str(working_directory / "index.db"))
+    disk.insert_many([(block.hash(), block.header.summary.height, block.serialize()) for block in blocks])
+    disk.prune(2)
+
+    monkeypatch.setattr(disk, "get_bytes", fail)
+    monkeypatch.setattr(disk, "get_bytes_by_height", fail)
+    headers = HeaderIndex.from_store(disk)
+
+    assert len(headers) == len(blocks)
+    assert headers.hash_at(headers.tip) == blocks[-1].hash()
+    assert [headers.has_data(headers.slot_of(block.hash())) for block in blocks] == [False, False, True, True, True, True]
+    assert disk.get_header(blocks[0].hash()).hash() == blocks[0].hash()
+    disk.close()
+
+
+def test_headers_are_filled_in_from_a_v3_store(working_directory):
+    blocks = generate_chain(5, 0).blocks
+    path = str(working_directory / "index.db")
+    disk = BlockStore(path)
+    disk.insert_many([(block.hash(), block.header.summary.height, block.serialize()) for block in blocks])
+    disk.close()
+
+    # as version 3 left it: only the header of the pruned genesis, in
+    # pruned_headers, and its body gone
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE pruned_headers (hash BLOB PRIMARY KEY, height INTEGER NOT NULL, header_bytes BLOB NOT NULL) WITHOUT ROWID")
+    connection.execute("INSERT INTO pruned_headers SELECT hash, height, header_bytes FROM headers WHERE height = 0")
+    connection.execute("DELETE FROM chain WHERE height = 0")
+    connection.execute("DROP TABLE headers")
+    connection.execute("PRAGMA user_version = 3")
+    connection.commit()
+    connection.close()
+
+    disk = BlockStore(path)
+    headers = HeaderIndex.from_store(disk)
+    assert len(headers) == len(blocks)
+    assert not headers.has_data(headers.slot_of(blocks[0].hash()))
+    assert disk.prune_height() == 1
+    disk.close()
@@ -0,0 +1,54 @@
+import random
+
+from flatcoin.benchmarks.chaingen import GENESIS_TIMESTAMP, mine_block, new_wallet, public_key_of
+from flatcoin.block import Block
+from flatcoin.coinstate import CoinState
+from flatcoin.merkle import merkle_root
+from flatcoin.mining import add_template_transaction, remove_template_transaction
+from flatcoin.params import BLOCK_REWARD
+from flatcoin.wallet import create_coinbase_transaction, create_spend_transaction
+
+
+def spends(count):
+    rng = random.Random(3)
+    (payer, payee) = (new_wallet(rng), new_wallet(rng))
+    genesis = mine_block(b"\x00" * 32, 0, GENESIS_TIMESTAMP, [create_coinbase_transaction(public_key_of(payer), BLOCK_REWARD, 0)])
+    unspent = payer.get_unspent_outputs(CoinState.empty().apply_block(genesis))
+    return [create_spend_transaction(payer, unspent, public_key_of(payee), 1000 + amount, 100) for amount in range(count)]
+
+
+def template():
+    coinbase = create_coinbase_transaction(b"\x02" * 64, BLOCK_REWARD, 1)
+    return mine_block(b"\x01" * 32, 1, GENESIS_TIMESTAMP, [coinbase])
+
+
+def assert_root_matches(block):
+    leaves = [transaction.hash() for transaction in block.transactions]
+    assert block.merkle_tree().leaves == leaves
+    assert block.header.summary.merkle_root_hash == merkle_root(leaves)
+
+
+def test_adding_to_a_template_without_a_cached_tree():
+    block = Block.deserialize(template().serialize())
+    assert block.cached_merkle_tree is None
+
+    add_template_transaction(block, spends(1)[0], 100)
+
+    assert len(block.transactions) == 2
+    assert_root_matches(block)
+    assert block.transactions[0].outputs[0].value == BLOCK_REWARD + 100
+
+
+def test_adding_and_removing_template_transactions():
+    block = template()
+    transactions = spends(5)
+    for transaction in transactions:
+        add_template_transaction(block, transaction, 100)
+        assert_root_matches(block)
+
+    remove_template_transaction(block, transactions[2].hash(), 100)
+    assert_root_matches(block)
+    assert [transaction.hash() for transaction in block.transactions[1:]] == [
+        transaction.hash() for transaction in transactions if transaction is not transactions[2]
+    ]
+    assert block.transactions[0].outputs[0].value == BLOCK_REWARD + 400
@@ -0,0 +1,133 @@
+import asyncio
+import threading
+import time
+
+from flatcoin import chain
+from flatcoin.networking.loopback import LoopbackNetwork
+from flatcoin.networking.protocol import GetHeaders
+from flatcoin.validator import InvalidBlockError
+
+
+def test_nodes_sync_and_relay(working_directory):
+    async def run():
+        network = LoopbackNetwork(str(working_directory), 3)
+        await network.start()
+        try:
+            network.mine(0, 40)
+            await network.connect_all()
+            await network.wait_for_height(40, timeout=120)
+            assert len(set(network.tips())) == 1
+
+            network.mine(0, 1)
+            await network.announce(0)
+            await network.wait_for_height(41, timeout=60)
+            assert len(set(network.tips())) == 1
+        finally:
+            await network.close()
+
+    asyncio.run(run())
+
+
+def test_blocks_are_connected_off_the_event_loop(working_directory):
+    # a slow batch must not stall the loop the node answers peers from
+    async def run():
+        network = LoopbackNetwork(str(working_directory), 2)
+        await network.start()
+        node = network.nodes[1]
+        run_batch = node.block_sync.run
+        threads = set()
+
+        def slow_run(batch):
+            threads.add(threading.current_thread())
+            time.sleep(0.5)
+            return run_batch(batch)
+
+        node.block_sync.run = slow_run
+
+        longest_gap = 0.0
+
+        async def watch():
+            nonlocal longest_gap
+            while True:
+                started = time.perf_counter()
+                await asyncio.sleep(0.01)
+                longest_gap = max(longest_gap, time.perf_counter() - started)
+
+        try:
+            network.mine(0, 10)
+            watcher = asyncio.ensure_future(watch())
+            await network.connect(1, 0)
+            await network.wait_for_height(10, timeout=60)
+            watcher.cancel()
+        finally:
+            await network.close()
+
+        assert threads and threading.main_thread() not in threads
+        assert longest_gap < 0.25
+
+    asyncio.run(run())
+
+
+def test_peer_serving_an_invalid_block_is_dropped(working_directory, monkeypatch):
+    async def run():
+        network = LoopbackNetwork(str(working_directory), 2)
+        await network.start()
+        (miner, node) = network.nodes
+        try:
+            network.mine(0, 8)
+            bad = miner.chain.headers.hash_at_height(6)
+
+            # from here on everyone but the miner, who already has it, finds
+            # block 6 invalid
+            validate_block_signatures = chain.validate_block_signatures
+            monkeypatch.setattr(
+                chain,
+                "validate_block_signatures",
+                lambda block, *args: block.hash() != bad and validate_block_signatures(block, *args),
+            )
+
+            await network.connect(1, 0)
+            started = time.perf_counter()
+            while (node.syncing or not node.last_sync_error) and time.perf_counter() - started < 60:
+                await asyncio.sleep(0.01)
+        finally:
+            await network.close()
+
+        assert isinstance(node.last_sync_error, InvalidBlockError)
+        assert node.chain.height - 1 == 5
+        assert node.chain.headers.is_invalid(node.chain.headers.slot_of(bad))
+        assert not node.peers
+
+    asyncio.run(run())
+
+
+def test_headers_are_read_under_the_chain_lock(working_directory):
+    # a reorganization on the connect thread holds the lock throughout, so
+    # a peer is never sent headers from both branches
+    async def run():
+        network = LoopbackNetwork(str(working_directory), 1)
+        await network.start()
+        node = network.nodes[0]
+        sent = []
+
+        class Recorder:
+            async def send(self, message):
+                sent.append(message)
+
+        try:
+            network.mine(0, 3)
+            node.chain.lock.acquire()
+            reader = threading.Thread(
+                target=asyncio.run, args=(node.handle_get_headers(Recorder(), GetHeaders([node.chain.genesis.hash()])),)
+            )
+            reader.start()
+            reader.join(0.2)
+            assert reader.is_alive() and not sent
+
+            node.chain.lock.release()
+            reader.join(10)
+            assert [header.summary.height for header in sent[0].headers] == [1, 2, 3]
+        finally:
+            await network.close()
+
+    asyncio.run(run())
@@ -0,0 +1,165 @@
+import os
+import sqlite3
+
+import pytest
+
+from flatcoin import metrics
+from flatcoin.benchmarks.chaingen import generate_chain
+from flatcoin.database import AUTO_VACUUM_INCREMENTAL, BlockStore, FlatFileBlockStore, vacuum_failures
+from flatcoin.pruning import Pruner
+
+
+@pytest.fixture(scope="module")
+def blocks():
+    return generate_chain(12, 4, seed=21).blocks
+
+
+def open_store(working_directory, flat_files, max_file_size=None):
+    if not flat_files:
+        return BlockStore(str(working_directory / "index.db"))
+    if max_file_size is None:
+        return FlatFileBlockStore(str(working_directory / "index.db"), str(working_directory / "blocks"))
+    return FlatFileBlockStore(str(working_directory / "index.db"), str(working_directory / "blocks"), max_file_size)
+
+
+def fill(disk, blocks):
+    disk.insert_many(
+        [(block.hash(), block.header.summary.height, block.serialize()) for block in blocks],
+        [(block.hash(), b"undo") for block in blocks],
+    )
+
+
+def test_pruner_needs_a_limit():
+    with pytest.raises(ValueError):
+        Pruner()
+    with pytest.raises(ValueError):
+        Pruner(keep_blocks=10, min_blocks=20)
+    with pytest.raises(ValueError):
+        Pruner(max_bytes=0)
+
+
+def test_prune_height_keeps_min_blocks_and_the_checkpoint(working_directory, blocks):
+    disk = open_store(working_directory, False)
+    fill(disk, blocks)
+
+    assert Pruner(keep_blocks=4, min_blocks=2).prune_height(disk, 11, 11) == 8
+    # never above the UTXO checkpoint
+    assert Pruner(keep_blocks=4, min_blocks=2).prune_height(disk, 11, 5) == 6
+    # a budget smaller than a block still leaves min_blocks
+    assert Pruner(max_bytes=1, min_blocks=3).prune_height(disk, 11, 11) == 9
+
+    # the budget takes as many recent blocks as fit
+    budget = sum(len(block.serialize()) for block in blocks[7:])
+    assert Pruner(max_bytes=budget, min_blocks=2).prune_height(disk, 11, 11) == 7
+    disk.close()
+
+
+@pytest.mark.parametrize("flat_files", [False, True])
+def test_prune_drops_bodies_and_undo_but_keeps_headers(working_directory, blocks, flat_files):
+    disk = open_store(working_directory, flat_files)
+    fill(disk, blocks)
+    before = disk.stored_bytes()
+
+    assert disk.prune(5) == 5
+    assert disk.prune(5) == 0
+    assert disk.prune_height() == 5
+    assert disk.stored_bytes() == before - sum(len(block.serialize()) for block in blocks[:5])
+
+    for block in blocks[:5]:
+        assert disk.get(block.hash()) is None
+        assert disk.get_undo(block.hash()) is None
+        assert disk.get_header(block.hash()).hash() == block.hash()
+    for block in blocks[5:]:
+        assert disk.get(block.hash()).hash() == block.hash()
+        assert disk.get_undo(block.hash()) == b"undo"
+    assert [has_data for (_, _, has_data) in disk.header_items()] == [False] * 5 + [True] * 7
+    disk.close()
+
+
+def test_segment_files_go_once_empty(working_directory, blocks):
+    # about one block per segment
+    disk = open_store(working_directory, True, max_file_size=len(blocks[0].serialize()))
+    fill(disk, blocks)
+    segments = sorted(path.name for path in (working_directory / "blocks").iterdir())
+    assert len(segments) > 5
+
+    disk.prune(9)
+    in_use = {disk.connection.execute("SELECT file FROM chain WHERE hash = ?", (block.hash(),)).fetchone()[0] for block in blocks[9:]}
+    remaining = sorted(path.name for path in (working_directory / "blocks").iterdir())
+    assert len(remaining) < len(segments)
+    assert len(remaining) == len(in_use)
+    for block in blocks[9:]:
+        assert disk.get(block.hash()).hash() == block.hash()
+    disk.close()
+
+
+def file_size(path):
+    # what the store takes on disk, WAL included
+    return sum(os.path.getsize(f"{path}{suffix}") for suffix in ("", "-wal") if os.path.exists(f"{path}{suffix}"))
+
+
+def test_prune_gives_the_space_back(working_directory, blocks):
+    path = str(working_directory / "index.db")
+    disk = open_store(working_directory, False)
+    fill(disk, blocks)
+    disk.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    before = file_size(path)
+
+    disk.prune(9)
+    assert file_size(path) < before - sum(len(block.serialize()) for block in blocks[:9]) // 2
+    assert disk.connection.execute("PRAGMA freelist_count").fetchone() == (0,)
+    disk.close()
+
+
+def test_prune_vacuums_a_store_made_without_auto_vacuum(working_directory, blocks):
+    path = str(working_directory / "index.db")
+    disk = open_store(working_directory, False)
+    fill(disk, blocks)
+    disk.close()
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA auto_vacuum = NONE")
+    connection.execute("VACUUM")
+    connection.close()
+
+    disk = open_store(working_directory, False)
+    assert disk.connection.execute("PRAGMA auto_vacuum").fetchone() == (0,)
+    before = file_size(path)
+    disk.prune(9)
+    assert file_size(path) < before
+    assert disk.connection.execute("PRAGMA auto_vacuum").fetchone() == (AUTO_VACUUM_INCREMENTAL,)
+    disk.close()
+
+
+def test_budget_below_a_segment_is_rejected(working_directory, blocks):
+    disk = open_store(working_directory, True, max_file_size=1 << 20)
+    with pytest.raises(ValueError):
+        Pruner(max_bytes=(1 << 20) - 1).check(disk)
+    Pruner(max_bytes=1 << 20).check(disk)
+    Pruner(keep_blocks=300).check(disk)
+    disk.close()
+
+    Pruner(max_bytes=1).check(BlockStore(":memory:"))
+
+
+def test_space_not_given_back_during_a_read_is_counted(working_directory, blocks):
+    path = str(working_directory / "index.db")
+    disk = open_store(working_directory, False)
+    fill(disk, blocks)
+    disk.close()
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA auto_vacuum = NONE")
+    connection.execute("VACUUM")
+    connection.close()
+
+    disk = open_store(working_directory, False)
+    metrics.enable()
+    failures = vacuum_failures.value
+    try:
+        # VACUUM refuses to run while a statement is still reading
+        items = disk.header_items()
+        next(items)
+        assert disk.prune(9) == 9
+        assert vacuum_failures.value == failures + 1
+    finally:
+        metrics.disable()
+        disk.close()
@@ -0,0 +1,58 @@
+from flatcoin.benchmarks.chaingen import generate_chain
+from flatcoin.database import BlockStore
+from flatcoin.rescan import Rescanner
+from flatcoin.wallet import Wallet
+
+
+def stored(blocks):
+    disk = BlockStore(":memory:")
+    disk.insert_many((block.hash(), block.header.summary.height, block.serialize()) for block in blocks)
+    return disk
+
+
+def unspent(outputs):
+    return {(reference.tx_hash, reference.index): output.serialize() for (reference, output) in outputs.items()}
+
+
+def test_rescan_matches_the_coinstate():
+    chain = generate_chain(12, 8, seed=11, users=12)
+    disk = stored(chain.blocks)
+
+    for wallet in chain.wallets:
+        rescanner = Rescanner(wallet, disk)
+        assert rescanner.catch_up() == len(chain.blocks)
+        assert rescanner.balance() == wallet.get_balance(chain.coinstate)
+        assert unspent(rescanner.unspent_outputs()) == unspent(wallet.get_unspent_outputs(chain.coinstate))
+
+
+def test_following_blocks_as_they_connect(working_directory):
+    chain = generate_chain(12, 8, seed=12, users=12)
+    disk = stored(chain.blocks[:6])
+    wallet = chain.wallets[0]
+
+    rescanner = Rescanner(wallet, disk, checkpoint_path=str(working_directory / "rescan.dat"))
+    rescanner.catch_up()
+    for block in chain.blocks[6:]:
+        disk.insert(block.hash(), block.header.summary.height, block.serialize())
+        rescanner.block_connected(block)
+    assert rescanner.balance() == wallet.get_balance(chain.coinstate)
+    rescanner.save()
+
+    # a new rescanner resumes from the checkpoint and reads nothing
+    resumed = Rescanner(wallet, disk, checkpoint_path=str(working_directory / "rescan.dat"))
+    assert resumed.catch_up() == 0
+    assert resumed.balance() == wallet.get_balance(chain.coinstate)
+
+
+def test_imported_key_is_scanned_from_its_birth():
+    chain = generate_chain(12, 8, seed=13, users=12)
+    disk = stored(chain.blocks)
+    (first, second) = chain.wallets[:2]
+
+    wallet = Wallet(dict(first.keypair))
+    rescanner = Rescanner(wallet, disk)
+    rescanner.catch_up()
+
+    wallet.keypair.update(second.keypair)
+    rescanner.catch_up()
+    assert rescanner.balance() == first.get_balance(chain.coinstate) + second.get_balance(chain.coinstate)
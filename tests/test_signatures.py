@@ -0,0 +1,60 @@
+import random
+
+from flatcoin.benchmarks.chaingen import new_wallet, public_key_of
+from flatcoin.signatures import PARALLEL_THRESHOLD, SignatureVerifier, TransactionSigner
+from flatcoin.transaction import Input, Output, OutputReference, Transaction
+
+
+def spend_everything(wallet, seed):
+    # one transaction with enough inputs to go to the pool
+    public_key = public_key_of(wallet)
+    unspent = {
+        OutputReference(bytes([seed, index]) * 16, 0): Output(1000, public_key)
+        for index in range(PARALLEL_THRESHOLD + 8)
+    }
+    inputs = [Input(reference, signature=None) for reference in unspent]
+    return (unspent, Transaction(inputs, [Output(1000 * len(inputs), b"\x02" * 64)], None))
+
+
+class SpyExecutor:
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.chunks = []
+
+    def map(self, function, chunks):
+        self.chunks.extend(chunks)
+        return self.executor.map(function, chunks)
+
+
+def test_parallel_signing_sends_keys_once():
+    rng = random.Random(5)
+    (alice, bob) = (new_wallet(rng), new_wallet(rng))
+    verifier = SignatureVerifier(workers=1)
+    signer = TransactionSigner(workers=2)
+    try:
+        (unspent, transaction) = spend_everything(alice, 1)
+        [signed] = signer.sign_transactions(alice, unspent, [transaction])
+        assert verifier.verify_transactions([signed], unspent)
+        assert signer.pool_keys == frozenset(alice.keypair)
+
+        # later batches carry public keys and digests only
+        pool = signer.executor
+        spy = signer.executor = SpyExecutor(pool)
+        [signed] = signer.sign_transactions(alice, unspent, [transaction])
+        assert verifier.verify_transactions([signed], unspent)
+        private_key = alice[public_key_of(alice)]
+        assert spy.chunks
+        assert all(private_key not in job for chunk in spy.chunks for job in chunk)
+        signer.executor = pool
+
+        # another wallet's keys need a new pool
+        (unspent, transaction) = spend_everything(bob, 2)
+        [signed] = signer.sign_transactions(bob, unspent, [transaction])
+        assert verifier.verify_transactions([signed], unspent)
+        assert signer.executor is not pool
+        assert signer.pool_keys == frozenset(bob.keypair)
+    finally:
+        signer.close()
+    assert signer.executor is None
+    assert not signer.pool_keys
@@ -0,0 +1,59 @@
+import pytest
+
+from flatcoin.benchmarks.chaingen import generate_chain
+from flatcoin.chain import Chain
+from flatcoin.database import BlockStore
+from flatcoin.sync import BlockSync
+from flatcoin.validator import InvalidBlockError
+
+
+@pytest.fixture(scope="module")
+def synthetic():
+    return generate_chain(12, 8, seed=3)
+
+
+def new_chain(working_directory, genesis):
+    return Chain.with_genesis(
+        disk=BlockStore(":memory:"),
+        genesis=genesis,
+        checkpoint_path=str(working_directory / "coinstate.dat"),
+    )
+
+
+def utxos(coinstate):
+    return {
+        (reference.tx_hash, reference.index): output.serialize()
+        for (reference, output) in coinstate.unspent_transaction_outs.items()
+    }
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_blocks_are_synced_in_order(working_directory, synthetic, workers):
+    chain = new_chain(working_directory, synthetic.blocks[0])
+    block_sync = BlockSync(chain, workers=workers, decode_batch=4)
+    try:
+        block_sync.run([block.serialize() for block in synthetic.blocks[1:]])
+    finally:
+        block_sync.close()
+
+    assert chain.tip_hash == synthetic.blocks[-1].hash()
+    assert chain.disk.tip() == (11, synthetic.blocks[-1].hash())
+    assert utxos(chain.coinstate) == utxos(synthetic.coinstate)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_sync_stops_at_a_block_failing_the_stateless_checks(working_directory, synthetic, workers):
+    chain = new_chain(working_directory, synthetic.blocks[0])
+    raw_blocks = [bytearray(block.serialize()) for block in synthetic.blocks[1:]]
+    # a flipped bit in the last signature no longer matches the merkle root
+    raw_blocks[6][-100] ^= 1
+
+    block_sync = BlockSync(chain, workers=workers, decode_batch=4)
+    try:
+        with pytest.raises(InvalidBlockError):
+            block_sync.run([bytes(raw) for raw in raw_blocks])
+    finally:
+        block_sync.close()
+
+    assert chain.tip_hash == synthetic.blocks[6].hash()
+    assert chain.disk.tip() == (6, synthetic.blocks[6].hash())